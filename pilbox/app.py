@@ -16,32 +16,70 @@
 
 from __future__ import absolute_import, division, with_statement
 
+import asyncio
+import hashlib
 import logging
+import os
+import random
 import socket
+import time
 
 import tornado.escape
 import tornado.gen
 import tornado.httpclient
 import tornado.httpserver
+import tornado.httputil
 import tornado.ioloop
+import tornado.netutil
 import tornado.options
+import tornado.process
 import tornado.web
 from tornado.options import define, options, parse_config_file
+from tornado.simple_httpclient import HTTPStreamClosedError
 
 from pilbox import errors
-from pilbox.image import Image
-from pilbox.signature import verify_signature
+from pilbox.cache import LRUCache, RenderCache, SharedRenderCache, STALE
+from pilbox.focalpoint import FocalPointStore
+from pilbox.health import HealthMonitor, RetryBudget
+from pilbox.image import Image, parse_encoder_profiles, \
+    set_block_cache_size, set_buffer_pool, set_encoder_profiles, \
+    set_focal_point_store
+from pilbox.origin import parse_origins
+from pilbox.peer import parse_peers
+from pilbox.pool import BufferPool
+from pilbox.result import get_result_key, get_result_store
+from pilbox.source import FileSource, S3Source, SourceResponse
+from pilbox.shm import SharedCache
+from pilbox.signature import Verifier, EXPIRED, VALID
+from pilbox.supervisor import get_cpu_count, get_rss, set_cpu_affinity, \
+    Supervisor
+from pilbox.vips import pyvips, VipsImage
 
 try:
     from urlparse import urlparse, urljoin
 except ImportError:
     from urllib.parse import urlparse, urljoin
 
+try:
+    from io import BytesIO
+except ImportError:
+    from cStringIO import StringIO as BytesIO
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
 try:
     import pycurl
 except ImportError:
     pycurl = None
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 
 # general settings
 define("config", help="path to configuration file",
@@ -50,20 +88,71 @@ define("debug", help="run in debug mode", type=bool, default=False)
 define("port", help="run on the given port", type=int, default=8888)
 define("workers", help="number of worker processes (0 = auto)",
        type=int, default=0)
+define("reuse_port", help="bind a SO_REUSEPORT socket per worker",
+       type=bool, default=False)
+define("cpu_affinity", help="pin each worker to a CPU", type=bool,
+       default=False)
+define("uvloop", help="run on the uvloop event loop", type=bool,
+       default=False)
+define("backend", help="image processing backend, pil or vips",
+       default="pil")
+define("buffer_pool_size", help="output buffers to reuse per worker",
+       type=int, default=16)
+define("image_block_cache", help="image memory blocks to reuse per worker",
+       type=int, default=0)
+define("worker_max_requests", help="requests before recycling a worker",
+       type=int, default=0)
+define("worker_max_rss", help="memory in MB before recycling a worker",
+       type=int, default=0)
+define("worker_drain_timeout", help="seconds to drain a recycled worker",
+       type=float, default=30)
+define("stats", help="serve worker and cache stats at /stats", type=bool,
+       default=False)
 
 # security related settings
 define("client_name", help="client name")
 define("client_key", help="client key")
+define("client_keys", help="additional active client keys, for rotation",
+       default=[], multiple=True)
 define("allowed_hosts", help="valid hosts", default=[], multiple=True)
 define("allowed_operations", help="valid ops", default=[], multiple=True)
 define("max_operations", help="maximum operations to perform", default=10)
 define("max_resize_height", help="maximum resize height", default=15000)
 define("max_resize_width", help="maximum resize width", default=15000)
+define("max_frames", help="maximum frames in an animated image", type=int)
+define("max_total_pixels", help="maximum pixels across animation frames",
+       type=int)
 
 # request related settings
 define("max_requests", help="max concurrent requests", type=int, default=40)
 define("timeout", help="request timeout in seconds", type=float, default=10)
+define("adaptive_timeout", help="derive host timeouts from p99 latency",
+       type=bool, default=False)
+define("min_timeout", help="minimum adaptive timeout in seconds",
+       type=float, default=1.0)
+define("hedge", help="hedge fetches slower than the host's p95",
+       type=bool, default=False)
+define("retries", help="retries of failed connections", type=int, default=2)
+define("retry_backoff", help="base retry backoff in seconds", type=float,
+       default=0.05)
+define("retry_budget", help="retries and hedges per request, 0.0-1.0",
+       type=float, default=0.1)
+define("breaker_failures", help="failures before failing fast for a host",
+       type=int, default=5)
+define("breaker_reset", help="seconds before retrying a failing host",
+       type=float, default=30)
 define("implicit_base_url", help="prepend protocol/host to url paths")
+define("origins", help="origin mirrors as name=base_url", default=[],
+       multiple=True)
+define("file_root", help="directory of images served for file urls")
+define("s3_endpoint", help="base url of the object store for s3 urls")
+define("s3_access_key", help="object store access key")
+define("s3_secret_key", help="object store secret key")
+define("s3_region", help="object store region", default="us-east-1")
+define("s3_part_size", help="bytes per object part request", type=int,
+       default=8 * 1024 * 1024)
+define("s3_parallel", help="object part requests made in parallel",
+       type=int, default=4)
 define("ca_certs",
        help="override filename of CA certificates in PEM format",
        default=None)
@@ -72,6 +161,65 @@ define("proxy_host", help="proxy hostname")
 define("proxy_port", help="proxy port", type=int)
 define("user_agent", help="user agent", type=str)
 
+# focal point related settings
+define("focal_point_store", help="path to the persistent focal point store")
+define("focal_point_store_size", help="maximum focal points to store",
+       type=int, default=100000)
+
+# info related settings
+define("info_cache_size", help="maximum image infos to cache", type=int,
+       default=10000)
+define("info_cache_ttl", help="seconds to cache image infos", type=float,
+       default=3600)
+
+# negative cache related settings
+define("negative_cache_size", help="maximum failed fetches to cache",
+       type=int, default=10000)
+define("negative_cache_ttl_4xx",
+       help="seconds to cache fetches failing with a 404 or 410 status",
+       type=float, default=60)
+define("negative_cache_ttl_5xx",
+       help="seconds to cache fetches failing with a 5xx status or timeout",
+       type=float, default=10)
+
+# render cache related settings
+define("render_cache_size",
+       help="memory in MB of rendered images to cache per worker",
+       type=int, default=0)
+define("render_cache_ttl", help="seconds rendered images are fresh",
+       type=float, default=300)
+define("render_cache_stale",
+       help="seconds stale rendered images are served while refreshed",
+       type=float, default=60)
+
+# shared cache related settings
+define("shared_cache_size",
+       help="memory in MB shared by the workers to cache images",
+       type=int, default=0)
+define("shared_cache_stripes", help="locks striping the shared cache",
+       type=int, default=16)
+define("shared_cache_item_size", help="largest item in KB in the shared cache",
+       type=int, default=4096)
+define("source_cache_ttl",
+       help="seconds to cache fetched images in the shared cache",
+       type=float, default=60)
+
+# peer related settings
+define("peers", help="urls of the nodes of the cluster", default=[],
+       multiple=True)
+define("peer_self", help="url of this node, one of the peers")
+define("peer_hash", help="route by the request or source url",
+       default="request")
+define("peer_timeout", help="timeout of requests to peers in seconds",
+       type=float, default=5)
+
+# result store related settings
+define("result_store",
+       help="file or s3 url under which rendered images are stored")
+define("result_url", help="base url redirected to for stored images")
+define("result_accel",
+       help="internal location of stored images, for X-Accel-Redirect")
+
 # header related settings
 define("content_type_from_image",
        help="override content type using image mime type",
@@ -81,15 +229,25 @@ define("content_type_from_image",
 define("background", help="default hexadecimal bg color (RGB or ARGB)")
 define("expand", help="default to expand when rotating", type=int)
 define("filter", help="default filter to use when resizing")
-define("format", help="default format to use when outputting")
+define("format", help="default format to use when outputting (or auto)")
 define("mode", help="default mode to use when resizing")
 define("operation", help="default operation to perform")
 define("optimize", help="default to optimize when saving", type=int)
 define("position", help="default cropping position")
 define("progressive", help="default to progressive when saving", type=int)
-define("quality", help="default jpeg quality, 1-99 or keep")
+define("quality", help="default jpeg quality, 1-99, keep or auto")
+define("target_size", help="target size in bytes for auto quality", type=int)
+define("target_ssim", help="target similarity for auto quality, 0.0-1.0",
+       type=float)
+define("max_encodes", help="maximum encodes for auto quality", type=int)
+define("encode_budget", help="time budget in seconds for auto quality",
+       type=float)
 define("retain", help="default adaptive retain percent, 1-99", type=int)
 define("preserve_exif", help="default behavior for exif data", type=int)
+define("profile", help="default encoder profile, e.g. fast or smallest")
+define("encoder_profiles",
+       help="encoder settings as name:format:key=value[:key=value]",
+       default=[], multiple=True)
 
 logger = logging.getLogger("tornado.application")
 
@@ -99,14 +257,21 @@ class PilboxApplication(tornado.web.Application):
     def __init__(self, **kwargs):
         settings = dict(
             debug=options.debug,
+            backend=options.backend,
+            buffer_pool_size=options.buffer_pool_size,
+            image_block_cache=options.image_block_cache,
+            stats=options.stats,
             client_name=options.client_name,
             client_key=options.client_key,
+            client_keys=options.client_keys,
             allowed_hosts=options.allowed_hosts,
             allowed_operations=set(
                 options.allowed_operations or ImageHandler.OPERATIONS),
             max_operations=options.max_operations,
             max_resize_height=options.max_resize_height,
             max_resize_width=options.max_resize_width,
+            max_frames=options.max_frames,
+            max_total_pixels=options.max_total_pixels,
             background=options.background,
             expand=options.expand,
             filter=options.filter,
@@ -117,19 +282,82 @@ class PilboxApplication(tornado.web.Application):
             position=options.position,
             progressive=options.progressive,
             quality=options.quality,
+            target_size=options.target_size,
+            target_ssim=options.target_ssim,
+            max_encodes=options.max_encodes,
+            encode_budget=options.encode_budget,
             max_requests=options.max_requests,
             timeout=options.timeout,
+            adaptive_timeout=options.adaptive_timeout,
+            min_timeout=options.min_timeout,
+            hedge=options.hedge,
+            retries=options.retries,
+            retry_backoff=options.retry_backoff,
+            retry_budget=options.retry_budget,
+            breaker_failures=options.breaker_failures,
+            breaker_reset=options.breaker_reset,
             implicit_base_url=options.implicit_base_url,
+            origins=options.origins,
+            file_root=options.file_root,
+            s3_endpoint=options.s3_endpoint,
+            s3_access_key=options.s3_access_key,
+            s3_secret_key=options.s3_secret_key,
+            s3_region=options.s3_region,
+            s3_part_size=options.s3_part_size,
+            s3_parallel=options.s3_parallel,
             ca_certs=options.ca_certs,
             user_agent=options.user_agent,
             validate_cert=options.validate_cert,
             content_type_from_image=options.content_type_from_image,
             proxy_host=options.proxy_host,
             proxy_port=options.proxy_port,
-            preserve_exif=options.preserve_exif)
+            preserve_exif=options.preserve_exif,
+            profile=options.profile,
+            encoder_profiles=options.encoder_profiles,
+            focal_point_store=options.focal_point_store,
+            focal_point_store_size=options.focal_point_store_size,
+            info_cache_size=options.info_cache_size,
+            info_cache_ttl=options.info_cache_ttl,
+            negative_cache_size=options.negative_cache_size,
+            negative_cache_ttl_4xx=options.negative_cache_ttl_4xx,
+            negative_cache_ttl_5xx=options.negative_cache_ttl_5xx,
+            render_cache_size=options.render_cache_size,
+            render_cache_ttl=options.render_cache_ttl,
+            render_cache_stale=options.render_cache_stale,
+            shared_cache_size=options.shared_cache_size,
+            shared_cache_stripes=options.shared_cache_stripes,
+            shared_cache_item_size=options.shared_cache_item_size,
+            source_cache_ttl=options.source_cache_ttl,
+            peers=options.peers,
+            peer_self=options.peer_self,
+            peer_hash=options.peer_hash,
+            peer_timeout=options.peer_timeout,
+            result_store=options.result_store,
+            result_url=options.result_url,
+            result_accel=options.result_accel)
 
         settings.update(kwargs)
 
+        if settings.get("buffer_pool_size"):
+            set_buffer_pool(BufferPool(settings.get("buffer_pool_size")))
+        else:
+            set_buffer_pool(None)
+        set_block_cache_size(settings.get("image_block_cache") or 0)
+        profiles = parse_encoder_profiles(settings.get("encoder_profiles"))
+        if settings.get("profile") and settings.get("profile") not in profiles:
+            raise Exception("Unknown profile: %s" % settings.get("profile"))
+        set_encoder_profiles(profiles)
+
+        if settings.get("focal_point_store"):
+            set_focal_point_store(FocalPointStore(
+                settings.get("focal_point_store"),
+                settings.get("focal_point_store_size")))
+
+        if settings.get("backend") not in ["pil", "vips"]:
+            raise Exception("Unknown backend: %s" % settings.get("backend"))
+        elif settings.get("backend") == "vips" and pyvips is None:
+            raise Exception("pyvips is required for the vips backend")
+
         if settings.get("proxy_host") and pycurl is None:  # pragma: no cover
             raise Exception("PycURL is required for proxy requests")
 
@@ -137,14 +365,89 @@ class PilboxApplication(tornado.web.Application):
             tornado.httpclient.AsyncHTTPClient.configure(
                 "tornado.curl_httpclient.CurlAsyncHTTPClient")
 
+        keys = [settings.get("client_key")] + \
+            list(settings.get("client_keys") or [])
+        self.verifier = Verifier(keys) if any(keys) else None
+
+        # The supervised worker serving this application, if any
+        self.worker = None
+        self.info_cache = LRUCache(
+            settings.get("info_cache_size"), settings.get("info_cache_ttl"))
+        self.health = HealthMonitor(
+            settings.get("breaker_failures"), settings.get("breaker_reset"))
+        self.retry_budget = RetryBudget(settings.get("retry_budget"))
+        self.origins = parse_origins(settings.get("origins"), self.health)
+        # Sources of images by url scheme, other than http(s)
+        self.sources = dict()
+        if settings.get("file_root"):
+            self.sources["file"] = FileSource(settings.get("file_root"))
+        if settings.get("s3_endpoint"):
+            self.sources["s3"] = S3Source(
+                settings.get("s3_endpoint"),
+                access_key=settings.get("s3_access_key"),
+                secret_key=settings.get("s3_secret_key"),
+                region=settings.get("s3_region"),
+                part_size=settings.get("s3_part_size"),
+                parallel=settings.get("s3_parallel"),
+                timeout=settings.get("timeout"),
+                max_clients=settings.get("max_requests"))
+        # Maps urls that recently failed to fetch to the failure status
+        self.negative_cache = LRUCache(settings.get("negative_cache_size"))
+        # Created before workers are forked, so that they share it
+        self.shared_cache = None
+        if settings.get("shared_cache_size"):
+            self.shared_cache = SharedCache(
+                settings.get("shared_cache_size") * 1024 * 1024,
+                settings.get("shared_cache_stripes"),
+                settings.get("shared_cache_item_size") * 1024)
+        self.render_cache = None
+        if self.shared_cache is not None:
+            self.render_cache = SharedRenderCache(
+                self.shared_cache, settings.get("render_cache_ttl"),
+                settings.get("render_cache_stale"))
+        elif settings.get("render_cache_size"):
+            self.render_cache = RenderCache(
+                settings.get("render_cache_size") * 1024 * 1024,
+                settings.get("render_cache_ttl"),
+                settings.get("render_cache_stale"))
+        if settings.get("peer_hash") not in ["request", "source"]:
+            raise Exception(
+                "Unknown peer_hash: %s" % settings.get("peer_hash"))
+        self.peers = parse_peers(settings.get("peers"),
+                                 settings.get("peer_self"))
+        self.result_store = None
+        if settings.get("result_store"):
+            if not (settings.get("result_url") or
+                    settings.get("result_accel")):
+                raise Exception("result_url or result_accel is required "
+                                "with a result_store")
+            self.result_store = get_result_store(
+                settings.get("result_store"), self.sources.get("s3"))
+
         tornado.web.Application.__init__(self, self.get_handlers(), **settings)
 
     def get_handlers(self):
-        return [(r"/", ImageHandler)]
+        return [(r"/", ImageHandler), (r"/info", InfoHandler),
+                (r"/stats", StatsHandler)]
 
 
 class ImageHandler(tornado.web.RequestHandler):
     FORWARD_HEADERS = ["Cache-Control", "Expires", "Last-Modified"]
+    # Headers of a render kept in the render cache, which sets its own
+    # Cache-Control in place of those forwarded from upstream
+    RENDER_HEADERS = ["Content-Type", "Etag", "Last-Modified", "Vary"]
+    EXPIRED_MAX_AGE = 86400
+    # Bytes of a streamed image waiting on a slow client before the
+    # stream is abandoned, as an HTTP fetch cannot be paused
+    MAX_STREAM_BUFFER = 8 * 1024 * 1024
+    # Prefix of the keys of fetched images in the shared cache
+    SOURCE_PREFIX = "source:"
+    # Marks requests forwarded by a peer, which are never forwarded again
+    PEER_HEADER = "X-Pilbox-Peer"
+    PEER_REQUEST_HEADERS = ["Accept", "If-None-Match"]
+    PEER_RESPONSE_HEADERS = ["Cache-Control", "Content-Type", "Etag",
+                             "Expires", "Last-Modified", "Location", "Vary",
+                             "X-Accel-Redirect"]
     OPERATIONS = ["region", "resize", "rotate", "noop"]
 
     _FORMAT_TO_MIME = {
@@ -156,10 +459,40 @@ class ImageHandler(tornado.web.RequestHandler):
         "tiff": "image/tiff",
     }
 
-    @tornado.gen.coroutine
-    def get(self):
+    _MIME_TO_FORMAT = dict(
+        (v, k) for k, v in _FORMAT_TO_MIME.items() if k != "jpg")
+
+    def prepare(self):
+        self._worker = self.application.worker
+        self._source_responses = []
+        if self._worker is not None:
+            self._worker.request_started()
+
+    def on_finish(self):
+        for resp in getattr(self, "_source_responses", []):
+            resp.close()
+        if getattr(self, "_worker", None) is not None:
+            self._worker.request_finished()
+
+    async def get(self):
         self.validate_request()
-        resp = yield self.fetch_image()
+        if "noop" in self._get_operations():
+            await self.stream_image()
+            return
+        if self._write_cached_render():
+            return
+        forwarded = await self._forward_to_peer()
+        if forwarded:
+            return
+        name = await self._lookup_result()
+        if name is not None:
+            self._redirect_result(name)
+            return
+        resp = await self.fetch_image()
+        if self._is_not_modified(resp):
+            self.set_status(304)
+            self.finish()
+            return
         self.render_image(resp)
 
     def get_argument(self, name, default=None, strip=True):
@@ -190,42 +523,276 @@ class ImageHandler(tornado.web.RequestHandler):
 
         Image.validate_options(opts)
 
-    @tornado.gen.coroutine
-    def fetch_image(self):
-        url = self.get_argument("url")
-        if self.settings.get("implicit_base_url") \
-                and urlparse(url).hostname is None:
-            url = urljoin(self.settings.get("implicit_base_url"), url)
+    async def fetch_image(self, **kwargs):
+        self.application.retry_budget.deposit()
+        urls = self._get_urls()
+        for (i, url) in enumerate(urls):
+            state = dict(first_byte=None, code=None, streamed=False,
+                         stopped=False)
+            try:
+                resp = await self._fetch_url(url, state, **kwargs)
+            except errors.FetchError:
+                # Fail over to the next mirror, unless streaming started
+                if i + 1 < len(urls) and not state["streamed"]:
+                    logger.debug("Failing over from %s", url)
+                    continue
+                raise
+            return resp
+
+    async def _fetch_url(self, url, state, **kwargs):
+        source = self.application.sources.get(urlparse(url).scheme)
+        if source is not None:
+            resp = await source.fetch(url, **kwargs)
+            self._source_responses.append(resp)
+            return resp
+        cacheable = self._is_source_cacheable(kwargs)
+        if cacheable:
+            resp = self._get_cached_source(url)
+            if resp is not None:
+                return resp
+        error_key = _get_fetch_error_key(url, kwargs)
+        if error_key in self.application.negative_cache:
+            logger.debug("Cached fetch error for %s", url)
+            raise errors.FetchError()
+        health = self.application.health.get(urlparse(url).netloc)
+        budget = self.application.retry_budget
+        retries = 0
+        while True:
+            if not health.allow():
+                logger.debug("Circuit open for %s", url)
+                raise errors.FetchError("Origin unavailable")
+            try:
+                resp = await self._fetch(url, health, state, **kwargs)
+            except (socket.error, tornado.httpclient.HTTPError) as e:
+                if getattr(e, "code", None) == 304:
+                    # Only the refresh of a render is conditional
+                    return e.response
+                elif state["stopped"]:
+                    # By the streaming callback, not a failure of the url
+                    raise errors.FetchError()
+                # A streamed response cannot be retried once started
+                if retries < self.settings.get("retries") \
+                        and _is_connection_error(e) \
+                        and not state["streamed"] \
+                        and budget.withdraw():
+                    retries += 1
+                    state["first_byte"] = None
+                    # Exponential backoff with full jitter
+                    await tornado.gen.sleep(random.uniform(
+                        0, self.settings.get("retry_backoff") * 2 ** retries))
+                    continue
+                logger.warn("Fetch error for %s: %s", url, str(e))
+                # Name resolution failures are treated as timeouts
+                self._cache_fetch_error(error_key, getattr(e, "code", 599))
+                raise errors.FetchError()
+            if cacheable:
+                self._cache_source(url, resp)
+            return resp
+
+    async def _fetch(self, url, health, state, **kwargs):
+        """Fetches the url, hedging with a second request if the first
+        byte has not been received by the host's p95 time to first byte.
+        """
+        first = self._fetch_once(url, health, state, **kwargs)
+        delay = None
+        if self.settings.get("hedge") and "streaming_callback" not in kwargs:
+            delay = health.get_hedge_delay()
+        if delay is None:
+            return await first
+
+        wait = tornado.gen.WaitIterator(first, tornado.gen.sleep(delay))
+        await wait.next()
+        if wait.current_future is first or state["first_byte"] is not None \
+                or not self.application.retry_budget.withdraw():
+            return await first
+
+        logger.debug("Hedging fetch of %s after %.3fs", url, delay)
+        second = self._fetch_once(url, health, state, **kwargs)
+        wait = tornado.gen.WaitIterator(first, second)
+        error = None
+        while not wait.done():
+            try:
+                resp = await wait.next()
+            except tornado.httpclient.HTTPError as e:
+                if e.code < 500:
+                    raise
+                error = e
+                continue
+            except socket.error as e:
+                error = e
+                continue
+            return resp
+        raise error
+
+    def _fetch_once(self, url, health, state, **kwargs):
+        """Returns the future of a single fetch, recording its outcome in
+        the health of the host.
+        """
+        timeout = self.settings.get("timeout")
+        if self.settings.get("adaptive_timeout"):
+            timeout = health.get_timeout(
+                timeout, self.settings.get("min_timeout"))
+        header_callback = kwargs.pop("header_callback", None)
+        streaming_callback = kwargs.pop("streaming_callback", None)
+        start = time.time()
+
+        def on_header(line):
+            if state["first_byte"] is None:
+                state["first_byte"] = time.time() - start
+                health.record_first_byte(state["first_byte"])
+            if line.startswith("HTTP/"):
+                state["code"] = int(line.split(" ", 2)[1])
+            if header_callback is not None:
+                header_callback(line)
+
+        def on_block(block):
+            # The body of an error response is not passed on to the client,
+            # so only a successful one commits the fetch
+            if 200 <= state["code"] < 300:
+                state["streamed"] = True
+            try:
+                return streaming_callback(block)
+            except Exception:
+                state["stopped"] = True
+                raise
+
+        def on_done(future):
+            # Client errors show the host is responding, anything else,
+            # e.g. a timeout or refused connection, counts as a failure
+            e = future.exception()
+            failed = e is not None and getattr(e, "code", 599) >= 500 \
+                and not state["stopped"]
+            health.record(time.time() - start, failed=failed)
 
         client = tornado.httpclient.AsyncHTTPClient(
             max_clients=self.settings.get("max_requests"))
+        future = client.fetch(
+            url,
+            request_timeout=timeout,
+            ca_certs=self.settings.get("ca_certs"),
+            validate_cert=self.settings.get("validate_cert"),
+            user_agent=self.settings.get("user_agent"),
+            proxy_host=self.settings.get("proxy_host"),
+            proxy_port=self.settings.get("proxy_port"),
+            header_callback=on_header,
+            streaming_callback=on_block if streaming_callback else None,
+            **kwargs)
+        future.add_done_callback(on_done)
+        return future
+
+    def _is_source_cacheable(self, kwargs):
+        # Only plain fetches, not streamed, ranged or conditional ones
+        return self.application.shared_cache is not None \
+            and bool(self.settings.get("source_cache_ttl")) and not kwargs
+
+    def _get_cached_source(self, url):
+        data = self.application.shared_cache.get(ImageHandler.SOURCE_PREFIX +
+                                                 url)
+        if data is None:
+            return None
+        headers, body = pickle.loads(data)
+        return tornado.httpclient.HTTPResponse(
+            tornado.httpclient.HTTPRequest(url), 200,
+            headers=tornado.httputil.HTTPHeaders(headers),
+            buffer=BytesIO(body))
+
+    def _cache_source(self, url, resp):
+        if resp.code != 200 or not _is_shared_cacheable(resp):
+            return
+        data = pickle.dumps((list(resp.headers.get_all()), resp.body),
+                            pickle.HIGHEST_PROTOCOL)
+        self.application.shared_cache.set(
+            ImageHandler.SOURCE_PREFIX + url, data,
+            self.settings.get("source_cache_ttl"))
+
+    def _cache_fetch_error(self, key, code):
+        # Other client errors may be due to the request rather than the url
+        if code // 100 == 4 and code not in (404, 410):
+            return
+        ttl = self.settings.get("negative_cache_ttl_%dxx" % (code // 100))
+        if ttl:
+            self.application.negative_cache.set(key, code, ttl)
+
+    async def stream_image(self):
+        """Writes the image to the client as it is received from upstream,
+        rather than buffering the entire image first. Headers are sent
+        with the first block of a successful response.
+
+        Sources wait for each block to be sent before reading the next.
+        The HTTP client reads on regardless, so the stream is abandoned once
+        more than MAX_STREAM_BUFFER bytes wait on the client.
+        """
+        state = dict(code=None, headers=None, started=False, buffered=0)
+
+        def on_flush(future, size):
+            state["buffered"] -= size
+            if not future.cancelled():
+                future.exception()  # The client may have disconnected
+
+        def on_header(line):
+            if line.startswith("HTTP/"):
+                # Each redirect response begins a new set of headers
+                state["code"] = int(line.split(" ", 2)[1])
+                state["headers"] = tornado.httputil.HTTPHeaders()
+            elif line.strip():
+                state["headers"].parse_line(line)
+
+        def on_block(block):
+            if state["code"] != 200:
+                return None
+            if not state["started"]:
+                self._set_headers(state["headers"], None)
+                state["started"] = True
+            if state["buffered"] and state["buffered"] + len(block) > \
+                    ImageHandler.MAX_STREAM_BUFFER:
+                raise errors.FetchError("Client too slow to stream to")
+            self.write(block)
+            state["buffered"] += len(block)
+            future = self.flush()
+            future.add_done_callback(lambda f: on_flush(f, len(block)))
+            return future
+
         try:
-            resp = yield client.fetch(
-                url,
-                request_timeout=self.settings.get("timeout"),
-                ca_certs=self.settings.get("ca_certs"),
-                validate_cert=self.settings.get("validate_cert"),
-                user_agent=self.settings.get("user_agent"),
-                proxy_host=self.settings.get("proxy_host"),
-                proxy_port=self.settings.get("proxy_port"))
-            raise tornado.gen.Return(resp)
-        except (socket.gaierror, tornado.httpclient.HTTPError) as e:
-            logger.warn("Fetch error for %s: %s",
-                        self.get_argument("url"),
-                        str(e))
-            raise errors.FetchError()
+            await self.fetch_image(header_callback=on_header,
+                                   streaming_callback=on_block)
+        except errors.FetchError:
+            if state["started"]:
+                # Rather than finishing, so a partial image does not look
+                # complete to the client
+                self.request.connection.close()
+            raise
+        if not state["started"] and state["headers"] is not None:
+            self._set_headers(state["headers"], None)
 
     def render_image(self, resp):
-        outfile, outfile_format = self._process_response(resp)
-        self._set_headers(resp.headers, outfile_format)
-        for block in iter(lambda: outfile.read(65536), b""):
-            self.write(block)
-        outfile.close()
+        data, headers = self._render(resp)
+        for (k, v) in headers.items():
+            self.set_header(k, v)
+        # A single write avoids copying the image into blocks, only for
+        # them to be joined again when the response is flushed
+        self.write(data)
+        if self._is_render_cacheable(resp):
+            self.clear_header("Expires")
+            self.set_header("Cache-Control", self._get_cache_control(
+                self.settings.get("render_cache_ttl")))
+            headers = dict((k, v) for (k, v) in self._headers.get_all()
+                           if k in ImageHandler.RENDER_HEADERS)
+            self.application.render_cache.set(
+                self._get_render_key(), (data, headers, _get_validators(resp)),
+                len(data))
+        if getattr(self, "_result_key", None) is not None \
+                and _is_shared_cacheable(resp):
+            tornado.ioloop.IOLoop.current().spawn_callback(
+                self._store_result, self._result_key, data)
 
     def write_error(self, status_code, **kwargs):
         err = kwargs["exc_info"][1] if "exc_info" in kwargs else None
         if isinstance(err, errors.PilboxError):
             self.set_header("Content-Type", "application/json")
+            if isinstance(err, errors.SignatureExpiredError):
+                # An expired URL never becomes valid again
+                self.set_header("Cache-Control", "public, max-age=%d"
+                                % ImageHandler.EXPIRED_MAX_AGE)
             resp = dict(status_code=status_code,
                         error_code=err.get_code(),
                         error=err.log_message)
@@ -233,12 +800,229 @@ class ImageHandler(tornado.web.RequestHandler):
         else:
             super(ImageHandler, self).write_error(status_code, **kwargs)
 
+    def _is_not_modified(self, resp):
+        """Sets the Etag of the rendered image from the validator of a
+        source response, returning whether the client's copy is current,
+        so that it need not be rendered.
+        """
+        etag = self._get_etag(resp)
+        if etag is None:
+            return False
+        self.set_header("Etag", etag)
+        return self.check_etag_header()
+
+    def _get_etag(self, resp):
+        validator = resp.headers.get("Etag")
+        if not isinstance(resp, SourceResponse) or not validator:
+            return None
+        parts = [validator, self.request.query]
+        if self._is_auto_format():
+            parts.extend(self._get_accepted_formats())
+        digest = hashlib.sha1("\n".join(parts).encode()).hexdigest()
+        return '"%s"' % digest
+
+    def _render(self, resp):
+        """Returns the rendered image and its headers"""
+        outfile, outfile_format = self._process_response(resp)
+        data = outfile.getvalue()
+        outfile.close()
+        return (data, self._get_headers(resp.headers, outfile_format))
+
+    def _write_cached_render(self):
+        """Writes the cached render of the request, if any, returning
+        whether it was written. A stale render is refreshed once written.
+        """
+        if self.application.render_cache is None:
+            return False
+        key = self._get_render_key()
+        cached = self.application.render_cache.get(key)
+        if cached is None:
+            return False
+        (data, headers, validators), state, fresh_for = cached
+        for (k, v) in headers.items():
+            self.set_header(k, v)
+        self.set_header("Cache-Control", self._get_cache_control(fresh_for))
+        if state == STALE and \
+                self.application.render_cache.begin_refresh(key):
+            tornado.ioloop.IOLoop.current().spawn_callback(
+                self._refresh_render, key, validators)
+        if "Etag" in headers and self.check_etag_header():
+            self.set_status(304)
+        else:
+            self.write(data)
+        self.finish()
+        return True
+
+    async def _refresh_render(self, key, validators):
+        """Revalidates the source of a stale render, conditionally when it
+        has a validator, rendering the image again only if it changed.
+        """
+        cache = self.application.render_cache
+        etag, last_modified = validators
+        headers = dict()
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        outcome = "error"
+        try:
+            resp = await self.fetch_image(headers=headers)
+            try:
+                if resp.code == 304 or (
+                        (etag or last_modified) and
+                        _get_validators(resp) == validators):
+                    cache.renew(key)
+                    outcome = "unchanged"
+                elif not self._is_render_cacheable(resp):
+                    cache.delete(key)
+                    outcome = "changed"
+                else:
+                    data, headers = self._render(resp)
+                    headers["Etag"] = self._get_etag(resp)
+                    headers = dict((k, v) for (k, v) in headers.items()
+                                   if k in ImageHandler.RENDER_HEADERS and
+                                   v is not None)
+                    cache.set(key, (data, headers, _get_validators(resp)),
+                              len(data))
+                    outcome = "changed"
+            finally:
+                if isinstance(resp, SourceResponse):
+                    resp.close()
+        except Exception as e:
+            # The stale render is served until it expires
+            logger.warning("Render refresh failed: %s", e)
+        finally:
+            cache.end_refresh(key, outcome)
+
+    def _is_render_cacheable(self, resp):
+        if self.application.render_cache is None:
+            return False
+        return _is_shared_cacheable(resp)
+
+    def _get_cache_control(self, max_age):
+        return "public, max-age=%d, stale-while-revalidate=%d" % (
+            max_age, self.settings.get("render_cache_stale"))
+
+    def _get_render_key(self):
+        return get_result_key(self._get_result_spec())
+
+    async def _forward_to_peer(self):
+        """Forwards the request to the peer owning its key, returning
+        whether the peer's response was written, which it is not when this
+        node owns the key, or the peer fails, so that it is rendered here.
+        """
+        ring = self.application.peers
+        if ring is None or ImageHandler.PEER_HEADER in self.request.headers:
+            return False
+        peer = ring.get(self._get_peer_key())
+        if peer == self.settings.get("peer_self").rstrip("/"):
+            return False
+        health = self.application.health.get(urlparse(peer).netloc)
+        if not health.allow():
+            return False
+
+        headers = {ImageHandler.PEER_HEADER: self.settings.get("peer_self")}
+        for k in ImageHandler.PEER_REQUEST_HEADERS:
+            if k in self.request.headers:
+                headers[k] = self.request.headers[k]
+        # Connections to peers are kept alive when PycURL is installed
+        client = tornado.httpclient.AsyncHTTPClient(
+            max_clients=self.settings.get("max_requests"))
+        start = time.time()
+        try:
+            resp = await client.fetch(
+                peer + self.request.uri, headers=headers,
+                follow_redirects=False, raise_error=False,
+                request_timeout=self.settings.get("peer_timeout"))
+        except (socket.error, tornado.httpclient.HTTPError) as e:
+            resp, error = None, e
+        else:
+            error = resp.error if resp.code >= 500 else None
+        health.record(time.time() - start, failed=error is not None)
+        if error is not None:
+            logger.warning("Peer %s failed, rendering locally: %s",
+                           peer, error)
+            return False
+
+        self.set_status(resp.code)
+        for k in ImageHandler.PEER_RESPONSE_HEADERS:
+            if k in resp.headers:
+                self.set_header(k, resp.headers[k])
+        if resp.body and resp.code != 304:
+            self.write(resp.body)
+        self.finish()
+        return True
+
+    def _get_peer_key(self):
+        if self.settings.get("peer_hash") == "source":
+            origin = self.get_argument("origin")
+            if origin:
+                return "%s:%s" % (origin, self.get_argument("url"))
+            return self._get_url()
+        return get_result_key(self._get_result_spec())
+
+    async def _lookup_result(self):
+        """Returns the name of the stored result of the request, if any,
+        remembering its key, so that a rendered result can be stored.
+        """
+        self._result_key = None
+        if self.application.result_store is None:
+            return None
+        self._result_key = get_result_key(self._get_result_spec())
+        try:
+            name = await self.application.result_store.lookup(
+                self._result_key)
+        except Exception as e:
+            # The image can still be rendered when the store is down
+            logger.warning("Result lookup failed: %s", e)
+            return None
+        return name
+
+    async def _store_result(self, key, data):
+        try:
+            await self.application.result_store.put(key, data)
+        except Exception as e:
+            logger.warning("Result store failed: %s", e)
+
+    def _redirect_result(self, name):
+        if self._is_auto_format():
+            self.set_header("Vary", "Accept")
+        if self.settings.get("result_accel"):
+            self.set_header("X-Accel-Redirect", "%s/%s" % (
+                self.settings.get("result_accel").rstrip("/"), name))
+            self.finish()
+        else:
+            self.redirect("%s/%s" % (
+                self.settings.get("result_url").rstrip("/"), name))
+
+    def _get_result_spec(self):
+        """Returns everything that determines the rendered image, with
+        defaults applied, so that equivalent requests share a result.
+        """
+        origin = self.get_argument("origin")
+        spec = dict(
+            url=self.get_argument("url") if origin else self._get_url(),
+            origin=origin,
+            backend=self.settings.get("backend"),
+            operations=self._get_operations(),
+            args=dict((k, self.get_argument(k))
+                      for k in ["w", "h", "deg", "rect"]),
+            resize=self._get_resize_options(),
+            rotate=self._get_rotate_options(),
+            save=self._get_save_options())
+        if self._is_auto_format():
+            spec["formats"] = self._get_accepted_formats()
+        return spec
+
     def _process_response(self, resp):
         ops = self._get_operations()
         if "noop" in ops:
             return (resp.buffer, None)
 
-        image = Image(resp.buffer)
+        if self.settings.get("backend") == "vips":
+            image = VipsImage(resp.buffer)
+        else:
+            image = Image(resp.buffer)
         for operation in ops:
             if operation == "resize":
                 self._image_resize(image)
@@ -262,20 +1046,68 @@ class ImageHandler(tornado.web.RequestHandler):
 
     def _image_save(self, image):
         opts = self._get_save_options()
+        if opts["format"] == Image.AUTO_FORMAT:
+            opts["format"] = image.get_auto_format(
+                self._get_accepted_formats())
         return image.save(**opts)
 
     def _set_headers(self, headers, file_format):
+        for (k, v) in self._get_headers(headers, file_format).items():
+            self.set_header(k, v)
+
+    def _get_headers(self, headers, file_format):
+        """Returns the headers of the response, given those of upstream"""
+        result = dict()
         if file_format and any((self.get_argument("fmt"),
                                 self.settings.get("format"),
                                 self.settings.get("content_type_from_image"))):
-            self.set_header(
-                "Content-Type", self._FORMAT_TO_MIME.get(file_format.lower()))
+            result["Content-Type"] = self._FORMAT_TO_MIME.get(
+                file_format.lower())
         elif "Content-Type" in headers:
-            self.set_header("Content-Type", headers["Content-Type"])
+            result["Content-Type"] = headers["Content-Type"]
 
         for k in ImageHandler.FORWARD_HEADERS:
             if k in headers and headers[k]:
-                self.set_header(k, headers[k])
+                result[k] = headers[k]
+
+        if file_format and self._is_auto_format():
+            # The output format depends on the Accept header, so caches
+            # must key the response on it as well.
+            result["Vary"] = "Accept"
+        return result
+
+    def _is_auto_format(self):
+        return (self.get_argument("fmt") or self.settings.get("format")) \
+            == Image.AUTO_FORMAT
+
+    def _get_accepted_formats(self):
+        accepted = []
+        for value in self.request.headers.get("Accept", "").split(","):
+            params = [p.strip() for p in value.split(";")]
+            if "q=0" in params or "q=0.0" in params:
+                continue
+            fmt = ImageHandler._MIME_TO_FORMAT.get(params[0].lower())
+            if fmt:
+                accepted.append(fmt)
+        return accepted
+
+    def _get_url(self):
+        url = self.get_argument("url")
+        origin = self.get_argument("origin")
+        if origin:
+            return self.application.origins[origin].get_url(url)
+        elif self.settings.get("implicit_base_url") \
+                and urlparse(url).hostname is None:
+            url = urljoin(self.settings.get("implicit_base_url"), url)
+        return url
+
+    def _get_urls(self):
+        """Returns the urls of the image to try in turn"""
+        origin = self.get_argument("origin")
+        if origin:
+            return self.application.origins[origin].get_urls(
+                self.get_argument("url"))
+        return [self._get_url()]
 
     def _get_operations(self):
         return self.get_argument(
@@ -300,7 +1132,14 @@ class ImageHandler(tornado.web.RequestHandler):
                  quality=self.get_argument("q"),
                  progressive=self.get_argument("prog"),
                  background=self.get_argument("bg"),
-                 preserve_exif=self.get_argument("exif")))
+                 preserve_exif=self.get_argument("exif"),
+                 profile=self.get_argument("profile"),
+                 target_size=None,
+                 target_ssim=None,
+                 max_encodes=None,
+                 encode_budget=None,
+                 max_frames=None,
+                 max_total_pixels=None))
 
     def _get_options(self, opts):
         for k, v in opts.items():
@@ -317,12 +1156,21 @@ class ImageHandler(tornado.web.RequestHandler):
 
     def _validate_url(self):
         url = self.get_argument("url")
+        origin = self.get_argument("origin")
         if not url:
             raise errors.UrlError("Missing url")
+        elif origin:
+            if origin not in self.application.origins:
+                raise errors.UrlError("Unknown origin")
+            elif urlparse(url).scheme or urlparse(url).netloc:
+                raise errors.UrlError("Origin urls must be relative")
+            return
         elif url.startswith("http://") or url.startswith("https://"):
             return
         elif self.settings.get("implicit_base_url") and url.startswith("/"):
             return
+        elif urlparse(url).scheme in self.application.sources:
+            return
         raise errors.UrlError("Unsupported protocol")
 
     def _validate_client(self):
@@ -331,16 +1179,151 @@ class ImageHandler(tornado.web.RequestHandler):
             raise errors.ClientError("Invalid client")
 
     def _validate_signature(self):
-        key = self.settings.get("client_key")
-        if key and not verify_signature(key, urlparse(self.request.uri).query):
+        verifier = self.application.verifier
+        if verifier is None:
+            return
+        result = verifier.verify(self.request.query)
+        if result == EXPIRED:
+            raise errors.SignatureExpiredError("Expired signature")
+        elif result != VALID:
             raise errors.SignatureError("Invalid signature")
 
     def _validate_host(self):
+        if self.get_argument("origin"):
+            return  # Origin mirrors are trusted
+        elif urlparse(self._get_url()).scheme in self.application.sources:
+            return
         hosts = self.settings.get("allowed_hosts", [])
         if hosts and urlparse(self.get_argument("url")).hostname not in hosts:
             raise errors.HostError("Invalid host")
 
 
+class InfoHandler(ImageHandler):
+    """Responds with JSON describing the image, read from its header. When
+    the origin supports ranged requests, only the start of the image is
+    requested.
+    """
+    RANGE_SIZE = 65536
+
+    async def get(self):
+        self.validate_request()
+        key = url = self._get_url()
+        if urlparse(url).scheme == "file":
+            # The file may have changed since its info was cached
+            key = "%s %s" % (url, self.application.sources["file"]
+                             .get_validator(url))
+        info = self.application.info_cache.get(key)
+        if info is None:
+            info = await self.fetch_info()
+            self.application.info_cache.set(key, info)
+        self.set_header("Content-Type", "application/json")
+        self.finish(tornado.escape.json_encode(info))
+
+    def validate_request(self):
+        self._validate_url()
+        self._validate_signature()
+        self._validate_client()
+        self._validate_host()
+
+    async def fetch_info(self):
+        resp = await self.fetch_image(
+            headers={"Range": "bytes=0-%d" % (InfoHandler.RANGE_SIZE - 1)})
+        if resp.code == 206:
+            buf = _PartialBuffer(resp.buffer.read())
+            try:
+                info = Image(buf).get_info()
+                # Looking for a second GIF frame may run past the range
+                if not buf.truncated:
+                    return info
+            except (errors.ImageFormatError, IOError, EOFError,
+                    SyntaxError, ValueError):
+                pass
+            resp = await self.fetch_image()
+        return Image(resp.buffer).get_info()
+
+
+class StatsHandler(ImageHandler):
+    """Responds with JSON describing the worker processes, including the
+    number of workers recycled for each reason when supervised. Stats are
+    only served when enabled, and to requests passing the client and
+    signature checks.
+    """
+
+    def prepare(self):
+        # Monitoring polls do not count toward recycling the worker
+        self._worker = None
+        self._source_responses = []
+
+    def get(self):
+        if not self.settings.get("stats"):
+            raise tornado.web.HTTPError(404)
+        self._validate_signature()
+        self._validate_client()
+        worker = self.application.worker
+        if worker is not None:
+            stats = worker.supervisor.get_stats()
+        else:
+            stats = dict(recycles=dict(), workers=[
+                dict(pid=os.getpid(), draining=False, rss=get_rss())])
+        if self.application.render_cache is not None:
+            stats["render_cache"] = self.application.render_cache.get_stats()
+        if self.application.shared_cache is not None:
+            stats["shared_cache"] = self.application.shared_cache.get_stats()
+        self.set_header("Content-Type", "application/json")
+        self.set_header("Cache-Control", "no-cache")
+        self.finish(tornado.escape.json_encode(stats))
+
+
+class _PartialBuffer(BytesIO):
+    """A buffer of the start of an image, noting whether a read wanted
+    more of the image than it holds.
+    """
+
+    def __init__(self, data):
+        BytesIO.__init__(self, data)
+        self.truncated = False
+
+    def read(self, size=-1):
+        data = BytesIO.read(self, size)
+        if size is not None and 0 < size and len(data) < size:
+            self.truncated = True
+        return data
+
+
+def _get_fetch_error_key(url, kwargs):
+    """Returns the negative cache key of a fetch, which is its url and
+    range, as a failed range says nothing of the whole image.
+    """
+    headers = kwargs.get("headers") or dict()
+    return (url, headers.get("Range"))
+
+
+def _get_validators(resp):
+    """Returns the Etag and Last-Modified validators of a response"""
+    return (resp.headers.get("Etag"), resp.headers.get("Last-Modified"))
+
+
+def _is_shared_cacheable(resp):
+    """Returns whether the origin allows its response, and what is rendered
+    from it, to be kept and served to other clients.
+    """
+    cache_control = resp.headers.get("Cache-Control", "").lower()
+    return "no-store" not in cache_control \
+        and "private" not in cache_control
+
+
+def _is_connection_error(e):
+    """Returns whether the fetch failed to connect or lost its connection,
+    which is safe to retry, as opposed to a timeout or an error response.
+    """
+    if isinstance(e, HTTPStreamClosedError):
+        return True
+    elif isinstance(e, tornado.httpclient.HTTPError):
+        # Couldn't connect, got nothing, send and receive errors
+        return e.code == 599 and getattr(e, "errno", None) in (7, 52, 55, 56)
+    return not isinstance(e, socket.gaierror)
+
+
 def parse_command_line():  # pragma: no cover
     tornado.options.parse_command_line()
 
@@ -348,12 +1331,44 @@ def parse_command_line():  # pragma: no cover
 def start_server(app=None):  # pragma: no cover
     if options.debug:
         logger.setLevel(logging.DEBUG)
-    server = tornado.httpserver.HTTPServer(
-        app if app else PilboxApplication())
+    if options.uvloop:
+        if uvloop is None:
+            raise Exception("uvloop is required for the uvloop option")
+        # Set before any loop is created, so that each worker runs on one
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    app = app if app else PilboxApplication()
+    server = tornado.httpserver.HTTPServer(app)
     logger.info("Starting server...")
+    # Load the classifier once so forked workers share it
+    Image.load_face_classifier()
+    # Size by the CPUs actually available, e.g. under a container quota
+    workers = 1 if options.debug else (options.workers or get_cpu_count())
     try:
-        server.bind(options.port)
-        server.start(1 if options.debug else options.workers)
+        if not options.reuse_port:
+            sockets = tornado.netutil.bind_sockets(options.port)
+        if not options.debug and (options.worker_max_requests
+                                  or options.worker_max_rss):
+            supervisor = Supervisor(
+                workers,
+                max_requests=options.worker_max_requests,
+                max_rss=options.worker_max_rss * 1024 * 1024,
+                drain_timeout=options.worker_drain_timeout)
+            app.worker = supervisor.start()
+            task_id = app.worker.id
+        elif workers > 1:
+            task_id = tornado.process.fork_processes(workers)
+        else:
+            task_id = 0
+        if options.reuse_port:
+            # Each worker listens on its own socket, so the kernel
+            # balances connections between them
+            sockets = tornado.netutil.bind_sockets(
+                options.port, reuse_port=True)
+        if options.cpu_affinity:
+            set_cpu_affinity(task_id)
+        server.add_sockets(sockets)
+        if app.worker is not None:
+            app.worker.start(server)
         tornado.ioloop.IOLoop.instance().start()
     except KeyboardInterrupt:
         tornado.ioloop.IOLoop.instance().stop()
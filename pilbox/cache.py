@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import collections
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+class LRUCache(object):
+    """A bounded in-process mapping that evicts the least recently used
+    entry once it holds more than maxsize entries. Entries expire after
+    ttl seconds, if supplied.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        try:
+            value, expires = self._entries.pop(key)
+        except KeyError:
+            return default
+        if expires is not None and expires <= time.time():
+            return default
+        self._entries[key] = (value, expires)
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.time() + ttl if ttl else None
+        self._entries.pop(key, None)
+        self._entries[key] = (value, expires)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+FRESH, STALE = "fresh", "stale"
+
+
+class RenderCache(object):
+    """A bounded in-process mapping of rendered images, evicting the least
+    recently used entries once their total size exceeds maxsize bytes.
+
+    Entries are fresh for ttl seconds, then stale for a further stale
+    seconds, during which they may be served while a single refresh
+    revalidates them. Counts of lookups and refreshes are kept for the
+    stats of the worker.
+    """
+
+    STATS = ["hits", "stale_hits", "misses", "refreshes",
+             "refreshes_changed", "refreshes_unchanged", "refresh_errors"]
+
+    def __init__(self, maxsize, ttl, stale=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale = stale
+        self.size = 0
+        self.stats = dict((k, 0) for k in RenderCache.STATS)
+        self._entries = collections.OrderedDict()
+        self._refreshing = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, now=None):
+        """Returns the value and its state, FRESH or STALE, and the
+        seconds it remains fresh for, or None if it is not cached.
+        """
+        now = time.time() if now is None else now
+        try:
+            value, size, fresh_until = self._entries.pop(key)
+        except KeyError:
+            self.stats["misses"] += 1
+            return None
+        if fresh_until + self.stale <= now:
+            self.size -= size
+            self.stats["misses"] += 1
+            return None
+        self._entries[key] = (value, size, fresh_until)
+        return self._get_state(value, fresh_until, now)
+
+    def _get_state(self, value, fresh_until, now):
+        if fresh_until > now:
+            self.stats["hits"] += 1
+            return (value, FRESH, fresh_until - now)
+        self.stats["stale_hits"] += 1
+        return (value, STALE, 0)
+
+    def set(self, key, value, size, now=None):
+        now = time.time() if now is None else now
+        self.delete(key)
+        if size > self.maxsize:
+            return
+        self._entries[key] = (value, size, now + self.ttl)
+        self.size += size
+        while self.size > self.maxsize:
+            _, (_, evicted, _) = self._entries.popitem(last=False)
+            self.size -= evicted
+
+    def renew(self, key, now=None):
+        """Makes the entry fresh again, once found to be current"""
+        now = time.time() if now is None else now
+        if key in self._entries:
+            value, size, _ = self._entries[key]
+            self._entries[key] = (value, size, now + self.ttl)
+
+    def delete(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def begin_refresh(self, key):
+        """Returns whether the caller should refresh the entry, which it
+        should unless another refresh of it is in flight.
+        """
+        if key in self._refreshing:
+            return False
+        self._refreshing.add(key)
+        self.stats["refreshes"] += 1
+        return True
+
+    def end_refresh(self, key, outcome):
+        """Records the outcome of a refresh: changed, unchanged or error"""
+        self._refreshing.discard(key)
+        if outcome == "error":
+            self.stats["refresh_errors"] += 1
+        else:
+            self.stats["refreshes_%s" % outcome] += 1
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats.update(entries=len(self._entries), size=self.size,
+                     refreshing=len(self._refreshing))
+        return stats
+
+
+class SharedRenderCache(RenderCache):
+    """A render cache kept in a SharedCache, so that the renders of each
+    worker forked after it was created are served by all of them. Lookups
+    and refreshes are still counted per worker, but a refresh is made
+    single across the workers by a marker in the shared cache, which
+    expires after REFRESH_TTL seconds should its worker die.
+    """
+
+    PREFIX = "render:"
+    REFRESH_PREFIX = "refresh:"
+    REFRESH_TTL = 60
+
+    def __init__(self, shared, ttl, stale=0):
+        super(SharedRenderCache, self).__init__(shared.size, ttl, stale)
+        self.shared = shared
+
+    def __len__(self):
+        return self.shared.get_stats()["items"]
+
+    def get(self, key, now=None):
+        now = time.time() if now is None else now
+        data = self.shared.get(SharedRenderCache.PREFIX + key, now)
+        if data is None:
+            self.stats["misses"] += 1
+            return None
+        value, fresh_until = pickle.loads(data)
+        return self._get_state(value, fresh_until, now)
+
+    def set(self, key, value, size, now=None):
+        self._set(key, value, (time.time() if now is None else now))
+
+    def renew(self, key, now=None):
+        now = time.time() if now is None else now
+        data = self.shared.get(SharedRenderCache.PREFIX + key, now)
+        if data is not None:
+            self._set(key, pickle.loads(data)[0], now)
+
+    def delete(self, key):
+        self.shared.delete(SharedRenderCache.PREFIX + key)
+
+    def begin_refresh(self, key):
+        if not self.shared.add(SharedRenderCache.REFRESH_PREFIX + key, b"",
+                               SharedRenderCache.REFRESH_TTL):
+            return False
+        return super(SharedRenderCache, self).begin_refresh(key)
+
+    def end_refresh(self, key, outcome):
+        self.shared.delete(SharedRenderCache.REFRESH_PREFIX + key)
+        super(SharedRenderCache, self).end_refresh(key, outcome)
+
+    def get_stats(self):
+        stats = super(SharedRenderCache, self).get_stats()
+        shared = self.shared.get_stats()
+        stats.update(entries=shared["items"], size=shared["used"])
+        return stats
+
+    def _set(self, key, value, now):
+        data = pickle.dumps((value, now + self.ttl), pickle.HIGHEST_PROTOCOL)
+        self.shared.set(SharedRenderCache.PREFIX + key, data,
+                        self.ttl + self.stale, now)
@@ -120,6 +120,12 @@ class RetainError(BadRequestError):
         return 14
 
 
+class ProfileError(BadRequestError):
+    @staticmethod
+    def get_code():
+        return 16
+
+
 class FetchError(PilboxError):
     def __init__(self, msg=None, *args, **kwargs):
         super(FetchError, self).__init__(404, msg, *args, **kwargs)
@@ -140,6 +146,12 @@ class SignatureError(ForbiddenError):
         return 101
 
 
+class SignatureExpiredError(SignatureError):
+    @staticmethod
+    def get_code():
+        return 104
+
+
 class ClientError(ForbiddenError):
     @staticmethod
     def get_code():
@@ -167,3 +179,9 @@ class ImageSaveError(UnsupportedError):
     @staticmethod
     def get_code():
         return 202
+
+
+class ImageFramesError(UnsupportedError):
+    @staticmethod
+    def get_code():
+        return 203
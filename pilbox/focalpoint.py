@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger("tornado.application")
+
+
+class FocalPointStore(object):
+    """A persistent store of focal points keyed by source fingerprint. The
+    store is an SQLite database file that all workers on a host may share
+    and is bounded to maxsize entries, evicting those least recently used.
+    Lookups only read the database, the times entries are used being kept
+    in memory until the next prune, so that workers only contend for its
+    lock when storing points.
+    """
+
+    _PRUNE_INTERVAL = 100
+
+    def __init__(self, path, maxsize=100000):
+        self.path = path
+        self.maxsize = maxsize
+        self._conn = None
+        self._pid = None
+        self._writes = 0
+        self._accessed = dict()
+
+    def get(self, key, default=None):
+        try:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT x, y FROM points WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return default
+            self._accessed[key] = time.time()
+            if len(self._accessed) >= FocalPointStore._PRUNE_INTERVAL:
+                self._update_accessed(conn)
+            return (row[0], row[1])
+        except sqlite3.Error as e:
+            logger.warn("Unable to read focal point %s: %s", key, str(e))
+            return default
+
+    def set(self, key, value):
+        self.load([(key, value[0], value[1])])
+
+    def load(self, rows):
+        """Stores (key, x, y) rows, e.g. points computed offline. Keys are
+        the hex SHA-1 digest of the source image bytes.
+        """
+        now = time.time()
+        rows = [(str(k), float(x), float(y), now) for (k, x, y) in rows]
+        try:
+            conn = self._connect()
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO points (key, x, y, accessed) "
+                    "VALUES (?, ?, ?, ?)", rows)
+            self._writes += len(rows)
+            if self._writes >= FocalPointStore._PRUNE_INTERVAL:
+                self._writes = 0
+                self._prune(conn)
+        except sqlite3.Error as e:
+            logger.warn("Unable to write focal points: %s", str(e))
+
+    def _update_accessed(self, conn):
+        accessed, self._accessed = (self._accessed, dict())
+        with conn:
+            conn.executemany("UPDATE points SET accessed = ? WHERE key = ?",
+                             [(t, k) for (k, t) in accessed.items()])
+
+    def _prune(self, conn):
+        self._update_accessed(conn)
+        count = conn.execute("SELECT COUNT(*) FROM points").fetchone()[0]
+        if count > self.maxsize:
+            with conn:
+                conn.execute(
+                    "DELETE FROM points WHERE key IN (SELECT key FROM "
+                    "points ORDER BY accessed LIMIT ?)",
+                    (count - self.maxsize,))
+
+    def _connect(self):
+        # Connections are not shared across forked workers
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=5.0)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS points (key TEXT PRIMARY KEY, "
+                "x REAL NOT NULL, y REAL NOT NULL, accessed REAL NOT NULL)")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS points_accessed "
+                "ON points (accessed)")
+            self._pid = os.getpid()
+        return self._conn
+
+
+def main():
+    import csv
+    import sys
+    import tornado.options
+    from tornado.options import define, options, parse_command_line
+    define("store", help="the focal point store path", type=str)
+    define("size", help="the maximum number of focal points", type=int,
+           default=100000)
+    args = parse_command_line()
+    if not options.store or not args:
+        tornado.options.print_help()
+        sys.exit()
+
+    store = FocalPointStore(options.store, options.size)
+    for path in args:
+        with open(path) as f:
+            rows = [row for row in csv.reader(f) if len(row) == 3]
+        store.load(rows)
+        print("Loaded %d focal points from %s" % (len(rows), path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import collections
+import math
+import time
+
+from pilbox.cache import LRUCache
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half-open"
+
+
+class HostHealth(object):
+    """Tracks the latency and failures of fetches from a single host.
+
+    After failures consecutive failed fetches the circuit opens, and
+    fetches are refused until reset seconds have passed. A single probe
+    fetch is then allowed, closing the circuit if it succeeds, or opening
+    it again if it fails.
+    """
+
+    # Samples required before the timeout is derived from the latency
+    MIN_SAMPLES = 20
+    # Multiple of the p99 latency used as the adaptive timeout
+    TIMEOUT_MULTIPLIER = 2.0
+    # Weight of the latest fetch in the moving average latency
+    EWMA_WEIGHT = 0.3
+
+    def __init__(self, failures=5, reset=30.0, window=100):
+        self.failures = failures
+        self.reset = reset
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.ewma = None
+        self._latencies = _Window(window)
+        self._first_bytes = _Window(window)
+        self._opened = None
+        self._probing = False
+
+    def allow(self, now=None):
+        """Returns whether a fetch from the host may be attempted"""
+        if self.state == CLOSED:
+            return True
+        now = time.time() if now is None else now
+        if self.state == OPEN and now - self._opened >= self.reset:
+            self.state = HALF_OPEN
+            self._probing = False
+        if self.state == HALF_OPEN and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def record(self, latency, failed=False, now=None):
+        """Records the outcome of a fetch, which took latency seconds"""
+        self._latencies.append(latency)
+        if self.ewma is None:
+            self.ewma = latency
+        else:
+            self.ewma += HostHealth.EWMA_WEIGHT * (latency - self.ewma)
+        if not failed:
+            self.state = CLOSED
+            self.consecutive_failures = 0
+            self._probing = False
+            return
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or (
+                self.failures and
+                self.consecutive_failures >= self.failures):
+            self.state = OPEN
+            self._opened = time.time() if now is None else now
+            self._probing = False
+
+    def record_first_byte(self, seconds):
+        """Records the time taken to receive the first byte of a fetch"""
+        self._first_bytes.append(seconds)
+
+    def get_percentile(self, percentile):
+        """Returns the latency percentile, 0-100, of the recent fetches"""
+        return self._latencies.get_percentile(percentile)
+
+    def get_hedge_delay(self):
+        """Returns the p95 time to the first byte of the recent fetches, or
+        None if too few fetches have been recorded.
+        """
+        if len(self._first_bytes) < HostHealth.MIN_SAMPLES:
+            return None
+        return self._first_bytes.get_percentile(95)
+
+    def get_timeout(self, timeout, minimum=None):
+        """Returns the timeout for the next fetch, a multiple of the p99
+        latency between minimum and timeout, or timeout if too few fetches
+        have been recorded.
+        """
+        if len(self._latencies) < HostHealth.MIN_SAMPLES:
+            return timeout
+        adaptive = self.get_percentile(99) * HostHealth.TIMEOUT_MULTIPLIER
+        return min(timeout, max(adaptive, minimum or 0))
+
+
+class RetryBudget(object):
+    """Limits retries and hedged requests across all hosts to a ratio of
+    the requests made, plus minimum per second, so that they cannot
+    multiply the load on failing hosts. At most capacity retries can be
+    saved up, and the budget starts with minimum retries.
+    """
+
+    def __init__(self, ratio=0.1, minimum=1.0, capacity=10.0):
+        self.ratio = ratio
+        self.minimum = minimum
+        self.capacity = capacity
+        self._balance = min(minimum, capacity)
+        self._updated = time.time()
+
+    def deposit(self, now=None):
+        """Records a request, earning a ratio of a retry"""
+        self._refill(now)
+        self._balance = min(self._balance + self.ratio, self.capacity)
+
+    def withdraw(self, now=None):
+        """Returns whether a retry may be made, spending it if so"""
+        self._refill(now)
+        if self._balance < 1:
+            return False
+        self._balance -= 1
+        return True
+
+    def _refill(self, now):
+        now = time.time() if now is None else now
+        elapsed = max(now - self._updated, 0)
+        self._balance = min(self._balance + elapsed * self.minimum,
+                            self.capacity)
+        self._updated = now
+
+
+class HealthMonitor(object):
+    """The health of each host fetched from, bounded to maxsize hosts"""
+
+    def __init__(self, failures=5, reset=30.0, maxsize=1000):
+        self.failures = failures
+        self.reset = reset
+        self._hosts = LRUCache(maxsize)
+
+    def get(self, host):
+        health = self._hosts.get(host)
+        if health is None:
+            health = HostHealth(self.failures, self.reset)
+            self._hosts.set(host, health)
+        return health
+
+
+class _Window(object):
+    """The most recent samples, which are sorted once per change when
+    percentiles are requested.
+    """
+
+    def __init__(self, size):
+        self._samples = collections.deque(maxlen=size)
+        self._sorted = None
+
+    def __len__(self):
+        return len(self._samples)
+
+    def append(self, sample):
+        self._samples.append(sample)
+        self._sorted = None
+
+    def get_percentile(self, percentile):
+        if not self._samples:
+            return None
+        if self._sorted is None:
+            self._sorted = sorted(self._samples)
+        index = int(math.ceil(percentile / 100.0 * len(self._sorted))) - 1
+        return self._sorted[max(index, 0)]
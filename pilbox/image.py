@@ -17,14 +17,22 @@
 from __future__ import absolute_import, division, print_function, \
     with_statement
 
+import copy
+import hashlib
 import logging
+import math
+import mmap
 import re
 import os.path
+import time
 
 import PIL.Image
+import PIL.ImageChops
 import PIL.ImageOps
 
 from pilbox import errors
+from pilbox.cache import LRUCache
+from pilbox.pool import BufferPool
 
 try:
     from io import BytesIO
@@ -32,9 +40,10 @@ except ImportError:
     from cStringIO import StringIO as BytesIO
 
 try:
-    import cv
+    import cv2
+    import numpy
 except ImportError:
-    cv = None
+    cv2 = None
 
 logger = logging.getLogger("tornado.application")
 
@@ -58,6 +67,39 @@ _filters_to_pil = {
     "nearest": PIL.Image.NEAREST
 }
 
+# Resizes first reduce by an integer factor where Pillow supports it, as
+# thumbnail does, which is faster and close to resampling fairly
+_reduce_kwargs = dict(reducing_gap=2.0) \
+    if hasattr(PIL.Image.Image, "reduce") else dict()
+
+# Qualities chosen by auto quality, keyed by source fingerprint and spec
+_auto_qualities = LRUCache(4096)
+
+# Face focal points, keyed by source fingerprint and spec, replaceable
+# with a persistent store using set_focal_point_store
+_focal_points = LRUCache(4096)
+
+# Output buffers reused between saves, replaceable using set_buffer_pool
+_buffers = BufferPool()
+
+# Encoder settings of the named profiles by format, trading encode time
+# for size, replaceable using set_encoder_profiles
+_DEFAULT_PROFILES = {
+    "fast": {
+        "PNG": dict(compress_level=1),
+        "WEBP": dict(method=0)},
+    "balanced": {
+        "JPEG": dict(optimize=True),
+        "PNG": dict(compress_level=6),
+        "WEBP": dict(method=4)},
+    "smallest": {
+        "GIF": dict(optimize=True),
+        "JPEG": dict(optimize=True, progressive=True),
+        "PNG": dict(compress_level=9, optimize=True),
+        "WEBP": dict(method=6)},
+}
+_profiles = _DEFAULT_PROFILES
+
 _formats_to_pil = {
     "gif": "GIF",
     "jpg": "JPEG",
@@ -73,17 +115,27 @@ class Image(object):
     FORMATS = _formats_to_pil.keys()
     MODES = ["adapt", "clip", "crop", "fill", "scale"]
     POSITIONS = _positions_to_ratios.keys()
+    AUTO_FORMAT = "auto"
 
     _DEFAULTS = dict(background="0fff", expand=False, filter="antialias",
                      format=None, mode="crop", optimize=False,
                      position="center", quality=90, progressive=False,
-                     retain=75, preserve_exif=False)
+                     retain=75, preserve_exif=False, target_size=None,
+                     target_ssim=0.98, max_encodes=6, encode_budget=0.5,
+                     max_frames=1000, max_total_pixels=100000000,
+                     profile=None)
+    _AUTO_QUALITY_RANGE = (30, 95)
+    _SSIM_SIZE = 128
     _CLASSIFIER_PATH = os.path.join(
         os.path.dirname(__file__), "frontalface.xml")
+    _FACE_DETECT_SIZE = 400
 
     def __init__(self, stream):
         self.stream = stream
         self._skip_background = False
+        self._fingerprint = None
+        self._spec = []
+        self._modified = False
         try:
             self.img = PIL.Image.open(self.stream)
         except IOError:
@@ -96,6 +148,8 @@ class Image(object):
             raise errors.ImageFormatError(
                 "Unknown format: %s" % self.img.format)
         self._orig_format = self.img.format
+        self._animated = getattr(self.img, "is_animated", False)
+        self._info = dict(self.img.info)
 
     @staticmethod
     def validate_dimensions(width, height):
@@ -137,7 +191,8 @@ class Image(object):
             raise errors.ModeError("Invalid mode: %s" % opts["mode"])
         elif opts["filter"] not in Image.FILTERS:
             raise errors.FilterError("Invalid filter: %s" % opts["filter"])
-        elif opts["format"] and opts["format"] not in Image.FORMATS:
+        elif opts["format"] and opts["format"] not in Image.FORMATS \
+                and opts["format"] != Image.AUTO_FORMAT:
             raise errors.FormatError("Invalid format: %s" % opts["format"])
         elif opts["position"] not in Image.POSITIONS \
                 and not opts["pil"]["position"]:
@@ -150,12 +205,21 @@ class Image(object):
         elif opts["optimize"] and not Image._isint(opts["optimize"]):
             raise errors.OptimizeError(
                 "Invalid optimize: %s", str(opts["optimize"]))
-        elif opts["quality"] != "keep" and \
+        elif opts["quality"] not in ["keep", "auto"] and \
             (not Image._isint(opts["quality"]) or
              int(opts["quality"]) > 100 or
              int(opts["quality"]) < 0):
             raise errors.QualityError(
                 "Invalid quality: %s", str(opts["quality"]))
+        elif opts["target_size"] and \
+            (not Image._isint(opts["target_size"]) or
+             int(opts["target_size"]) <= 0):
+            raise errors.QualityError(
+                "Invalid target size: %s" % str(opts["target_size"]))
+        elif not Image._isfloat(opts["target_ssim"]) or \
+                not 0.0 < float(opts["target_ssim"]) <= 1.0:
+            raise errors.QualityError(
+                "Invalid target ssim: %s" % str(opts["target_ssim"]))
         elif opts["preserve_exif"] and not Image._isint(opts["preserve_exif"]):
             raise errors.PreserveExifError(
                 "Invalid preserve_exif: %s" % str(opts["preserve_exif"]))
@@ -167,6 +231,56 @@ class Image(object):
               int(opts["retain"]) < 0):
             raise errors.RetainError(
                 "Invalid retain: %s" % str(opts["retain"]))
+        elif opts["profile"] and opts["profile"] not in _profiles:
+            raise errors.ProfileError(
+                "Invalid profile: %s" % str(opts["profile"]))
+
+    @staticmethod
+    def load_face_classifier():
+        """Loads the face classifier if OpenCV is available. Servers
+        should call this before forking so that workers share it.
+        """
+        if cv2 is not None and not hasattr(Image, "_classifier"):
+            classifier_path = os.path.abspath(Image._CLASSIFIER_PATH)
+            Image._classifier = cv2.CascadeClassifier(classifier_path)
+
+    @property
+    def fingerprint(self):
+        """A digest of the source image bytes"""
+        if self._fingerprint is None:
+            self._fingerprint = hashlib.sha1(
+                self._get_source_bytes()).hexdigest()
+        return self._fingerprint
+
+    def get_auto_format(self, accepted=None):
+        """Returns the output format best suited to the image, choosing
+        from the supplied list of formats accepted by the client. WebP is
+        preferred when accepted, otherwise PNG is used for images with
+        transparency and JPEG for everything else.
+        """
+        if accepted and "webp" in accepted:
+            return "webp"
+        elif self.has_alpha():
+            return "png"
+        return "jpeg"
+
+    def get_info(self):
+        """Returns a dict describing the image, read from its header
+        without decoding the image.
+        """
+        return dict(format=self._orig_format.lower(),
+                    width=self.img.size[0],
+                    height=self.img.size[1],
+                    mode=self.img.mode,
+                    alpha=self.has_alpha(),
+                    animated=bool(self._animated),
+                    orientation=self._get_orientation())
+
+    def has_alpha(self):
+        """Returns whether the image has an alpha channel or transparency"""
+        if self.img.mode in ["RGBA", "LA", "PA"]:
+            return True
+        return self.img.mode == "P" and "transparency" in self.img.info
 
     def region(self, rect):
         """ Selects a sub-region of the image using the supplied rectangle,
@@ -176,7 +290,11 @@ class Image(object):
                int(rect[1]) + int(rect[3]))
         if box[2] > self.img.size[0] or box[3] > self.img.size[1]:
             raise errors.RectangleError("Region out-of-bounds")
+        elif box == (0, 0) + self.img.size:
+            return self  # The region is the entire image
         self.img = self.img.crop(box)
+        self._modified = True
+        self._spec.append(("region", (tuple(rect),), ()))
         return self
 
     def resize(self, width, height, **kwargs):
@@ -193,7 +311,9 @@ class Image(object):
         """
         opts = Image._normalize_options(kwargs)
         size = self._get_size(width, height)
-        if opts["mode"] == "adapt":
+        if self._is_identity_resize(size, opts):
+            return self
+        elif opts["mode"] == "adapt":
             self._adapt(size, opts)
         elif opts["mode"] == "clip":
             self._clip(size, opts)
@@ -203,6 +323,9 @@ class Image(object):
             self._scale(size, opts)
         else:
             self._crop(size, opts)
+        self._modified = True
+        self._spec.append(
+            ("resize", (width, height), Image._spec_options(kwargs)))
         return self
 
     def rotate(self, deg, **kwargs):
@@ -215,15 +338,15 @@ class Image(object):
 
         if deg == "auto":
             if self._orig_format == "JPEG":
-                try:
-                    exif = self.img._getexif() or dict()
-                    deg = _orientation_to_rotation.get(exif.get(274, 0), 0)
-                except Exception:
-                    logger.warn('unable to parse exif')
-                    deg = 0
+                deg = _orientation_to_rotation.get(
+                    self._get_orientation(), 0)
             else:
                 deg = 0
 
+        if int(deg) % 360 == 0:
+            return self
+        self._modified = True
+        self._spec.append(("rotate", (deg,), Image._spec_options(kwargs)))
         deg = 360 - (int(deg) % 360)
         if deg % 90 == 0:
             if deg == 90:
@@ -241,19 +364,49 @@ class Image(object):
         """Returns a buffer to the image for saving, supports the
         following optional keyword arguments:
 
-        format - The format to save as: see Image.FORMATS
+        format - The format to save as: see Image.FORMATS or auto to
+                 select the format using Image.get_auto_format
         optimize - The image file size should be optimized
+        profile - The named encoder profile, whose settings for the format
+                  apply unless overridden by the other arguments
         preserve_exif - Preserve the Exif information in JPEGs
         progressive - The output should be progressive JPEG
-        quality - The quality used to save JPEGs: integer from 1 - 100
+        quality - The quality used to save JPEGs: integer from 1 - 100,
+                  keep or auto to search for the lowest quality that meets
+                  the target size or target ssim
+        target_size - The maximum size in bytes for auto quality
+        target_ssim - The minimum similarity to the unencoded image for
+                      auto quality, used when no target size is set
+        max_encodes - The maximum number of encodes for auto quality
+        encode_budget - The time budget in seconds for auto quality
+        max_frames - The maximum number of frames in an animated image
+        max_total_pixels - The maximum number of pixels summed over all
+                           frames of an animated image
+
+        Animated GIF and WebP sources remain animated when saved as GIF or
+        WebP, otherwise only the first frame is saved. When no operation
+        changed the image and the output would be an equivalent encoding of
+        the source, the source bytes are returned without being decoded.
         """
         opts = Image._normalize_options(kwargs)
-        outfile = BytesIO()
-        if opts["pil"]["format"]:
+        outfile = _new_buffer()
+        if opts["format"] == Image.AUTO_FORMAT:
+            fmt = _formats_to_pil.get(self.get_auto_format())
+        elif opts["pil"]["format"]:
             fmt = opts["pil"]["format"]
         else:
             fmt = self._orig_format
-        save_kwargs = dict()
+
+        if self._is_identity_save(fmt, opts):
+            data = self._get_source_bytes()
+            if fmt == "JPEG" and not int(opts["preserve_exif"]):
+                data = _strip_jpeg_exif(data)
+            if data is not None:
+                outfile.write(data)
+                outfile.seek(0)
+                return outfile
+
+        save_kwargs = get_encoder_profile(opts["profile"], fmt)
 
         if Image._isint(opts["quality"]):
             save_kwargs["quality"] = int(opts["quality"])
@@ -268,7 +421,74 @@ class Image(object):
             save_kwargs["exif"] = self._exif
 
         color = color_hex_to_dec_tuple(opts["background"])
+        self._prepare(fmt, color)
+
+        img = self.img
+        animated = self._animated and fmt in ["GIF", "WEBP"]
+        if animated:
+            durations = []
+            frames = self._get_frames(fmt, color, durations, opts)
+            img = next(frames)
+            save_kwargs.update(save_all=True, append_images=frames,
+                               duration=durations)
+            if "loop" in self._info:
+                save_kwargs["loop"] = self._info["loop"]
+
+        if self._orig_format == "JPEG":
+            self.img.format = self._orig_format
+            save_kwargs["subsampling"] = "keep"
+            if opts["quality"] == "keep":
+                save_kwargs["quality"] = "keep"
+
+        try:
+            if opts["quality"] == "auto" and fmt in ["JPEG", "WEBP"] \
+                    and not animated:
+                self._save_auto_quality(outfile, fmt, save_kwargs, opts)
+            else:
+                img.save(outfile, fmt, **save_kwargs)
+        except IOError as e:
+            raise errors.ImageSaveError(str(e))
+        self.img.format = fmt
+        outfile.seek(0)
+
+        return outfile
 
+    def _get_orientation(self):
+        if not hasattr(self.img, "_getexif"):
+            return 1
+        try:
+            exif = self.img._getexif() or dict()
+            return exif.get(274, 1)
+        except Exception:
+            logger.warn('unable to parse exif')
+            return 1
+
+    def _is_identity_resize(self, size, opts):
+        if size == self.img.size:
+            return True
+        # Clipping never enlarges an image
+        return opts["mode"] == "clip" and size[0] >= self.img.size[0] \
+            and size[1] >= self.img.size[1]
+
+    def _is_identity_save(self, fmt, opts):
+        if self._modified or fmt != self._orig_format:
+            return False
+        elif int(opts["optimize"]) or int(opts["progressive"]):
+            return False
+        elif get_encoder_profile(opts["profile"], fmt):
+            return False
+        elif fmt in ["JPEG", "WEBP"] and opts["quality"] != "keep":
+            return False
+        elif self._exif and fmt != "JPEG" and not int(opts["preserve_exif"]):
+            return False
+        elif self.img.mode == "RGBA":
+            # Compositing onto a transparent background has no effect
+            color = color_hex_to_dec_tuple(opts["background"])
+            return Image._supports_alpha(fmt) and len(color) == 4 \
+                and color[3] == 0
+        return True
+
+    def _prepare(self, fmt, color):
         if self.img.mode == "RGBA":
             self._background(fmt, color)
 
@@ -283,20 +503,129 @@ class Image(object):
                 # saved as RGBA. It must be converted to RGB.
                 self.img = self.img.convert("RGB")
 
-        if self._orig_format == "JPEG":
-            self.img.format = self._orig_format
-            save_kwargs["subsampling"] = "keep"
-            if opts["quality"] == "keep":
-                save_kwargs["quality"] = "keep"
+    def _get_frames(self, fmt, color, durations, opts):
+        """Generates the frames of an animated image one at a time, the
+        first being the already processed image. Each later frame is read
+        from the source and has the recorded operations replayed on it.
+        Consecutive identical frames are merged, with their durations
+        appended to durations as each frame is yielded.
+        """
+        source = PIL.Image.open(BytesIO(self._get_source_bytes()))
+        frame_pixels = source.size[0] * source.size[1]
+        # Durations of some formats are only known once a frame is loaded
+        source.load()
+        pending = self.img
+        pending_duration = source.info.get("duration", 0)
+        index = 1
+        while True:
+            try:
+                source.seek(index)
+            except EOFError:
+                break
+            index += 1
+            if index > int(opts["max_frames"]) or \
+                    index * frame_pixels > int(opts["max_total_pixels"]):
+                raise errors.ImageFramesError("Too many frames")
+
+            frame = self._replay(source.convert("RGBA"), fmt, color)
+            duration = source.info.get("duration", 0)
+            if Image._is_same_frame(frame, pending):
+                pending_duration += duration
+                continue
+
+            durations.append(pending_duration)
+            yield pending
+            pending, pending_duration = (frame, duration)
+
+        durations.append(pending_duration)
+        yield pending
+
+    def _replay(self, frame, fmt, color):
+        image = copy.copy(self)
+        image.img = frame
+        image._spec = []
+        image._skip_background = False
+        for (name, args, options) in self._spec:
+            getattr(image, name)(*args, **dict(options))
+        image._prepare(fmt, color)
+        return image.img
+
+    def _save_auto_quality(self, outfile, fmt, save_kwargs, opts):
+        # The searched quality replaces that of the encoder profile
+        save_kwargs = dict((k, v) for (k, v) in save_kwargs.items()
+                           if k != "quality")
+        key = (self.fingerprint, tuple(self._spec), fmt,
+               opts["target_size"], opts["target_ssim"],
+               tuple(sorted((k, v) for k, v in save_kwargs.items()
+                            if k != "exif")))
+        quality = _auto_qualities.get(key)
+        if quality is not None:
+            self.img.save(outfile, fmt, quality=quality, **save_kwargs)
+            return
 
-        try:
-            self.img.save(outfile, fmt, **save_kwargs)
-        except IOError as e:
-            raise errors.ImageSaveError(str(e))
-        self.img.format = fmt
-        outfile.seek(0)
+        quality, data = self._search_quality(fmt, save_kwargs, opts)
+        _auto_qualities.set(key, quality)
+        outfile.write(data)
 
-        return outfile
+    def _search_quality(self, fmt, save_kwargs, opts):
+        """Binary searches for the quality that best meets the target,
+        returning the quality and the encoded bytes. With a target size,
+        this is the highest quality that fits, otherwise it is the lowest
+        quality whose similarity is at least the target ssim.
+        """
+        target_size = int(opts["target_size"] or 0)
+        target_ssim = float(opts["target_ssim"])
+        reference = None if target_size else self._get_luma(self.img)
+        deadline = time.time() + float(opts["encode_budget"])
+        low, high = Image._AUTO_QUALITY_RANGE
+        best, fallback = (None, None)
+        for _ in range(max(int(opts["max_encodes"]), 1)):
+            quality = (low + high) // 2
+            with _new_buffer() as outfile:
+                self.img.save(outfile, fmt, quality=quality, **save_kwargs)
+                data = outfile.getvalue()
+            if target_size:
+                ok = len(data) <= target_size
+            else:
+                img = PIL.Image.open(BytesIO(data))
+                ok = _ssim(reference, self._get_luma(img)) >= target_ssim
+            if ok:
+                best = (quality, data)
+            else:
+                fallback = (quality, data)
+
+            # Search higher qualities while the size fits the target and
+            # lower qualities while the similarity meets the target
+            if ok == bool(target_size):
+                low = quality + 1
+            else:
+                high = quality - 1
+            if low > high or time.time() >= deadline:
+                break
+
+        return best or fallback
+
+    def _get_luma(self, img):
+        size = (min(self.img.size[0], Image._SSIM_SIZE),
+                min(self.img.size[1], Image._SSIM_SIZE))
+        return img.convert("L").resize(size, PIL.Image.BILINEAR)
+
+    def _get_source_bytes(self):
+        """Returns the source image bytes, or the memory map of a source
+        file, which is read in place rather than copied.
+        """
+        if isinstance(self.stream, mmap.mmap):
+            return self.stream
+        elif hasattr(self.stream, "getvalue"):
+            return self.stream.getvalue()
+        elif hasattr(self.stream, "read"):
+            pos = self.stream.tell()
+            self.stream.seek(0)
+            data = self.stream.read()
+            self.stream.seek(pos)
+            return data
+        with open(self.stream, "rb") as f:
+            return f.read()
 
     def _adapt(self, size, opts):
         source_aspect_ratio = float(self.img.size[0]) / float(self.img.size[1])
@@ -317,21 +646,23 @@ class Image(object):
     def _background(self, fmt, color):
         if self._skip_background:
             return
-        img = PIL.Image.new(mode="RGBA", size=self.img.size, color=color)
         if self.img.mode == "RGBA" and Image._supports_alpha(fmt):
+            img = PIL.Image.new(mode="RGBA", size=self.img.size, color=color)
             self.img = PIL.Image.alpha_composite(img, self.img)
         else:
-            bands = self.img.split()
-            mask = bands[3] if len(bands) == 4 else None
-            img.paste(self.img, mask=mask)
+            # JPEGs are saved without alpha, so need no alpha background
+            if fmt == "JPEG":
+                img = PIL.Image.new("RGB", self.img.size, color[:3])
+            else:
+                img = PIL.Image.new("RGBA", self.img.size, color)
+            # Pasting an RGBA image onto itself uses its alpha band as the
+            # mask, without copying the bands as split() does
+            img.paste(self.img, mask=self._get_alpha_mask())
             self.img = img
 
     def _crop(self, size, opts):
         if opts["position"] == "face":
-            if cv is None:
-                raise NotImplementedError
-            else:
-                pos = self._get_face_position()
+            pos = self._get_face_position()
         else:
             pos = opts["pil"]["position"]
         self.img = PIL.ImageOps.fit(
@@ -348,12 +679,14 @@ class Image(object):
         img = PIL.Image.new(mode=mode, size=size, color=color)
         # If the image has an alpha channel, use it as a mask when
         # pasting onto the background.
-        channels = self.img.split()
-        mask = channels[3] if len(channels) == 4 else None
-        img.paste(self.img, (x, y), mask=mask)
+        img.paste(self.img, (x, y), mask=self._get_alpha_mask())
         self._skip_background = True
         self.img = img
 
+    def _get_alpha_mask(self):
+        # Pillow uses the alpha band of an RGBA image supplied as a mask
+        return self.img if self.img.mode == "RGBA" else None
+
     def _scale(self, size, opts):
         self.img = self.img.resize(size, opts["pil"]["filter"])
 
@@ -366,41 +699,56 @@ class Image(object):
         return (int(width), int(height))
 
     def _get_face_rectangles(self):
-        cvim = self._pil_to_opencv()
-        return cv.HaarDetectObjects(
+        # Detect on a bounded greyscale image, resized from the image rather
+        # than from a full size copy of it, positions are returned as ratios
+        # so the scale does not affect the result
+        mono = self.img
+        size = _get_bounded_size(mono.size, Image._FACE_DETECT_SIZE)
+        if size != mono.size:
+            mono = mono.resize(size, PIL.Image.BILINEAR, **_reduce_kwargs)
+        mono = mono.convert("L")
+        cvim = cv2.equalizeHist(numpy.asarray(mono))
+        rects = self._get_face_classifier().detectMultiScale(
             cvim,
-            self._get_face_classifier(),
-            cv.CreateMemStorage(0),
-            1.3,  # Scale factor
-            4,  # Minimum neighbors
-            0,  # HAAR Flags
-            (20, 20))
+            scaleFactor=1.3,
+            minNeighbors=4,
+            minSize=(20, 20))
+        return (rects, mono.size)
 
     def _get_face_position(self):
-        rects = self._get_face_rectangles()
-        if not rects:
+        key = self._get_focal_point_key()
+        pos = _focal_points.get(key)
+        if pos is None:
+            if cv2 is None:
+                raise NotImplementedError
+            pos = self._detect_face_position()
+            _focal_points.set(key, pos)
+        return pos
+
+    def _get_focal_point_key(self):
+        # The source fingerprint alone identifies points computed on the
+        # unmodified source, e.g. those preloaded by offline jobs
+        if not self._spec:
+            return self.fingerprint
+        spec = hashlib.sha1(repr(self._spec).encode()).hexdigest()
+        return "%s:%s" % (self.fingerprint, spec[:16])
+
+    def _detect_face_position(self):
+        rects, size = self._get_face_rectangles()
+        if not len(rects):
             return (0.5, 0.5)
         xt, yt = (0.0, 0.0)
-        for rect in rects:
-            xt += rect[0][0] + (rect[0][2] / 2.0)
-            yt += rect[0][1] + (rect[0][3] / 2.0)
+        for (x, y, w, h) in rects:
+            xt += x + (w / 2.0)
+            yt += y + (h / 2.0)
 
-        return (xt / (len(rects) * self.img.size[0]),
-                yt / (len(rects) * self.img.size[1]))
+        return (xt / (len(rects) * size[0]),
+                yt / (len(rects) * size[1]))
 
     def _get_face_classifier(self):
-        if not hasattr(Image, "_classifier"):
-            classifier_path = os.path.abspath(Image._CLASSIFIER_PATH)
-            Image._classifier = cv.Load(classifier_path)
+        Image.load_face_classifier()
         return Image._classifier
 
-    def _pil_to_opencv(self):
-        mono = self.img.convert("L")
-        cvim = cv.CreateImageHeader(mono.size, cv.IPL_DEPTH_8U, 1)
-        cv.SetData(cvim, mono.tobytes(), mono.size[0])
-        cv.EqualizeHist(cvim, cvim)
-        return cvim
-
     @staticmethod
     def _normalize_options(options):
         opts = Image._DEFAULTS.copy()
@@ -428,6 +776,29 @@ class Image(object):
             return None
         return pos
 
+    @staticmethod
+    def _is_same_frame(a, b):
+        if a.mode != b.mode or a.size != b.size:
+            return False
+        extrema = PIL.ImageChops.difference(a, b).getextrema()
+        if not isinstance(extrema[0], tuple):
+            extrema = [extrema]
+        return all(high == 0 for (low, high) in extrema)
+
+    @staticmethod
+    def _spec_options(options):
+        return tuple(sorted((k, v) for k, v in options.items()
+                            if v is not None))
+
+    @staticmethod
+    def _isfloat(v):
+        try:
+            if type(v) is not bool:
+                float(v)
+        except (TypeError, ValueError):
+            return False
+        return True
+
     @staticmethod
     def _isint(v, base=10):
         try:
@@ -444,6 +815,147 @@ class Image(object):
         return fmt in ["PNG", "WEBP"]
 
 
+def set_focal_point_store(store):
+    """Replaces the in-process focal point cache with the supplied store,
+    any object providing get(key) and set(key, (x, y)) methods, e.g.
+    pilbox.focalpoint.FocalPointStore.
+    """
+    global _focal_points
+    _focal_points = store
+
+
+def set_buffer_pool(pool):
+    """Replaces the pool of output buffers, e.g. to bound it differently,
+    or disables pooling when pool is None.
+    """
+    global _buffers
+    _buffers = pool
+
+
+def get_encoder_profile(name, fmt):
+    """Returns the Pillow save arguments of the named encoder profile for
+    the format, empty when there is no profile or it leaves the format's
+    encoder settings at their defaults.
+    """
+    return dict(_profiles.get(name or "", {}).get(fmt, {}))
+
+
+def set_encoder_profiles(profiles):
+    """Replaces the encoder profiles, a dict of the Pillow save arguments
+    by format by profile name, or restores the built-in fast, balanced and
+    smallest profiles when profiles is None.
+    """
+    global _profiles
+    _profiles = _DEFAULT_PROFILES if profiles is None else profiles
+
+
+def parse_encoder_profiles(entries):
+    """Returns the built-in encoder profiles with the settings of the
+    entries, each name:format:key=value[:key=value...], replacing those
+    of the profile for the format, e.g. smallest:png:compress_level=9.
+    """
+    profiles = dict((name, dict(formats))
+                    for (name, formats) in _DEFAULT_PROFILES.items())
+    for entry in entries or []:
+        parts = entry.split(":")
+        fmt = _formats_to_pil.get(parts[1].lower()) if len(parts) > 1 \
+            else None
+        if not parts[0] or fmt is None \
+                or not all("=" in part for part in parts[2:]):
+            raise Exception("Invalid encoder profile: %s" % entry)
+        settings = dict()
+        for part in parts[2:]:
+            (k, v) = part.split("=", 1)
+            settings[k] = int(v) if Image._isint(v) else v
+        profiles.setdefault(parts[0], dict())[fmt] = settings
+    return profiles
+
+
+def set_block_cache_size(blocks):
+    """Keeps up to the supplied number of freed image memory blocks for
+    reuse by later images, rather than returning them to the system.
+    """
+    PIL.Image.core.set_blocks_max(blocks)
+
+
+def _get_bounded_size(size, bound):
+    """Returns the size scaled down to fit a square of the bound, keeping
+    its aspect ratio, rounded as Pillow's thumbnail rounds it.
+    """
+    (width, height) = size
+    if width <= bound and height <= bound:
+        return size
+    aspect = width / height
+
+    def _round(n, key):
+        return max(min(math.floor(n), math.ceil(n), key=key), 1)
+    if aspect <= 1:
+        return (_round(bound * aspect, lambda n: abs(aspect - n / bound)),
+                bound)
+    return (bound, _round(bound / aspect,
+                          lambda n: abs(aspect - bound / n) if n else 0))
+
+
+def _new_buffer():
+    if _buffers is None:
+        return BytesIO()
+    return _buffers.acquire()
+
+
+def _strip_jpeg_exif(data):
+    """Returns the JPEG data without its Exif segments, or None if the
+    data could not be parsed.
+    """
+    if data[:2] != b"\xff\xd8":
+        return None
+    segments = [data[:2]]
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos:pos + 1] != b"\xff":
+            return None
+        marker = ord(data[pos + 1:pos + 2])
+        if marker == 0xff:
+            pos += 1  # Fill byte
+            continue
+        elif marker == 0xda or marker == 0xd9:
+            # Start of scan, the rest is compressed image data
+            segments.append(data[pos:])
+            return b"".join(segments)
+        length = (ord(data[pos + 2:pos + 3]) << 8) + ord(data[pos + 3:pos + 4])
+        segment = data[pos:pos + 2 + length]
+        if marker != 0xe1 or segment[4:10] != b"Exif\x00\x00":
+            segments.append(segment)
+        pos += 2 + length
+    return None
+
+
+def _ssim(a, b, window=8):
+    """Returns the mean structural similarity of two equally sized
+    greyscale images, computed over non-overlapping square windows.
+    """
+    c1, c2 = ((0.01 * 255) ** 2, (0.03 * 255) ** 2)
+    width, height = a.size
+    pa, pb = (list(a.getdata()), list(b.getdata()))
+    total, count = (0.0, 0)
+    for y0 in range(0, height, window):
+        for x0 in range(0, width, window):
+            xs, ys = ([], [])
+            for y in range(y0, min(y0 + window, height)):
+                row = y * width
+                end = row + min(x0 + window, width)
+                xs.extend(pa[row + x0:end])
+                ys.extend(pb[row + x0:end])
+            n = float(len(xs))
+            mx, my = (sum(xs) / n, sum(ys) / n)
+            vx = sum((x - mx) ** 2 for x in xs) / n
+            vy = sum((y - my) ** 2 for y in ys) / n
+            cov = sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / n
+            total += ((2 * mx * my + c1) * (2 * cov + c2)) / \
+                ((mx ** 2 + my ** 2 + c1) * (vx + vy + c2))
+            count += 1
+    return total / count if count else 1.0
+
+
 def color_hex_to_dec_tuple(color):
     """Converts a color from hexadecimal to decimal tuple, color can be in
     the following formats: 3-digit RGB, 4-digit ARGB, 6-digit RGB and
@@ -484,9 +996,15 @@ def main():
            metavar="|".join(Image.FORMATS), type=str)
     define("optimize", help="default to optimize when saving", type=int)
     define("progressive", help="default to progressive when saving", type=int)
-    define("quality", help="default jpeg quality, 1-99 or keep")
+    define("quality", help="default jpeg quality, 1-99, keep or auto")
+    define("target_size", help="target size in bytes for auto quality",
+           type=int)
+    define("target_ssim", help="target similarity for auto quality",
+           type=float)
     define("retain", help="default adaptive retain percent, 1-99", type=int)
     define("preserve_exif", help="default behavior for Exif data", type=int)
+    define("backend", help="image processing backend", metavar="pil|vips",
+           type=str, default="pil")
 
     args = parse_command_line()
     if not args:
@@ -508,12 +1026,17 @@ def main():
         tornado.options.print_help()
         sys.exit()
 
+    image_class = Image
+    if options.backend == "vips":
+        from pilbox.vips import VipsImage
+        image_class = VipsImage
+
     if args[0].startswith("http://") or args[0].startswith("https://"):
         client = tornado.httpclient.HTTPClient()
         resp = client.fetch(args[0])
-        image = Image(resp.buffer)
+        image = image_class(resp.buffer)
     else:
-        image = Image(open(args[0], "r"))
+        image = image_class(open(args[0], "r"))
 
     if options.operation == "resize":
         image.resize(options.width, options.height, mode=options.mode,
@@ -528,6 +1051,8 @@ def main():
                         optimize=options.optimize,
                         background=options.background,
                         quality=options.quality,
+                        target_size=options.target_size,
+                        target_ssim=options.target_ssim,
                         progressive=options.progressive,
                         preserve_exif=options.preserve_exif)
     try:
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import collections
+import random
+
+from pilbox.health import CLOSED
+
+try:
+    from urlparse import urlparse, urljoin
+except ImportError:
+    from urllib.parse import urlparse, urljoin
+
+
+class OriginGroup(object):
+    """Mirrors serving the same images, each a base url that relative urls
+    are resolved against. Mirrors are tried in order of their moving
+    average latency, those that have just failed after the others, and
+    those with an open circuit last. Occasionally another
+    mirror is tried first, so that the latency of every mirror stays
+    current.
+    """
+
+    # Proportion of fetches which try a random mirror first
+    EXPLORE = 0.05
+
+    def __init__(self, name, bases, health):
+        self.name = name
+        self.bases = list(bases)
+        self._health = health
+
+    def get_urls(self, path):
+        """Returns the url of the path on each mirror, in the order to try"""
+        bases = sorted(self.bases, key=self._rank)
+        if len(bases) > 1 and random.random() < OriginGroup.EXPLORE:
+            bases.insert(0, bases.pop(random.randrange(1, len(bases))))
+        return [urljoin(base, path) for base in bases]
+
+    def get_url(self, path):
+        """Returns the url of the path on the first configured mirror"""
+        return urljoin(self.bases[0], path)
+
+    def _rank(self, base):
+        health = self._health.get(urlparse(base).netloc)
+        # A failure may be quicker than any response, so ranks lower
+        return (health.state != CLOSED, health.consecutive_failures,
+                health.ewma or 0)
+
+
+def parse_origins(specs, health):
+    """Returns the origin groups by name, given specs of the form
+    name=base_url, one per mirror.
+    """
+    bases = collections.OrderedDict()
+    for spec in specs or []:
+        name, sep, base = spec.partition("=")
+        if not sep or not name or not urlparse(base).hostname:
+            raise Exception("Invalid origin: %s" % spec)
+        bases.setdefault(name, []).append(base)
+    return dict((name, OriginGroup(name, bases[name], health))
+                for name in bases)
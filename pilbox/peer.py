@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import bisect
+import hashlib
+import struct
+
+
+class HashRing(object):
+    """Maps keys onto peers by consistent hashing. Each peer is placed at
+    replicas points on a ring, and a key belongs to the peer at the first
+    point following its hash, so that adding or removing a peer only moves
+    the keys of the points it gains or loses.
+    """
+
+    def __init__(self, peers, replicas=100):
+        self.peers = list(peers)
+        points = sorted((_hash("%s#%d" % (peer, i)), peer)
+                        for peer in self.peers for i in range(replicas))
+        self._hashes = [h for (h, _) in points]
+        self._peers = [peer for (_, peer) in points]
+
+    def get(self, key):
+        """Returns the peer owning the key, or None if there are none"""
+        if not self._hashes:
+            return None
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._peers[i]
+
+
+def parse_peers(peers, this):
+    """Returns the HashRing of the peer urls, which must include this
+    node's own url, or None if there are no peers.
+    """
+    peers = [peer.rstrip("/") for peer in peers or []]
+    if not peers:
+        return None
+    elif not this or this.rstrip("/") not in peers:
+        raise Exception("peer_self must be one of the peers")
+    return HashRing(peers)
+
+
+def _hash(key):
+    # Stable across processes and nodes, unlike hash()
+    if not isinstance(key, bytes):
+        key = key.encode("utf-8")
+    return struct.unpack(">Q", hashlib.md5(key).digest()[:8])[0]
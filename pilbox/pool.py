@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import io
+
+
+class BufferPool(object):
+    """A pool of reusable bytearrays for writing images. Released arrays
+    keep their capacity, so once a worker has rendered a few images,
+    writing another does not need to grow its buffer. At most maxsize
+    arrays, each no larger than maxcapacity bytes, are kept.
+    """
+
+    def __init__(self, maxsize=16, maxcapacity=16 * 1024 * 1024,
+                 initial=256 * 1024):
+        self.maxsize = maxsize
+        self.maxcapacity = maxcapacity
+        self.initial = initial
+        self._free = []
+
+    def __len__(self):
+        return len(self._free)
+
+    def acquire(self):
+        """Returns an empty PooledBuffer, released when it is closed"""
+        if self._free:
+            return PooledBuffer(self._free.pop(), self)
+        return PooledBuffer(bytearray(self.initial), self)
+
+    def release(self, data):
+        if len(self._free) < self.maxsize and len(data) <= self.maxcapacity:
+            self._free.append(data)
+
+
+class PooledBuffer(io.BufferedIOBase):
+    """A file-like object writing to a pooled bytearray, returned to the
+    pool when closed or collected. Like BytesIO, it is readable and
+    seekable, but unlike BytesIO, its capacity is not reduced when reused.
+    """
+
+    def __init__(self, data, pool=None):
+        super(PooledBuffer, self).__init__()
+        self._data = data
+        self._pool = pool
+        self._size = 0
+        self._pos = 0
+
+    def write(self, b):
+        data = self._get_data()
+        end = self._pos + len(b)
+        if end > len(data):
+            # Grow geometrically, as the capacity is kept once released
+            data.extend(bytearray(max(end - len(data), len(data))))
+        if self._pos > self._size:
+            data[self._size:self._pos] = bytearray(self._pos - self._size)
+        data[self._pos:end] = b
+        self._pos = end
+        self._size = max(self._size, end)
+        return len(b)
+
+    def read(self, size=-1):
+        data = self._get_data()
+        end = self._size if size < 0 else min(self._pos + size, self._size)
+        b = _copy(data, self._pos, end) if end > self._pos else b""
+        self._pos = max(self._pos, end)
+        return b
+
+    def seek(self, pos, whence=0):
+        self._get_data()
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            pos += self._size
+        if pos < 0:
+            raise ValueError("Negative seek position %d" % pos)
+        self._pos = pos
+        return pos
+
+    def tell(self):
+        self._get_data()
+        return self._pos
+
+    def truncate(self, size=None):
+        self._get_data()
+        self._size = self._pos if size is None else min(size, self._size)
+        return self._size
+
+    def getvalue(self):
+        return _copy(self._get_data(), 0, self._size)
+
+    def read1(self, size=-1):
+        return self.read(size)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def close(self):
+        if self._data is not None and self._pool is not None:
+            self._pool.release(self._data)
+        self._data = None
+        super(PooledBuffer, self).close()
+
+    def _get_data(self):
+        if self._data is None:
+            raise ValueError("I/O operation on closed buffer")
+        return self._data
+
+
+def _copy(data, start, end):
+    # Slicing the bytearray itself would copy the bytes twice
+    return memoryview(data)[start:end].tobytes()
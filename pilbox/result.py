@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import abc
+import hashlib
+import json
+import os
+import tempfile
+
+import tornado.gen
+import tornado.httpclient
+
+from pilbox.cache import LRUCache
+
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+_FORMATS = ["jpeg", "png", "webp", "gif", "tiff"]
+
+_SIGNATURES = [
+    (b"\xff\xd8", "jpeg"),
+    (b"\x89PNG", "png"),
+    (b"GIF8", "gif"),
+    (b"II*\x00", "tiff"),
+    (b"MM\x00*", "tiff"),
+]
+
+_FORMAT_TO_MIME = {
+    "gif": "image/gif",
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "webp": "image/webp",
+    "tiff": "image/tiff",
+}
+
+
+def get_result_key(spec):
+    """Returns the key of the result of a request, a digest of its spec,
+    a dict of everything that determines the rendered image.
+    """
+    digest = hashlib.sha256(
+        json.dumps(spec, sort_keys=True).encode()).hexdigest()
+    return "%s/%s" % (digest[:2], digest)
+
+
+def get_format(data):
+    """Returns the format of the image data, from its signature"""
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    for (signature, fmt) in _SIGNATURES:
+        if data.startswith(signature):
+            return fmt
+    return None
+
+
+class ResultStore(abc.ABC):
+    """Stores rendered images by key. Keys found to be stored are
+    remembered, so that lookups of popular results need not touch the
+    store.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self._names = LRUCache(maxsize, ttl)
+
+    async def lookup(self, key):
+        """Returns the name the result is stored as, or None"""
+        name = self._names.get(key)
+        if name is None:
+            name = await self._lookup(key)
+            if name is not None:
+                self._names.set(key, name)
+        return name
+
+    async def put(self, key, data):
+        """Stores the image data as the result"""
+        name = await self._put(key, data, get_format(data))
+        self._names.set(key, name)
+        return name
+
+    @abc.abstractmethod
+    async def _lookup(self, key):
+        """Returns the name the result is stored as, or None"""
+
+    @abc.abstractmethod
+    async def _put(self, key, data, fmt):
+        """Stores the image data as the result, returning its name"""
+
+
+class FileResultStore(ResultStore):
+    """Stores results as files below a root directory, named by key and
+    format, so that a web server serving them can tell their type.
+    """
+
+    def __init__(self, root, **kwargs):
+        super(FileResultStore, self).__init__(**kwargs)
+        self.root = root
+
+    async def _lookup(self, key):
+        for fmt in _FORMATS:
+            name = "%s.%s" % (key, fmt)
+            if os.path.isfile(os.path.join(self.root, name)):
+                return name
+        return None
+
+    async def _put(self, key, data, fmt):
+        name = "%s.%s" % (key, fmt) if fmt else key
+        path = os.path.join(self.root, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass  # Created by another worker
+        # Written to a temporary file first, so no partial file is served
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.rename(tmp, path)
+        except (IOError, OSError):
+            os.unlink(tmp)
+            raise
+        return name
+
+
+class S3ResultStore(ResultStore):
+    """Stores results as objects of an S3 compatible object store, using
+    an S3Source to address and sign requests.
+    """
+
+    def __init__(self, source, bucket, prefix="", **kwargs):
+        super(S3ResultStore, self).__init__(**kwargs)
+        self.source = source
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    async def _lookup(self, key):
+        name = self._get_name(key)
+        try:
+            await self._request("HEAD", name)
+        except tornado.httpclient.HTTPError as e:
+            if e.code == 404:
+                return None
+            raise
+        return name
+
+    async def _put(self, key, data, fmt):
+        name = self._get_name(key)
+        await self._request(
+            "PUT", name, body=data,
+            headers={"Content-Type": _FORMAT_TO_MIME.get(
+                fmt, "application/octet-stream")})
+        return name
+
+    def _get_name(self, key):
+        return "%s/%s" % (self.prefix, key) if self.prefix else key
+
+    def _request(self, method, name, body=None, headers=None):
+        url = self.source.get_url("s3://%s/%s" % (self.bucket, name))
+        headers = dict(headers or {})
+        if self.source.access_key and self.source.secret_key:
+            self.source.sign(method, url, headers, payload_hash=(
+                hashlib.sha256(body or b"").hexdigest()))
+        client = tornado.httpclient.AsyncHTTPClient(
+            max_clients=self.source.max_clients)
+        return client.fetch(url, method=method, body=body, headers=headers,
+                            request_timeout=self.source.timeout)
+
+
+def get_result_store(url, s3_source=None):
+    """Returns the store of a file or s3 url, the latter stored using the
+    S3Source.
+    """
+    parsed = urlparse(url)
+    if parsed.scheme == "file":
+        return FileResultStore(parsed.path)
+    elif parsed.scheme == "s3" and s3_source is not None:
+        return S3ResultStore(s3_source, parsed.netloc, parsed.path)
+    raise Exception("Invalid result store: %s" % url)
@@ -0,0 +1,393 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import hashlib
+import logging
+import mmap
+import multiprocessing
+import struct
+import time
+
+# Item header: key hash, next item in the bucket or free list, expiry time,
+# key length, value length and whether it was read since the clock passed
+_ITEM = struct.Struct("<QqdIII4x")
+# Stripe counters: pages assigned, items, hits, misses, sets, evictions
+_STRIPE_FIELDS = 6
+_STRIPE = struct.Struct("<%dq" % _STRIPE_FIELDS)
+_PAGES, _ITEMS, _HITS, _MISSES, _SETS, _EVICTIONS = range(_STRIPE_FIELDS)
+# Per class: free list head, clock page and clock chunk
+_CLASS = struct.Struct("<3q")
+_OFFSET = struct.Struct("<q")
+_PAGE_CLASS = struct.Struct("<i")
+
+# Smallest chunk, the sizes of the chunk classes doubling up to a page
+MIN_CHUNK = 128
+# Average size of the items for which a bucket is allotted
+_BUCKET_BYTES = 4096
+
+logger = logging.getLogger("tornado.application")
+
+
+class SharedCache(object):
+    """A cache of bytes in an anonymous shared memory segment, so that the
+    worker processes forked after it is created share the same entries.
+
+    The segment is divided into stripes, by key hash, each with its own
+    lock, hash table and pages, so that workers only contend for a lock
+    when their keys fall in the same stripe. Pages of page_size bytes,
+    the largest item, are assigned to classes of chunks, whose sizes
+    double from MIN_CHUNK bytes, as items of each size are stored. Once a
+    stripe's pages are all assigned, items are evicted by a clock over
+    the pages of their class, skipping those read since the clock last
+    passed them, and a page is taken from another class when the class
+    of an item has no pages.
+
+    A stripe whose lock is not released within lock_timeout seconds, as
+    when a worker was killed holding it, is skipped, its gets missing and
+    its sets not stored, and is afterwards only used when its lock is
+    free, rather than waited for again.
+    """
+
+    def __init__(self, size, stripes=16, page_size=4 * 1024 * 1024,
+                 lock_timeout=1.0):
+        chunk = MIN_CHUNK
+        while chunk * 2 <= min(page_size, size // stripes // 4):
+            chunk *= 2
+        self.page_size = chunk
+        self.classes = self.page_size.bit_length() - \
+            MIN_CHUNK.bit_length() + 1
+        self.stripes = stripes
+        stripe_size = size // stripes
+        self.buckets = max(stripe_size // _BUCKET_BYTES, 64)
+        self.pages = stripe_size // self.page_size
+        self._class_base = _STRIPE.size
+        self._page_class_base = self._class_base + \
+            self.classes * _CLASS.size
+        self._bucket_base = self._page_class_base + \
+            self.pages * _PAGE_CLASS.size
+        self._page_base = _align(self._bucket_base +
+                                 self.buckets * _OFFSET.size)
+        self.stripe_size = self._page_base + self.pages * self.page_size
+        self.size = self.pages * self.page_size * stripes
+        # Anonymous maps are shared with the processes forked after them
+        self._buf = mmap.mmap(-1, self.stripe_size * stripes)
+        self._locks = [multiprocessing.Lock() for _ in range(stripes)]
+        self.lock_timeout = lock_timeout
+        self._stalled = set()
+        for stripe in range(stripes):
+            base = stripe * self.stripe_size
+            for page in range(self.pages):
+                _PAGE_CLASS.pack_into(
+                    self._buf, base + self._page_class_base +
+                    page * _PAGE_CLASS.size, -1)
+
+    def get(self, key, now=None):
+        """Returns the value of the key, or None"""
+        key = _encode(key)
+        h = _hash(key)
+        now = time.time() if now is None else now
+        stripe = h % self.stripes
+        if not self._acquire(stripe):
+            return None
+        try:
+            offset = self._find(stripe, h, key)
+            if offset and not self._is_expired(offset, now):
+                head = _ITEM.unpack_from(self._buf, offset)
+                _ITEM.pack_into(self._buf, offset, *(head[:5] + (1,)))
+                start = offset + _ITEM.size + head[3]
+                self._count(stripe, _HITS, 1)
+                return self._buf[start:start + head[4]]
+            if offset:
+                self._unlink(stripe, offset)
+                self._free(stripe, offset)
+            self._count(stripe, _MISSES, 1)
+        finally:
+            self._locks[stripe].release()
+        return None
+
+    def set(self, key, value, ttl=None, now=None):
+        """Stores the value of the key, for ttl seconds if supplied,
+        returning whether it was stored, which it is not if it is larger
+        than a page or its stripe is locked.
+        """
+        return self._set(key, value, ttl, now, True)
+
+    def add(self, key, value, ttl=None, now=None):
+        """Stores the value of the key, as set does, unless the key is
+        already stored, so that of the processes adding a key only one
+        does.
+        """
+        return self._set(key, value, ttl, now, False)
+
+    def _set(self, key, value, ttl, now, replace):
+        key = _encode(key)
+        h = _hash(key)
+        size = _ITEM.size + len(key) + len(value)
+        if size > self.page_size:
+            return False
+        cls = max(size - 1, MIN_CHUNK - 1).bit_length() - \
+            MIN_CHUNK.bit_length() + 1
+        now = time.time() if now is None else now
+        expires = now + ttl if ttl else 0.0
+        stripe = h % self.stripes
+        if not self._acquire(stripe):
+            return False
+        try:
+            offset = self._find(stripe, h, key)
+            if offset and not replace and not self._is_expired(offset, now):
+                return False
+            if offset:
+                self._unlink(stripe, offset)
+                self._free(stripe, offset)
+            offset = self._alloc(stripe, cls)
+            if not offset:
+                return False
+            bucket = self._get_bucket(stripe, h)
+            head = _OFFSET.unpack_from(self._buf, bucket)[0]
+            _ITEM.pack_into(self._buf, offset, h, head, expires, len(key),
+                            len(value), 0)
+            start = offset + _ITEM.size
+            self._buf[start:start + len(key)] = key
+            self._buf[start + len(key):start + len(key) + len(value)] = value
+            _OFFSET.pack_into(self._buf, bucket, offset)
+            self._count(stripe, _ITEMS, 1)
+            self._count(stripe, _SETS, 1)
+        finally:
+            self._locks[stripe].release()
+        return True
+
+    def delete(self, key):
+        key = _encode(key)
+        h = _hash(key)
+        stripe = h % self.stripes
+        if not self._acquire(stripe):
+            return
+        try:
+            self._delete(stripe, h, key)
+        finally:
+            self._locks[stripe].release()
+
+    def get_stats(self):
+        """Returns the counts of all the stripes, and the bytes of their
+        pages assigned to classes, and the number of stripes left out as
+        they are locked.
+        """
+        totals = [0] * _STRIPE_FIELDS
+        stalled = 0
+        for stripe in range(self.stripes):
+            if not self._acquire(stripe):
+                stalled += 1
+                continue
+            try:
+                counts = _STRIPE.unpack_from(
+                    self._buf, stripe * self.stripe_size)
+            finally:
+                self._locks[stripe].release()
+            totals = [a + b for (a, b) in zip(totals, counts)]
+        return dict(size=self.size, used=totals[_PAGES] * self.page_size,
+                    items=totals[_ITEMS], hits=totals[_HITS],
+                    misses=totals[_MISSES], sets=totals[_SETS],
+                    evictions=totals[_EVICTIONS], stalled=stalled)
+
+    def _acquire(self, stripe):
+        """Acquires the lock of the stripe, returning whether it did"""
+        stalled = stripe in self._stalled
+        if self._locks[stripe].acquire(
+                timeout=0 if stalled else self.lock_timeout):
+            self._stalled.discard(stripe)
+            return True
+        if not stalled:
+            logger.warning("Shared cache stripe %d still locked after %.1fs, "
+                           "skipping it while it is locked", stripe,
+                           self.lock_timeout)
+            self._stalled.add(stripe)
+        return False
+
+    def _find(self, stripe, h, key):
+        offset = _OFFSET.unpack_from(
+            self._buf, self._get_bucket(stripe, h))[0]
+        while offset:
+            head = _ITEM.unpack_from(self._buf, offset)
+            if head[0] == h and head[3] == len(key):
+                start = offset + _ITEM.size
+                if self._buf[start:start + len(key)] == key:
+                    return offset
+            offset = head[1]
+        return 0
+
+    def _delete(self, stripe, h, key):
+        offset = self._find(stripe, h, key)
+        if offset:
+            self._unlink(stripe, offset)
+            self._free(stripe, offset)
+
+    def _unlink(self, stripe, offset):
+        """Removes the item from its bucket"""
+        head = _ITEM.unpack_from(self._buf, offset)
+        prev = self._get_bucket(stripe, head[0])
+        current = _OFFSET.unpack_from(self._buf, prev)[0]
+        while current != offset:
+            prev = current + _OFFSET.size  # The next field of the item
+            current = _ITEM.unpack_from(self._buf, current)[1]
+        _OFFSET.pack_into(self._buf, prev, head[1])
+        self._count(stripe, _ITEMS, -1)
+
+    def _free(self, stripe, offset):
+        cls = self._get_page_class(stripe, self._get_page(stripe, offset))
+        free, page, chunk = self._get_class(stripe, cls)
+        _ITEM.pack_into(self._buf, offset, 0, free, 0.0, 0, 0, 0)
+        self._set_class(stripe, cls, offset, page, chunk)
+
+    def _alloc(self, stripe, cls):
+        free, page, chunk = self._get_class(stripe, cls)
+        if free:
+            self._set_class(stripe, cls,
+                            _ITEM.unpack_from(self._buf, free)[1],
+                            page, chunk)
+            return free
+        base = stripe * self.stripe_size
+        assigned = _STRIPE.unpack_from(self._buf, base)[_PAGES]
+        if assigned < self.pages:
+            self._count(stripe, _PAGES, 1)
+            return self._assign(stripe, assigned, cls)
+        pages = [p for p in range(self.pages)
+                 if self._get_page_class(stripe, p) == cls]
+        if not pages:
+            return self._steal(stripe, cls)
+        return self._evict(stripe, cls, pages)
+
+    def _assign(self, stripe, page, cls):
+        """Assigns the page to the class, freeing all but its first chunk,
+        which is returned.
+        """
+        _PAGE_CLASS.pack_into(self._buf, stripe * self.stripe_size +
+                              self._page_class_base +
+                              page * _PAGE_CLASS.size, cls)
+        start = self._get_page_offset(stripe, page)
+        chunk_size = MIN_CHUNK << cls
+        for offset in range(start + self.page_size - chunk_size, start,
+                            -chunk_size):
+            self._free(stripe, offset)
+        return start
+
+    def _evict(self, stripe, cls, pages):
+        """Evicts the first item the clock finds unread since it last
+        passed, returning its chunk.
+        """
+        free, page, chunk = self._get_class(stripe, cls)
+        chunks = self.page_size // (MIN_CHUNK << cls)
+        if page not in pages:
+            page, chunk = pages[0], 0
+        for _ in range(2 * chunks * len(pages) + 1):
+            offset = self._get_page_offset(stripe, page) + \
+                chunk * (MIN_CHUNK << cls)
+            chunk += 1
+            if chunk >= chunks:
+                page, chunk = pages[(pages.index(page) + 1) % len(pages)], 0
+            head = _ITEM.unpack_from(self._buf, offset)
+            if head[5]:
+                _ITEM.pack_into(self._buf, offset, *(head[:5] + (0,)))
+                continue
+            self._set_class(stripe, cls, free, page, chunk)
+            self._unlink(stripe, offset)
+            self._count(stripe, _EVICTIONS, 1)
+            return offset
+        return 0
+
+    def _steal(self, stripe, cls):
+        """Takes the page of another class, evicting its items"""
+        counts = dict()
+        for p in range(self.pages):
+            other = self._get_page_class(stripe, p)
+            counts.setdefault(other, []).append(p)
+        # From the class with the most pages, which can best spare one
+        other, pages = max(counts.items(), key=lambda item: len(item[1]))
+        page = pages[-1]
+        start = self._get_page_offset(stripe, page)
+        end = start + self.page_size
+        chunk_size = MIN_CHUNK << other
+        for offset in range(start, end, chunk_size):
+            if _ITEM.unpack_from(self._buf, offset)[0]:
+                self._unlink(stripe, offset)
+                self._count(stripe, _EVICTIONS, 1)
+        # Its free chunks are dropped from the free list of the class
+        free, clock_page, chunk = self._get_class(stripe, other)
+        head, prev, offset = free, None, free
+        while offset:
+            following = _ITEM.unpack_from(self._buf, offset)[1]
+            if start <= offset < end:
+                if prev is None:
+                    head = following
+                else:
+                    _OFFSET.pack_into(self._buf, prev + _OFFSET.size,
+                                      following)
+            else:
+                prev = offset
+            offset = following
+        self._set_class(stripe, other, head, clock_page, chunk)
+        return self._assign(stripe, page, cls)
+
+    def _is_expired(self, offset, now):
+        expires = _ITEM.unpack_from(self._buf, offset)[2]
+        return expires and expires <= now
+
+    def _count(self, stripe, field, n):
+        offset = stripe * self.stripe_size + field * 8
+        _OFFSET.pack_into(self._buf, offset,
+                          _OFFSET.unpack_from(self._buf, offset)[0] + n)
+
+    def _get_bucket(self, stripe, h):
+        return stripe * self.stripe_size + self._bucket_base + \
+            (h // self.stripes % self.buckets) * _OFFSET.size
+
+    def _get_class(self, stripe, cls):
+        return _CLASS.unpack_from(
+            self._buf, stripe * self.stripe_size + self._class_base +
+            cls * _CLASS.size)
+
+    def _set_class(self, stripe, cls, free, page, chunk):
+        _CLASS.pack_into(
+            self._buf, stripe * self.stripe_size + self._class_base +
+            cls * _CLASS.size, free, page, chunk)
+
+    def _get_page(self, stripe, offset):
+        return (offset - stripe * self.stripe_size - self._page_base) \
+            // self.page_size
+
+    def _get_page_offset(self, stripe, page):
+        return stripe * self.stripe_size + self._page_base + \
+            page * self.page_size
+
+    def _get_page_class(self, stripe, page):
+        return _PAGE_CLASS.unpack_from(
+            self._buf, stripe * self.stripe_size + self._page_class_base +
+            page * _PAGE_CLASS.size)[0]
+
+
+def _align(offset, alignment=64):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def _encode(key):
+    return key.encode("utf-8") if not isinstance(key, bytes) else key
+
+
+def _hash(key):
+    # Stable across processes, unlike hash(), and never 0, marking free
+    return struct.unpack("<Q", hashlib.sha1(key).digest()[:8])[0] or 1
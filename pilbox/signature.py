@@ -20,35 +20,109 @@ from __future__ import absolute_import, division, print_function, \
 import hashlib
 import hmac
 import re
+import time
 
 try:
     from urllib import urlencode
 except ImportError:
     from urllib.parse import urlencode
 
-try:
-    import urlparse
-except ImportError:
-    import urllib.parse as urlparse
+# Verification results
+VALID = "valid"
+INVALID = "invalid"
+EXPIRED = "expired"
+
+_DIGESTS = {1: hashlib.sha1, 2: hashlib.sha256}
+
+# The hexadecimal signature length identifies the version
+_VERSIONS = {40: 1, 64: 2}
+
+_V1_SIGNATURE_RE = re.compile(r'&?sig=[^&]*')
+
+
+class Verifier(object):
+    """Verifies signed query strings against any of the active keys, so
+    that keys can be rotated. The keyed HMAC state is computed once, and
+    copied for each request.
 
+    Version 1 signatures are HMAC-SHA1 digests of the query string without
+    the sig parameter. Version 2 signatures are HMAC-SHA256 digests of the
+    query string without sig parameters, which may include an exp
+    parameter, a unix timestamp after which the signature is expired.
+    Expiry is checked first, so expired requests are rejected cheaply.
+    """
 
-def derive_signature(key, qs):
+    def __init__(self, keys):
+        self._macs = dict((v, [_new_mac(k, v) for k in keys if k])
+                          for v in _DIGESTS)
+
+    def verify(self, qs, now=None):
+        """Returns VALID, INVALID or EXPIRED"""
+        unsigned_qs, sig, exp = _split(qs or "")
+        version = _VERSIONS.get(len(sig or ""))
+        if version is None:
+            return INVALID
+        if version == 2 and exp is not None:
+            try:
+                if int(exp) <= (time.time() if now is None else now):
+                    return EXPIRED
+            except ValueError:
+                return INVALID
+        if version == 1:
+            unsigned_qs = _V1_SIGNATURE_RE.sub("", qs)
+        msg = unsigned_qs.encode()
+        sig = sig.encode()
+        valid = False
+        for mac in self._macs[version]:
+            mac = mac.copy()
+            mac.update(msg)
+            # Every key is compared, so the time taken does not reveal
+            # which one matched
+            valid |= hmac.compare_digest(mac.hexdigest().encode(), sig)
+        return VALID if valid else INVALID
+
+
+def derive_signature(key, qs, version=1):
     """Derives the signature from the supplied query string using the key."""
-    key, qs = (key or "", qs or "")
-    return hmac.new(key.encode(), qs.encode(), hashlib.sha1).hexdigest()
+    mac = _new_mac(key or "", version)
+    mac.update((qs or "").encode())
+    return mac.hexdigest()
 
 
-def sign(key, qs):
-    """Signs the query string using the key."""
-    sig = derive_signature(key, qs)
+def sign(key, qs, version=1, expires=None):
+    """Signs the query string using the key. When expires, a unix
+    timestamp, is supplied, it is included as the exp parameter.
+    """
+    if expires is not None:
+        qs = "%s&%s" % (qs, urlencode([("exp", int(expires))]))
+    sig = derive_signature(key, qs, version)
     return "%s&%s" % (qs, urlencode([("sig", sig)]))
 
 
 def verify_signature(key, qs):
     """Verifies that the signature in the query string is correct."""
-    unsigned_qs = re.sub(r'&?sig=[^&]*', '', qs)
-    sig = derive_signature(key, unsigned_qs)
-    return urlparse.parse_qs(qs).get("sig", [None])[0] == sig
+    return Verifier([key]).verify(qs) == VALID
+
+
+def _new_mac(key, version):
+    return hmac.new(key.encode(), None, _DIGESTS[version])
+
+
+def _split(qs):
+    """Splits the query string into the unsigned query string, the first
+    signature and the last expiry, in a single pass.
+    """
+    sig = exp = None
+    unsigned = []
+    for param in qs.split("&"):
+        if param.startswith("sig="):
+            if sig is None:
+                sig = param[4:]
+            continue
+        elif param.startswith("exp="):
+            exp = param[4:]
+        unsigned.append(param)
+    return ("&".join(unsigned), sig, exp)
 
 
 def main():
@@ -56,6 +130,9 @@ def main():
     import tornado.options
     from tornado.options import define, options, parse_command_line
     define("key", help="the signing key", type=str)
+    define("version", help="the signature version, 1 or 2", type=int,
+           default=1)
+    define("ttl", help="seconds until the signature expires", type=int)
     args = parse_command_line()
     if not options.key:
         tornado.options.print_help()
@@ -65,9 +142,11 @@ def main():
     if qs and qs[0] == "?":
         print("Invalid query string, should not include leading '?'")
         sys.exit()
+    expires = int(time.time()) + options.ttl if options.ttl else None
+    signed_qs = sign(options.key, qs, options.version, expires)
     print("Query String: %s" % qs)
-    print("Signature: %s" % derive_signature(options.key, qs))
-    print("Signed Query String: %s" % sign(options.key, qs))
+    print("Signature: %s" % signed_qs.rsplit("sig=", 1)[1])
+    print("Signed Query String: %s" % signed_qs)
 
 
 if __name__ == "__main__":
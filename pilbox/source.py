@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import datetime
+import email.utils
+import hashlib
+import hmac
+import mimetypes
+import mmap
+import os
+import re
+import socket
+
+import tornado.gen
+import tornado.httpclient
+import tornado.httputil
+import tornado.locks
+
+from pilbox import errors
+
+try:
+    from io import BytesIO
+except ImportError:
+    from cStringIO import StringIO as BytesIO
+
+try:
+    from urlparse import urlparse
+    from urllib import quote, unquote
+except ImportError:
+    from urllib.parse import urlparse, quote, unquote
+
+
+_BLOCK_SIZE = 65536
+
+
+class SourceResponse(object):
+    """The response of a source, with the code, headers and buffer used of
+    a Tornado HTTPResponse.
+    """
+
+    def __init__(self, code, headers, buffer):
+        self.code = code
+        self.headers = headers
+        self.buffer = buffer
+
+    def close(self):
+        self.buffer.close()
+
+
+class FileSource(object):
+    """Serves images from the files below a root directory, addressed by
+    file urls relative to the root, e.g. file:///a/b.jpg. Files are memory
+    mapped, so images are decoded, hashed and passed through from the page
+    cache, rather than being copied into the heap first, other than to
+    read the frames of animations again. The modification time and size
+    of a file are its validator, given as the response's Etag.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.realpath(root)
+
+    def get_path(self, url):
+        """Returns the path of the file, raising a UrlError if it is not
+        within the root directory, including by a symbolic link.
+        """
+        path = unquote(urlparse(url).path).lstrip("/")
+        path = os.path.realpath(os.path.join(self.root, path))
+        if not path.startswith(os.path.join(self.root, "")):
+            raise errors.UrlError("Invalid path")
+        return path
+
+    def get_validator(self, url):
+        """Returns the validator of the file, derived from its modification
+        time and size.
+        """
+        return _get_validator(self._stat(self.get_path(url)))
+
+    async def fetch(self, url, header_callback=None,
+                    streaming_callback=None, **kwargs):
+        """Returns a SourceResponse for the file, calling the callbacks as
+        an HTTP fetch would.
+        """
+        path = self.get_path(url)
+        try:
+            with open(path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                if stat.st_size:
+                    buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    buf = BytesIO()  # Empty files cannot be mapped
+        except (IOError, OSError):
+            raise errors.FetchError("File not found")
+
+        headers = tornado.httputil.HTTPHeaders()
+        headers["Content-Type"] = mimetypes.guess_type(path)[0] or \
+            "application/octet-stream"
+        headers["Content-Length"] = str(stat.st_size)
+        headers["Last-Modified"] = email.utils.formatdate(
+            stat.st_mtime, usegmt=True)
+        headers["Etag"] = _get_validator(stat)
+        resp = SourceResponse(200, headers, buf)
+        await _run_callbacks(resp, header_callback, streaming_callback)
+        return resp
+
+    def _stat(self, path):
+        try:
+            return os.stat(path)
+        except (IOError, OSError):
+            raise errors.FetchError("File not found")
+
+
+class S3Source(object):
+    """Serves images from an S3 compatible object store, addressed by s3
+    urls, e.g. s3://bucket/a/b.jpg. Requests are signed with AWS Signature
+    Version 4 when credentials are supplied.
+
+    The first part_size bytes of an object are requested, and when the
+    object is larger, its remaining parts are requested in parallel, at
+    most parallel at a time, each conditional on the object's ETag, so
+    that a changed object cannot be assembled from different versions.
+    Requests with a Range header are passed through, so probing the header
+    of an image only requests the start of it.
+
+    The endpoint is a base url, with the bucket as the first path segment,
+    or in place of {bucket}, e.g. https://{bucket}.s3.amazonaws.com.
+    """
+
+    FORWARD_HEADERS = ["Cache-Control", "Content-Type", "Etag", "Expires",
+                       "Last-Modified"]
+
+    def __init__(self, endpoint, access_key=None, secret_key=None,
+                 region="us-east-1", part_size=8 * 1024 * 1024, parallel=4,
+                 timeout=10.0, max_clients=10):
+        self.endpoint = endpoint.rstrip("/")
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.part_size = part_size
+        self.parallel = parallel
+        self.timeout = timeout
+        self.max_clients = max_clients
+        self._signing_keys = dict()
+
+    def get_url(self, url):
+        """Returns the http url of the object of the s3 url"""
+        parsed = urlparse(url)
+        key = quote(unquote(parsed.path.lstrip("/")), safe="/~")
+        if "{bucket}" in self.endpoint:
+            return "%s/%s" % (
+                self.endpoint.replace("{bucket}", parsed.netloc), key)
+        return "%s/%s/%s" % (self.endpoint, parsed.netloc, key)
+
+    async def fetch(self, url, header_callback=None,
+                    streaming_callback=None, headers=None, **kwargs):
+        """Returns a SourceResponse for the object, calling the callbacks as
+        an HTTP fetch would.
+        """
+        url = self.get_url(url)
+        if headers and "Range" in headers:
+            resp = await self._get(url, headers["Range"])
+            resp = self._get_response(resp, resp.code, BytesIO(resp.body))
+            await _run_callbacks(resp, header_callback, streaming_callback)
+            return resp
+
+        resp = await self._get(url, "bytes=0-%d" % (self.part_size - 1))
+        if resp.code == 416:
+            # An empty object has no first part
+            resp = await self._get(url)
+        size = _get_object_size(resp)
+        if resp.code == 200 or size <= len(resp.body):
+            buf = BytesIO(resp.body)
+        else:
+            # The parts are written in place, into a buffer of the object's
+            # size, rather than copied once assembled
+            buf = BytesIO()
+            buf.seek(size - 1)
+            buf.write(b"\0")
+            data = buf.getbuffer()
+            data[:len(resp.body)] = resp.body
+            lock = tornado.locks.Semaphore(self.parallel)
+            await tornado.gen.multi([
+                self._get_part(url, data, start, resp.headers.get("Etag"),
+                               lock)
+                for start in range(len(resp.body), size, self.part_size)])
+            data.release()
+        resp = self._get_response(resp, 200, buf)
+        await _run_callbacks(resp, header_callback, streaming_callback)
+        return resp
+
+    def sign(self, method, url, headers, now=None,
+             payload_hash="UNSIGNED-PAYLOAD"):
+        """Adds the AWS Signature Version 4 headers for the request"""
+        now = now or datetime.datetime.utcnow()
+        date = now.strftime("%Y%m%d")
+        parsed = urlparse(url)
+        headers["Host"] = parsed.netloc
+        headers["X-Amz-Content-Sha256"] = payload_hash
+        headers["X-Amz-Date"] = now.strftime("%Y%m%dT%H%M%SZ")
+        signed = sorted((k.lower(), " ".join(str(v).split()))
+                        for (k, v) in headers.items())
+        query = "&".join(sorted(
+            p if "=" in p else p + "=" for p in parsed.query.split("&") if p))
+        request = "\n".join(
+            [method, parsed.path or "/", query] +
+            ["%s:%s" % (k, v) for (k, v) in signed] +
+            ["", ";".join(k for (k, v) in signed), payload_hash])
+        scope = "%s/%s/s3/aws4_request" % (date, self.region)
+        string_to_sign = "\n".join([
+            "AWS4-HMAC-SHA256", headers["X-Amz-Date"], scope,
+            hashlib.sha256(request.encode()).hexdigest()])
+        signature = hmac.new(self._get_signing_key(date),
+                             string_to_sign.encode(),
+                             hashlib.sha256).hexdigest()
+        headers["Authorization"] = (
+            "AWS4-HMAC-SHA256 Credential=%s/%s, SignedHeaders=%s, "
+            "Signature=%s" % (self.access_key, scope,
+                              ";".join(k for (k, v) in signed), signature))
+        return headers
+
+    async def _get_part(self, url, data, start, etag, lock):
+        end = min(start + self.part_size, len(data))
+        async with lock:
+            resp = await self._get(url, "bytes=%d-%d" % (start, end - 1),
+                                   etag)
+        if resp.code != 206 or len(resp.body) != end - start:
+            raise errors.FetchError("Invalid object part")
+        data[start:end] = resp.body
+
+    async def _get(self, url, byte_range=None, etag=None):
+        headers = dict()
+        if byte_range:
+            headers["Range"] = byte_range
+        if etag:
+            headers["If-Match"] = etag
+        if self.access_key and self.secret_key:
+            self.sign("GET", url, headers)
+        # The client is shared per IOLoop, bounding concurrent requests.
+        # Connections are only reused by the curl client, which is used
+        # when pycurl is installed.
+        client = tornado.httpclient.AsyncHTTPClient(
+            max_clients=self.max_clients)
+        try:
+            resp = await client.fetch(url, headers=headers,
+                                      request_timeout=self.timeout)
+        except tornado.httpclient.HTTPError as e:
+            if e.code == 416:
+                return e.response
+            raise errors.FetchError("Object fetch error: %s" % e)
+        except socket.error as e:
+            raise errors.FetchError("Object fetch error: %s" % e)
+        return resp
+
+    def _get_response(self, resp, code, buf):
+        headers = tornado.httputil.HTTPHeaders()
+        for k in S3Source.FORWARD_HEADERS:
+            if k in resp.headers:
+                headers[k] = resp.headers[k]
+        if code == 206 and "Content-Range" in resp.headers:
+            headers["Content-Range"] = resp.headers["Content-Range"]
+        headers["Content-Length"] = str(buf.seek(0, os.SEEK_END))
+        buf.seek(0)
+        return SourceResponse(code, headers, buf)
+
+    def _get_signing_key(self, date):
+        # Derived once a day, rather than with four HMACs per request
+        key = self._signing_keys.get(date)
+        if key is None:
+            key = ("AWS4" + self.secret_key).encode()
+            for msg in [date, self.region, "s3", "aws4_request"]:
+                key = hmac.new(key, msg.encode(), hashlib.sha256).digest()
+            self._signing_keys = {date: key}
+        return key
+
+
+def _get_object_size(resp):
+    match = re.match(r"bytes \d+-\d+/(\d+)",
+                     resp.headers.get("Content-Range", ""))
+    return int(match.group(1)) if match else len(resp.body)
+
+
+async def _run_callbacks(resp, header_callback, streaming_callback):
+    """Calls the callbacks of an HTTP fetch with the response, waiting on
+    any future returned by the streaming callback before the next block.
+    """
+    if header_callback is not None:
+        header_callback("HTTP/1.1 %d %s\r\n" % (
+            resp.code, tornado.httputil.responses.get(resp.code, "")))
+        for (k, v) in resp.headers.get_all():
+            header_callback("%s: %s\r\n" % (k, v))
+        header_callback("\r\n")
+    if streaming_callback is not None:
+        for block in iter(lambda: resp.buffer.read(_BLOCK_SIZE), b""):
+            future = streaming_callback(block)
+            if future is not None:
+                await future
+        resp.buffer.seek(0)
+
+
+def _get_validator(stat):
+    mtime = getattr(stat, "st_mtime_ns", int(stat.st_mtime * 1e9))
+    return '"%x-%x"' % (mtime, stat.st_size)
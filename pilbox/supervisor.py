@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import errno
+import logging
+import math
+import multiprocessing.sharedctypes
+import os
+import random
+import resource
+import signal
+import sys
+import time
+
+import tornado.ioloop
+import tornado.process
+
+logger = logging.getLogger("tornado.application")
+
+RECYCLE_REASONS = ["requests", "memory", "crash"]
+
+# Per worker slot fields, stored in shared memory
+_PID, _STATE, _REQUESTS, _RSS = range(4)
+_SLOT_FIELDS = 4
+
+_FREE, _STARTING, _SERVING, _DRAINING = range(4)
+_POLL_INTERVAL = 0.1
+
+# CPU quota files of cgroup v2 and v1 respectively, as mounted in containers
+_CGROUP_CPU_MAX = "/sys/fs/cgroup/cpu.max"
+_CGROUP_CFS_QUOTA = "/sys/fs/cgroup/cpu/cpu.cfs_quota_us"
+_CGROUP_CFS_PERIOD = "/sys/fs/cgroup/cpu/cpu.cfs_period_us"
+
+
+class Supervisor(object):
+    """Forks and supervises worker processes, like Tornado's
+    fork_processes, but replacing workers that exit for any reason.
+
+    A worker is recycled once it has served max_requests requests or its
+    resident set size exceeds max_rss bytes. A replacement is forked, the
+    worker stops accepting connections once the replacement is serving,
+    and it exits once its in-flight requests have finished or
+    drain_timeout seconds have passed. Recycle
+    counts by reason and worker states are kept in shared memory, so any
+    worker can report them.
+    """
+
+    def __init__(self, workers=None, max_requests=None, max_rss=None,
+                 drain_timeout=30.0, interval=1.0):
+        self.workers = workers or get_cpu_count()
+        self.max_requests = max_requests
+        self.max_rss = max_rss
+        self.drain_timeout = drain_timeout
+        self.interval = interval
+        # Draining workers keep their slot, so allow one spare per worker
+        self._slots = multiprocessing.sharedctypes.RawArray(
+            "l", 2 * self.workers * _SLOT_FIELDS)
+        self._recycles = multiprocessing.sharedctypes.RawArray(
+            "l", len(RECYCLE_REASONS))
+        self._stopping = False
+        # The time the supervisor began waiting for a free slot, or None
+        self._waiting = None
+
+    def start(self):
+        """Forks the workers, returning a Worker in each child process.
+        The parent process replaces workers as they drain or exit, until
+        it receives SIGINT or SIGTERM, then exits once they have drained.
+        """
+        logger.info("Starting %d supervised processes", self.workers)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        while True:
+            self._reap()
+            if self._stopping:
+                if not self._get_slots(_STARTING, _SERVING, _DRAINING):
+                    sys.exit(0)
+            else:
+                worker = self._replace_workers()
+                if worker is not None:
+                    return worker
+            time.sleep(_POLL_INTERVAL)
+
+    def get_stats(self):
+        """Returns the recycle counts by reason and the state of each
+        running worker.
+        """
+        workers = []
+        for slot in self._get_slots(_STARTING, _SERVING, _DRAINING):
+            workers.append(dict(
+                pid=self._get(slot, _PID),
+                draining=self._get(slot, _STATE) == _DRAINING,
+                requests=self._get(slot, _REQUESTS),
+                rss=self._get(slot, _RSS)))
+        recycles = dict(zip(RECYCLE_REASONS, self._recycles))
+        return dict(recycles=recycles, workers=workers)
+
+    def _replace_workers(self):
+        """Forks workers until enough are starting or serving, returning a
+        Worker in each child process. When every slot is held, e.g. by
+        workers recycled at once, it waits for draining workers to exit,
+        killing them once they have overrun their drain timeout.
+        """
+        live = self._get_slots(_STARTING, _SERVING)
+        for _ in range(self.workers - len(live)):
+            if not self._get_slots(_FREE):
+                self._wait_for_slot()
+                return None
+            self._waiting = None
+            worker = self._fork()
+            if worker is not None:
+                return worker
+        return None
+
+    def _wait_for_slot(self):
+        now = time.time()
+        if self._waiting is None:
+            logger.warning("No free worker slot, waiting for %d draining "
+                           "workers to exit",
+                           len(self._get_slots(_DRAINING)))
+            self._waiting = now
+        elif now - self._waiting >= self.drain_timeout:
+            # Any worker draining since the wait began has overrun
+            for slot in self._get_slots(_DRAINING):
+                pid = self._get(slot, _PID)
+                if not pid:
+                    continue
+                logger.warning("Killing worker %d, still draining after "
+                               "%.0fs", pid, now - self._waiting)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            self._waiting = now
+
+    def _fork(self):
+        slot = self._get_slots(_FREE)[0]
+        self._set(slot, _STATE, _STARTING)
+        self._set(slot, _REQUESTS, 0)
+        self._set(slot, _RSS, 0)
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            random.seed()
+            self._set(slot, _PID, os.getpid())
+            return Worker(self, slot)
+        self._set(slot, _PID, pid)
+        return None
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            slots = [s for s in self._get_slots(_STARTING, _SERVING,
+                                                _DRAINING)
+                     if self._get(s, _PID) == pid]
+            if not slots:
+                continue
+            slot = slots[0]
+            if self._get(slot, _STATE) != _DRAINING:
+                logger.warning("Worker %d exited with status %d", pid,
+                               status)
+                self._recycles[RECYCLE_REASONS.index("crash")] += 1
+            self._set(slot, _STATE, _FREE)
+            self._set(slot, _PID, 0)
+
+    def _recycle(self, slot, reason):
+        self._set(slot, _STATE, _DRAINING)
+        if reason in RECYCLE_REASONS:
+            self._recycles[RECYCLE_REASONS.index(reason)] += 1
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+        for slot in self._get_slots(_STARTING, _SERVING, _DRAINING):
+            try:
+                os.kill(self._get(slot, _PID), signal.SIGTERM)
+            except OSError:
+                pass
+
+    def _get_slots(self, *states):
+        return [i for i in range(len(self._slots) // _SLOT_FIELDS)
+                if self._get(i, _STATE) in states]
+
+    def _get(self, slot, field):
+        return self._slots[slot * _SLOT_FIELDS + field]
+
+    def _set(self, slot, field, value):
+        self._slots[slot * _SLOT_FIELDS + field] = value
+
+
+class Worker(object):
+    """A supervised worker process, which counts its requests and recycles
+    itself once it reaches the supervisor's limits.
+    """
+
+    def __init__(self, supervisor, slot):
+        self.supervisor = supervisor
+        self.id = slot
+        self.active = 0
+        self._slot = slot
+        self._server = None
+        self._deadline = None
+
+    @property
+    def draining(self):
+        return self._deadline is not None
+
+    def start(self, server):
+        """Monitors the worker while the IOLoop runs, stopping the IOLoop
+        once the worker has drained. SIGTERM drains the worker.
+        """
+        self._server = server
+        if not self.draining:
+            self.supervisor._set(self._slot, _STATE, _SERVING)
+        signal.signal(signal.SIGTERM, lambda signum, frame: (
+            tornado.ioloop.IOLoop.current().add_callback_from_signal(
+                self.drain)))
+        tornado.ioloop.PeriodicCallback(
+            self.check, self.supervisor.interval * 1000).start()
+
+    def request_started(self):
+        self.active += 1
+
+    def request_finished(self):
+        self.active -= 1
+        requests = self.supervisor._get(self._slot, _REQUESTS) + 1
+        self.supervisor._set(self._slot, _REQUESTS, requests)
+        max_requests = self.supervisor.max_requests
+        if max_requests and requests >= max_requests:
+            self.drain("requests")
+
+    def check(self):
+        rss = get_rss()
+        self.supervisor._set(self._slot, _RSS, rss)
+        if self.draining:
+            # Keep accepting connections until the replacement is serving
+            if self._server is not None and (
+                    time.time() >= self._deadline or
+                    len(self.supervisor._get_slots(_SERVING)) >=
+                    self.supervisor.workers):
+                self._stop_listening()
+            if self._server is None and (
+                    not self.active or time.time() >= self._deadline):
+                tornado.ioloop.IOLoop.current().stop()
+            return
+
+        max_requests = self.supervisor.max_requests
+        max_rss = self.supervisor.max_rss
+        requests = self.supervisor._get(self._slot, _REQUESTS)
+        if max_requests and requests >= max_requests:
+            self.drain("requests")
+        elif max_rss and rss > max_rss:
+            self.drain("memory")
+
+    def drain(self, reason=None):
+        """Signals the supervisor to replace this worker, which stops
+        accepting connections once its replacement is serving, or at once
+        when shutting down, and exits once it has finished its in-flight
+        requests.
+        """
+        if self.draining:
+            return
+        logger.info("Draining worker %d (%s), %d requests in flight",
+                    os.getpid(), reason or "shutdown", self.active)
+        self.supervisor._recycle(self._slot, reason)
+        self._deadline = time.time() + self.supervisor.drain_timeout
+        if reason is None:
+            self._stop_listening()
+
+    def _stop_listening(self):
+        if self._server is not None:
+            self._server.stop()
+            self._server = None
+
+
+def get_rss():
+    """Returns the resident set size of the process in bytes"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        # Falls back to the peak size, in KB on Linux, bytes on OS X
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+
+
+def get_cpus():
+    """Returns the CPUs the process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(tornado.process.cpu_count()))
+
+
+def get_cpu_count():
+    """Returns the number of CPUs available to the process, limited by the
+    CPU affinity and any cgroup CPU quota, rounded up.
+    """
+    count = len(get_cpus())
+    quota = _get_cgroup_quota()
+    if quota:
+        count = min(count, int(math.ceil(quota)))
+    return max(count, 1)
+
+
+def set_cpu_affinity(index):
+    """Pins the process to one of the available CPUs, chosen by index"""
+    if not hasattr(os, "sched_setaffinity"):
+        logger.warning("CPU affinity is not supported on this platform")
+        return
+    cpus = get_cpus()
+    os.sched_setaffinity(0, [cpus[index % len(cpus)]])
+
+
+def _get_cgroup_quota():
+    try:
+        with open(_CGROUP_CPU_MAX) as f:
+            quota, period = f.read().split()[:2]
+    except (IOError, OSError, ValueError):
+        try:
+            with open(_CGROUP_CFS_QUOTA) as f:
+                quota = f.read().strip()
+            with open(_CGROUP_CFS_PERIOD) as f:
+                period = f.read().strip()
+        except (IOError, OSError):
+            return None
+    if quota == "max" or int(quota) <= 0:
+        return None
+    return int(quota) / int(period)
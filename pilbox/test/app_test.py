@@ -1,21 +1,36 @@
 from __future__ import absolute_import, division, with_statement
 
+import asyncio
+import datetime
+import hashlib
 import logging
 import os.path
+import re
+import shutil
+import tempfile
 import time
 
 import PIL.Image
 import tornado.escape
 import tornado.gen
+import tornado.httpserver
 import tornado.ioloop
 import tornado.web
+from tornado.simple_httpclient import HTTPStreamClosedError
 from tornado.test.util import unittest
-from tornado.testing import AsyncHTTPTestCase
+from tornado.testing import AsyncHTTPTestCase, bind_unused_port
 
 from pilbox import errors
-from pilbox.app import PilboxApplication
+from pilbox import supervisor as supervisor_module
+from pilbox.app import ImageHandler, InfoHandler, PilboxApplication
+from pilbox.cache import LRUCache
+from pilbox.health import HostHealth
+from pilbox.origin import OriginGroup
 from pilbox.signature import sign
+from pilbox.source import S3Source
+from pilbox.supervisor import Supervisor, Worker
 from pilbox.test import image_test
+from pilbox.vips import pyvips
 
 try:
     from io import BytesIO
@@ -28,9 +43,14 @@ except ImportError:
     from urllib.parse import urlencode, quote
 
 try:
-    import cv
+    from urlparse import urlparse
 except ImportError:
-    cv = None
+    from urllib.parse import urlparse
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
 
 try:
     import pycurl
@@ -56,6 +76,39 @@ class _AppAsyncMixin(object):
         self.assertEqual(response.code, 200, msg)
         return response
 
+    def fetch_noop_slowly(self, url, delay):
+        """Fetches test-bad-exif.jpg from the url, streamed to a client
+        that takes delay seconds to accept each block, returning the
+        response, the flushes and the most flushes pending at once.
+        """
+        flush = ImageHandler.flush
+        state = dict(pending=0, most=0, flushes=0)
+
+        def slow_flush(handler, *args, **kwargs):
+            future = flush(handler, *args, **kwargs)
+            state["pending"] += 1
+            state["most"] = max(state["most"], state["pending"])
+            state["flushes"] += 1
+
+            async def wait():
+                try:
+                    await future
+                    await tornado.gen.sleep(delay)
+                finally:
+                    state["pending"] -= 1
+            return asyncio.ensure_future(wait())
+
+        ImageHandler.flush = slow_flush
+        try:
+            resp = self.fetch("/?%s" % urlencode(dict(url=url, op="noop")))
+        finally:
+            ImageHandler.flush = flush
+        if resp.code == 200:
+            with open(os.path.join(os.path.dirname(__file__), "data",
+                                   "test-bad-exif.jpg"), "rb") as f:
+                self.assertEqual(resp.body, f.read())
+        return (resp, state["flushes"], state["most"])
+
     def get_image_resize_cases(self):
         cases = image_test.get_image_resize_cases()
         m = dict(background="bg", filter="filter", format="fmt",
@@ -158,7 +211,16 @@ class _PilboxTestApplication(PilboxApplication):
     def get_handlers(self):
         path = os.path.join(os.path.dirname(__file__), "data")
         handlers = [(r"/test/data/test-delayed.jpg", _DelayedHandler),
+                    (r"/test/data/test-failing.jpg", _FailingHandler),
+                    (r"/test/unavailable/.*", _UnavailableHandler),
+                    (r"/test/data/test-slow-once.jpg", _SlowOnceHandler),
+                    (r"/test/s3/([^/]+)/(.*)", _ObjectStoreHandler),
                     (r"/test/data/test-user-agent.jpg", _UserAgentHandler),
+                    (r"/test/data/test-revalidated.jpg",
+                     _RevalidatedHandler),
+                    (r"/test/data/test-private.jpg", _PrivateHandler),
+                    (r"/test/data/test-unsatisfiable.jpg",
+                     _UnsatisfiableHandler),
                     (r"/test/data/(.*)",
                      tornado.web.StaticFileHandler,
                      {"path": path})]
@@ -174,6 +236,155 @@ class _DelayedHandler(tornado.web.RequestHandler):
         self.finish()
 
 
+class _FailingHandler(tornado.web.RequestHandler):
+    requests = 0
+
+    def get(self):
+        _FailingHandler.requests += 1
+        self.set_status(int(self.get_argument("status", 404)))
+        self.finish()
+
+
+class _UnavailableHandler(tornado.web.RequestHandler):
+    """A mirror that is up but failing, responding 503 with a body"""
+    requests = 0
+
+    def get(self):
+        _UnavailableHandler.requests += 1
+        self.set_status(503)
+        self.finish("unavailable")
+
+
+class _SlowOnceHandler(tornado.web.RequestHandler):
+    requests = 0
+
+    @tornado.gen.coroutine
+    def get(self):
+        _SlowOnceHandler.requests += 1
+        if _SlowOnceHandler.requests == 1:
+            yield tornado.gen.sleep(float(self.get_argument("delay", 0.0)))
+        path = os.path.join(os.path.dirname(__file__), "data", "test1.jpg")
+        self.set_header("Content-Type", "image/jpeg")
+        with open(path, "rb") as f:
+            self.finish(f.read())
+
+
+class _PrivateHandler(tornado.web.RequestHandler):
+
+    def get(self):
+        path = os.path.join(os.path.dirname(__file__), "data", "test1.jpg")
+        self.set_header("Content-Type", "image/jpeg")
+        self.set_header("Cache-Control", "private, max-age=3600")
+        with open(path, "rb") as f:
+            self.finish(f.read())
+
+
+class _UnsatisfiableHandler(tornado.web.RequestHandler):
+    """Serves an image, but responds 416 to any range of it"""
+
+    def get(self):
+        if "Range" in self.request.headers:
+            self.set_status(416)
+            self.finish()
+            return
+        path = os.path.join(os.path.dirname(__file__), "data", "test1.jpg")
+        self.set_header("Content-Type", "image/jpeg")
+        with open(path, "rb") as f:
+            self.finish(f.read())
+
+
+class _ObjectStoreHandler(tornado.web.RequestHandler):
+    """A stand-in for an S3 compatible object store, serving the test data
+    and any objects put as the objects of any bucket, to requests signed
+    with the key abc and secret def.
+    """
+    requests = []
+    objects = dict()
+
+    def get(self, bucket, key):
+        _ObjectStoreHandler.requests.append(self.request.headers.get("Range"))
+        self._verify(bucket, key, ["Range", "If-Match"])
+        data = self._get_object(key)
+        etag = '"%s"' % hashlib.md5(data).hexdigest()
+        if self.request.headers.get("If-Match", etag) != etag:
+            raise tornado.web.HTTPError(412)
+        self.set_header("Content-Type", "image/jpeg")
+        self.set_header("Etag", etag)
+        match = re.match(r"bytes=(\d+)-(\d+)",
+                         self.request.headers.get("Range", ""))
+        if match:
+            start, end = int(match.group(1)), int(match.group(2))
+            if start >= len(data):
+                raise tornado.web.HTTPError(416)
+            end = min(end, len(data) - 1)
+            self.set_status(206)
+            self.set_header("Content-Range",
+                            "bytes %d-%d/%d" % (start, end, len(data)))
+            data = data[start:end + 1]
+        self.finish(data)
+
+    def head(self, bucket, key):
+        self._verify(bucket, key, [], "HEAD", hashlib.sha256().hexdigest())
+        self._get_object(key)
+        self.finish()
+
+    def put(self, bucket, key):
+        self._verify(bucket, key, ["Content-Type"], "PUT",
+                     hashlib.sha256(self.request.body).hexdigest())
+        _ObjectStoreHandler.objects[key] = (
+            self.request.headers.get("Content-Type"), self.request.body)
+        self.finish()
+
+    def _verify(self, bucket, key, names, method="GET",
+                payload_hash="UNSIGNED-PAYLOAD"):
+        source = S3Source(self.settings.get("s3_endpoint"), "abc", "def")
+        headers = dict((k, self.request.headers[k]) for k in names
+                       if k in self.request.headers)
+        now = datetime.datetime.strptime(
+            self.request.headers.get("X-Amz-Date", ""), "%Y%m%dT%H%M%SZ")
+        source.sign(method, source.get_url("s3://%s/%s" % (bucket, key)),
+                    headers, now=now, payload_hash=payload_hash)
+        if self.request.headers.get("Authorization") != \
+                headers["Authorization"]:
+            raise tornado.web.HTTPError(403)
+
+    def _get_object(self, key):
+        if key in _ObjectStoreHandler.objects:
+            return _ObjectStoreHandler.objects[key][1]
+        path = os.path.join(os.path.dirname(__file__), "data", key)
+        if not os.path.isfile(path):
+            raise tornado.web.HTTPError(404)
+        with open(path, "rb") as f:
+            return f.read()
+
+
+class _RevalidatedHandler(tornado.web.RequestHandler):
+    """Serves the image named by its class, with an Etag of the name,
+    recording the If-None-Match header of each request.
+    """
+    name = "test1.jpg"
+    requests = []
+
+    def get(self):
+        _RevalidatedHandler.requests.append(
+            self.request.headers.get("If-None-Match"))
+        etag = '"%s"' % _RevalidatedHandler.name
+        self.set_header("Etag", etag)
+        self.set_header("Cache-Control", "max-age=3600")
+        if self.request.headers.get("If-None-Match") == etag:
+            self.set_status(304)
+            self.finish()
+            return
+        path = os.path.join(os.path.dirname(__file__), "data",
+                            _RevalidatedHandler.name)
+        self.set_header("Content-Type", "image/jpeg")
+        with open(path, "rb") as f:
+            self.finish(f.read())
+
+    def compute_etag(self):
+        return None
+
+
 class _UserAgentHandler(tornado.web.RequestHandler):
 
     def get(self):
@@ -198,7 +409,7 @@ class _UserAgentHandler(tornado.web.RequestHandler):
 
 class AppTest(AsyncHTTPTestCase, _AppAsyncMixin):
     def get_app(self):
-        return _PilboxTestApplication(timeout=10.0)
+        return _PilboxTestApplication(stats=True, timeout=10.0)
 
     def test_missing_url(self):
         qs = urlencode(dict(w=1, h=1))
@@ -297,6 +508,12 @@ class AppTest(AsyncHTTPTestCase, _AppAsyncMixin):
         self.assertEqual(resp.get("error_code"),
                          errors.OptimizeError.get_code())
 
+    def test_invalid_profile(self):
+        qs = urlencode(dict(url="http://foo.co/x.jpg", w=1, h=1, profile="a"))
+        resp = self.fetch_error(400, "/?%s" % qs)
+        self.assertEqual(resp.get("error_code"),
+                         errors.ProfileError.get_code())
+
     def test_invalid_integer_quality(self):
         qs = urlencode(dict(url="http://foo.co/x.jpg", w=1, h=1, q="a"))
         resp = self.fetch_error(400, "/?%s" % qs)
@@ -354,6 +571,165 @@ class AppTest(AsyncHTTPTestCase, _AppAsyncMixin):
         with open(expected_path, "rb") as expected:
             self.assertEqual(resp.buffer.read(), expected.read(), msg)
 
+    def test_auto_format_accepts_webp(self):
+        url = self.get_url("/test/data/test1.jpg")
+        qs = urlencode(dict(url=url, w=100, h=100, fmt="auto"))
+        resp = self.fetch_success(
+            "/?%s" % qs, headers={"Accept": "image/webp,image/*,*/*;q=0.8"})
+        self.assertEqual(resp.headers.get("Content-Type"), "image/webp")
+        self.assertEqual(resp.headers.get("Vary"), "Accept")
+        self.assertEqual(PIL.Image.open(resp.buffer).format, "WEBP")
+
+    def test_auto_format_without_webp(self):
+        url = self.get_url("/test/data/test1.jpg")
+        qs = urlencode(dict(url=url, w=100, h=100, fmt="auto"))
+        resp = self.fetch_success(
+            "/?%s" % qs, headers={"Accept": "image/webp;q=0,image/*"})
+        self.assertEqual(resp.headers.get("Content-Type"), "image/jpeg")
+        self.assertEqual(resp.headers.get("Vary"), "Accept")
+
+    def test_auto_format_with_alpha(self):
+        url = self.get_url("/test/data/test-alpha1.png")
+        qs = urlencode(dict(url=url, w=100, h=100, fmt="auto"))
+        resp = self.fetch_success("/?%s" % qs)
+        self.assertEqual(resp.headers.get("Content-Type"), "image/png")
+        self.assertEqual(resp.headers.get("Vary"), "Accept")
+
+    def test_explicit_format_not_varied(self):
+        url = self.get_url("/test/data/test1.jpg")
+        qs = urlencode(dict(url=url, w=100, h=100, fmt="png"))
+        resp = self.fetch_success(
+            "/?%s" % qs, headers={"Accept": "image/webp"})
+        self.assertEqual(resp.headers.get("Content-Type"), "image/png")
+        self.assertIsNone(resp.headers.get("Vary"))
+
+    def test_auto_quality(self):
+        url = self.get_url("/test/data/test1.jpg")
+        qs = urlencode(dict(url=url, w=100, h=100, q="auto"))
+        resp = self.fetch_success("/?%s" % qs)
+        self.assertEqual(PIL.Image.open(resp.buffer).format, "JPEG")
+
+    def test_noop_streamed(self):
+        url = self.get_url("/test/data/test1.jpg")
+        qs = urlencode(dict(url=url, op="noop"))
+        resp = self.fetch_success("/?%s" % qs)
+        self.assertEqual(resp.headers.get("Content-Type"), "image/jpeg")
+        self.assertEqual(resp.headers.get("Transfer-Encoding"), "chunked")
+        self.assertTrue("Last-Modified" in resp.headers)
+
+    def test_noop_streamed_incrementally(self):
+        flushes = self.fetch_noop_slowly(
+            self.get_url("/test/data/test-bad-exif.jpg"), 0.0)[1]
+        self.assertGreater(flushes, 2)
+
+    def test_noop_slow_client(self):
+        size = ImageHandler.MAX_STREAM_BUFFER
+        ImageHandler.MAX_STREAM_BUFFER = 16 * 1024
+        try:
+            # The response is cut short rather than buffered
+            self.assertRaises(
+                HTTPStreamClosedError, self.fetch_noop_slowly,
+                self.get_url("/test/data/test-bad-exif.jpg"), 0.05)
+        finally:
+            ImageHandler.MAX_STREAM_BUFFER = size
+        # Nor is the url taken to be failing
+        self.assertEqual(len(self._app.negative_cache), 0)
+        self.assertEqual(self.fetch_noop_slowly(
+            self.get_url("/test/data/test-bad-exif.jpg"), 0.0)[0].code, 200)
+
+    def test_noop_not_found(self):
+        path = "/test/data/test-not-found.jpg"
+        qs = urlencode(dict(url=self.get_url(path), op="noop"))
+        resp = self.fetch_error(404, "/?%s" % qs)
+        self.assertEqual(resp.get("error_code"), errors.FetchError.get_code())
+
+    def test_info(self):
+        url = self.get_url("/test/data/test1.jpg")
+        qs = urlencode(dict(url=url))
+        resp = self.fetch_success("/info?%s" % qs)
+        self.assertEqual(resp.headers.get("Content-Type"), "application/json")
+        info = tornado.escape.json_decode(resp.body)
+        self.assertEqual(info["format"], "jpeg")
+        self.assertFalse(info["alpha"])
+        self.assertFalse(info["animated"])
+
+    def test_info_alpha(self):
+        url = self.get_url("/test/data/test-alpha1.png")
+        qs = urlencode(dict(url=url))
+        resp = self.fetch_success("/info?%s" % qs)
+        info = tornado.escape.json_decode(resp.body)
+        self.assertEqual(info["format"], "png")
+        self.assertTrue(info["alpha"])
+
+    def test_info_cached(self):
+        url = self.get_url("/test/data/test1.jpg")
+        self.fetch_success("/info?%s" % urlencode(dict(url=url)))
+        self.assertTrue(url in self._app.info_cache)
+
+    def test_info_not_found(self):
+        path = "/test/data/test-not-found.jpg"
+        qs = urlencode(dict(url=self.get_url(path)))
+        resp = self.fetch_error(404, "/info?%s" % qs)
+        self.assertEqual(resp.get("error_code"), errors.FetchError.get_code())
+
+    def test_fetch_error_cached(self):
+        for status in [404, 503]:
+            url = self.get_url("/test/data/test-failing.jpg?status=%d"
+                               % status)
+            qs = urlencode(dict(url=url, w=1, h=1))
+            _FailingHandler.requests = 0
+            for _ in range(3):
+                resp = self.fetch_error(404, "/?%s" % qs)
+                self.assertEqual(resp.get("error_code"),
+                                 errors.FetchError.get_code())
+            self.assertEqual(_FailingHandler.requests, 1)
+            self.assertEqual(self._app.negative_cache.get((url, None)),
+                             status)
+
+    def test_fetch_error_cached_per_range(self):
+        url = self.get_url("/test/data/test-unsatisfiable.jpg")
+        self.fetch_error(404, "/info?%s" % urlencode(dict(url=url)))
+        self.fetch_success("/?%s" % urlencode(dict(url=url, w=1, h=1)))
+        qs = urlencode(dict(url=self.get_url(
+            "/test/data/test-failing.jpg?status=403"), w=1, h=1))
+        _FailingHandler.requests = 0
+        for _ in range(2):
+            self.fetch_error(404, "/?%s" % qs)
+        self.assertEqual(_FailingHandler.requests, 2)
+
+    def test_stats(self):
+        resp = self.fetch("/stats")
+        self.assertEqual(resp.code, 200)
+        stats = tornado.escape.json_decode(resp.body)
+        self.assertEqual(stats["recycles"], dict())
+        self.assertEqual(len(stats["workers"]), 1)
+
+    def test_stats_not_counted(self):
+        supervisor = Supervisor(workers=1, max_requests=2)
+        supervisor._set(0, supervisor_module._STATE,
+                        supervisor_module._SERVING)
+        self._app.worker = Worker(supervisor, 0)
+        try:
+            for _ in range(3):
+                self.assertEqual(self.fetch("/stats").code, 200)
+            self.assertFalse(self._app.worker.draining)
+            stats = supervisor.get_stats()
+            self.assertEqual(stats["workers"][0]["requests"], 0)
+        finally:
+            self._app.worker = None
+
+    def test_stats_disabled(self):
+        self._app.settings["stats"] = False
+        self.assertEqual(self.fetch("/stats").code, 404)
+
+    def test_profile(self):
+        url = self.get_url("/test/data/test2.png")
+        sizes = dict()
+        for profile in ["fast", "smallest"]:
+            qs = urlencode(dict(url=url, w=100, h=100, profile=profile))
+            sizes[profile] = len(self.fetch_success("/?%s" % qs).body)
+        self.assertLess(sizes["smallest"], sizes["fast"])
+
     def test_valid_resize(self):
         cases = self.get_image_resize_cases()
         for case in cases:
@@ -381,7 +757,7 @@ class AppTest(AsyncHTTPTestCase, _AppAsyncMixin):
         for case in cases:
             self._assert_expected_case(case)
 
-    @unittest.skipIf(cv is None, "OpenCV is not installed")
+    @unittest.skipIf(cv2 is None, "OpenCV is not installed")
     def test_valid_face(self):
         cases = self.get_image_resize_cases()
         for case in cases:
@@ -400,6 +776,46 @@ class AppTest(AsyncHTTPTestCase, _AppAsyncMixin):
             self.assertEqual(resp.buffer.read(), expected.read(), msg)
 
 
+class AppAutoQualityTest(AsyncHTTPTestCase, _AppAsyncMixin):
+    def get_app(self):
+        return _PilboxTestApplication(quality="auto", target_size=4000)
+
+    def test_target_size(self):
+        url = self.get_url("/test/data/test1.jpg")
+        qs = urlencode(dict(url=url, w=200, h=200))
+        resp = self.fetch_success("/?%s" % qs)
+        self.assertLessEqual(len(resp.body), 4000)
+
+
+@unittest.skipIf(pyvips is None, "pyvips is not installed")
+class AppVipsTest(AsyncHTTPTestCase, _AppAsyncMixin):
+    def get_app(self):
+        return _PilboxTestApplication(backend="vips")
+
+    def test_resize(self):
+        url = self.get_url("/test/data/test1.jpg")
+        qs = urlencode(dict(url=url, w=200, h=100, mode="fill", bg="ccc"))
+        resp = self.fetch_success("/?%s" % qs)
+        self.assertEqual(resp.headers.get("Content-Type"), "image/jpeg")
+        self.assertEqual(PIL.Image.open(resp.buffer).size, (200, 100))
+
+    def test_content_type(self):
+        # The content type is that of the format saved as, not the source's
+        cases = [("test1.jpg", "png", None, "PNG"),
+                 ("test1.jpg", "webp", None, "WEBP"),
+                 ("test1.jpg", "auto", "image/webp", "WEBP"),
+                 ("test-alpha1.png", "auto", None, "PNG"),
+                 ("test2.png", "jpeg", None, "JPEG")]
+        for (name, fmt, accept, expected) in cases:
+            url = self.get_url("/test/data/%s" % name)
+            qs = urlencode(dict(url=url, w=100, h=100, fmt=fmt))
+            resp = self.fetch_success(
+                "/?%s" % qs, headers={"Accept": accept or "*/*"})
+            self.assertEqual(PIL.Image.open(resp.buffer).format, expected)
+            self.assertEqual(resp.headers.get("Content-Type"),
+                             "image/%s" % expected.lower())
+
+
 class AppImplicitBaseUrlTest(AsyncHTTPTestCase, _AppAsyncMixin):
     def get_app(self):
         return _PilboxTestApplication(
@@ -528,6 +944,16 @@ class AppRestrictedTest(AsyncHTTPTestCase, _AppAsyncMixin):
             allowed_hosts=["foo.co", "bar.io", "localhost", "127.0.0.1"],
             timeout=10.0)
 
+    def test_stats(self):
+        self._app.settings["stats"] = True
+        resp = self.fetch_error(403, "/stats?client=%s" % self.NAME)
+        self.assertEqual(resp.get("error_code"),
+                         errors.SignatureError.get_code())
+        qs = sign(self.KEY, urlencode(dict(client=self.NAME)))
+        resp = self.fetch_success("/stats?%s" % qs)
+        self.assertEqual(len(
+            tornado.escape.json_decode(resp.body)["workers"]), 1)
+
     def test_missing_client_name(self):
         params = dict(url="http://foo.co/x.jpg", w=1, h=1)
         qs = sign(self.KEY, urlencode(params))
@@ -575,6 +1001,598 @@ class AppRestrictedTest(AsyncHTTPTestCase, _AppAsyncMixin):
             with open(case["expected_path"], "rb") as expected:
                 self.assertEqual(resp.buffer.read(), expected.read(), msg)
 
+    def test_valid_v2(self):
+        params = dict(url=self.get_url("/test/data/test1.jpg"), w=1, h=1,
+                      client=self.NAME)
+        qs = sign(self.KEY, urlencode(params), 2,
+                  expires=time.time() + 3600)
+        self.fetch_success("/?%s" % qs)
+
+    def test_expired_signature(self):
+        params = dict(url="http://foo.co/x.jpg", w=1, h=1, client=self.NAME)
+        qs = sign(self.KEY, urlencode(params), 2, expires=time.time() - 1)
+        resp = self.fetch("/?%s" % qs)
+        self.assertEqual(resp.code, 403)
+        self.assertTrue(resp.headers.get("Cache-Control").startswith(
+            "public, max-age="))
+        body = tornado.escape.json_decode(resp.body)
+        self.assertEqual(body.get("error_code"),
+                         errors.SignatureExpiredError.get_code())
+
+
+class AppRotatedKeysTest(AsyncHTTPTestCase, _AppAsyncMixin):
+    def get_app(self):
+        return _PilboxTestApplication(
+            client_key="abcdef", client_keys=["ghijkl"], timeout=10.0)
+
+    def test_keys(self):
+        params = dict(url=self.get_url("/test/data/test1.jpg"), w=1, h=1)
+        for key in ["abcdef", "ghijkl"]:
+            for version in [1, 2]:
+                qs = sign(key, urlencode(params), version)
+                self.fetch_success("/?%s" % qs)
+        qs = sign("mnopqr", urlencode(params), 2)
+        resp = self.fetch_error(403, "/?%s" % qs)
+        self.assertEqual(resp.get("error_code"),
+                         errors.SignatureError.get_code())
+
+
+class AppNegativeCacheTest(AsyncHTTPTestCase, _AppAsyncMixin):
+    def get_app(self):
+        return _PilboxTestApplication(
+            negative_cache_ttl_4xx=0, negative_cache_ttl_5xx=0.01,
+            timeout=10.0)
+
+    def test_ttl(self):
+        for status in [404, 503]:
+            url = self.get_url("/test/data/test-failing.jpg?status=%d"
+                               % status)
+            qs = urlencode(dict(url=url, w=1, h=1))
+            _FailingHandler.requests = 0
+            self.fetch_error(404, "/?%s" % qs)
+            time.sleep(0.02)
+            self.fetch_error(404, "/?%s" % qs)
+            self.assertEqual(_FailingHandler.requests, 2)
+
+
+class AppCircuitBreakerTest(AsyncHTTPTestCase, _AppAsyncMixin):
+    def get_app(self):
+        return _PilboxTestApplication(
+            breaker_failures=2, breaker_reset=60, adaptive_timeout=True,
+            timeout=10.0)
+
+    def test_fails_fast(self):
+        _FailingHandler.requests = 0
+        for i in range(3):
+            url = self.get_url("/test/data/test-failing.jpg?status=503&i=%d"
+                               % i)
+            qs = urlencode(dict(url=url, w=1, h=1))
+            resp = self.fetch_error(404, "/?%s" % qs)
+            self.assertEqual(resp.get("error_code"),
+                             errors.FetchError.get_code())
+        self.assertEqual(_FailingHandler.requests, 2)
+
+    def test_client_errors(self):
+        _FailingHandler.requests = 0
+        for i in range(3):
+            url = self.get_url("/test/data/test-failing.jpg?status=404&i=%d"
+                               % i)
+            qs = urlencode(dict(url=url, w=1, h=1))
+            self.fetch_error(404, "/?%s" % qs)
+        self.assertEqual(_FailingHandler.requests, 3)
+
+    def test_adaptive_timeout(self):
+        url = self.get_url("/test/data/test1.jpg")
+        for _ in range(HostHealth.MIN_SAMPLES):
+            self.fetch_success("/?%s" % urlencode(dict(url=url, op="noop")))
+        health = self._app.health.get(urlparse(url).netloc)
+        self.assertLess(health.get_timeout(10.0), 10.0)
+
+
+class AppRetryTest(AsyncHTTPTestCase, _AppAsyncMixin):
+    def get_app(self):
+        return _PilboxTestApplication(
+            hedge=True, retries=2, retry_backoff=0.001, retry_budget=1.0,
+            timeout=10.0)
+
+    def test_retries(self):
+        sock, port = bind_unused_port()
+        sock.close()
+        url = "http://127.0.0.1:%d/x.jpg" % port
+        qs = urlencode(dict(url=url, w=1, h=1))
+        resp = self.fetch_error(404, "/?%s" % qs)
+        self.assertEqual(resp.get("error_code"), errors.FetchError.get_code())
+        health = self._app.health.get("127.0.0.1:%d" % port)
+        self.assertEqual(health.consecutive_failures, 3)
+
+    def test_hedge(self):
+        url = self.get_url("/test/data/test-slow-once.jpg?delay=0.5")
+        health = self._app.health.get(urlparse(url).netloc)
+        for _ in range(HostHealth.MIN_SAMPLES):
+            health.record_first_byte(0.01)
+        _SlowOnceHandler.requests = 0
+        start = time.time()
+        self.fetch_success("/?%s" % urlencode(dict(url=url, w=1, h=1)))
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(_SlowOnceHandler.requests, 2)
+        # Let the slow request finish before the server is stopped
+        self.io_loop.call_later(0.5, self.stop)
+        self.wait()
+
+
+class AppOriginTest(AsyncHTTPTestCase, _AppAsyncMixin):
+    def get_app(self):
+        sock, port = bind_unused_port()
+        sock.close()
+        return _PilboxTestApplication(
+            origins=["images=http://127.0.0.1:%d/" % port,
+                     "images=%s" % self.get_url("/test/data/")],
+            allowed_hosts=["foo.co"], retries=0, timeout=10.0)
+
+    def test_failover(self):
+        # Exploring could try the working mirror first, or last
+        explore, OriginGroup.EXPLORE = OriginGroup.EXPLORE, 0
+        try:
+            qs = urlencode(dict(origin="images", url="test1.jpg", op="noop"))
+            resp = self.fetch_success("/?%s" % qs)
+            with open(os.path.join(os.path.dirname(__file__), "data",
+                                   "test1.jpg"), "rb") as f:
+                self.assertEqual(resp.body, f.read())
+            # The failed mirror is now the slowest, so it is tried last
+            urls = self._app.origins["images"].get_urls("test1.jpg")
+        finally:
+            OriginGroup.EXPLORE = explore
+        self.assertEqual(urls[0], self.get_url("/test/data/test1.jpg"))
+
+    def test_failover_unavailable(self):
+        # A mirror that responds with an error is failed over, whether or
+        # not the response is streamed
+        self._app.origins["images"].bases.insert(
+            0, self.get_url("/test/unavailable/"))
+        with open(os.path.join(os.path.dirname(__file__), "data",
+                               "test1.jpg"), "rb") as f:
+            expected = f.read()
+        _UnavailableHandler.requests = 0
+        explore, OriginGroup.EXPLORE = OriginGroup.EXPLORE, 0
+        try:
+            qs = urlencode(dict(origin="images", url="test1.jpg", op="noop"))
+            resp = self.fetch_success("/?%s" % qs)
+            self.assertEqual(resp.body, expected)
+            self.assertEqual(_UnavailableHandler.requests, 1)
+            qs = urlencode(dict(origin="images", url="test1.jpg", w=10, h=10))
+            resp = self.fetch_success("/?%s" % qs)
+            self.assertEqual(PIL.Image.open(resp.buffer).size, (10, 10))
+        finally:
+            OriginGroup.EXPLORE = explore
+
+    def test_not_found(self):
+        qs = urlencode(dict(origin="images", url="x.jpg", w=1, h=1))
+        resp = self.fetch_error(404, "/?%s" % qs)
+        self.assertEqual(resp.get("error_code"), errors.FetchError.get_code())
+
+    def test_unknown_origin(self):
+        qs = urlencode(dict(origin="videos", url="test1.jpg", w=1, h=1))
+        resp = self.fetch_error(400, "/?%s" % qs)
+        self.assertEqual(resp.get("error_code"), errors.UrlError.get_code())
+
+    def test_absolute_url(self):
+        url = self.get_url("/test/data/test1.jpg")
+        qs = urlencode(dict(origin="images", url=url, w=1, h=1))
+        resp = self.fetch_error(400, "/?%s" % qs)
+        self.assertEqual(resp.get("error_code"), errors.UrlError.get_code())
+
+
+class AppFileSourceTest(AsyncHTTPTestCase, _AppAsyncMixin):
+    def get_app(self):
+        self.root = os.path.join(os.path.dirname(__file__), "data")
+        return _PilboxTestApplication(
+            file_root=self.root, allowed_hosts=["foo.co"], timeout=10.0)
+
+    def test_resize(self):
+        qs = urlencode(dict(url="file:///test1.jpg", w=10, h=10))
+        resp = self.fetch_success("/?%s" % qs)
+        self.assertEqual(resp.headers.get("Content-Type"), "image/jpeg")
+        self.assertTrue(resp.headers.get("Last-Modified"))
+        img = PIL.Image.open(BytesIO(resp.body))
+        self.assertEqual(img.size, (10, 10))
+
+    def test_noop(self):
+        qs = urlencode(dict(url="file:///test1.jpg", op="noop"))
+        resp = self.fetch_success("/?%s" % qs)
+        with open(os.path.join(self.root, "test1.jpg"), "rb") as f:
+            self.assertEqual(resp.body, f.read())
+
+    def test_noop_waits_for_client(self):
+        # Each block is sent to the client before the next is read
+        _, flushes, most = self.fetch_noop_slowly(
+            "file:///test-bad-exif.jpg", 0.01)
+        self.assertGreater(flushes, 2)
+        self.assertEqual(most, 1)
+
+    def test_not_modified(self):
+        qs = urlencode(dict(url="file:///test1.jpg", w=10, h=10))
+        etag = self.fetch_success("/?%s" % qs).headers.get("Etag")
+        self.assertTrue(etag)
+        resp = self.fetch("/?%s" % qs, headers={"If-None-Match": etag})
+        self.assertEqual(resp.code, 304)
+        qs = urlencode(dict(url="file:///test1.jpg", w=20, h=20))
+        resp = self.fetch("/?%s" % qs, headers={"If-None-Match": etag})
+        self.assertEqual(resp.code, 200)
+
+    def test_info(self):
+        qs = urlencode(dict(url="file:///test-alpha1.png"))
+        resp = self.fetch_success("/info?%s" % qs)
+        info = tornado.escape.json_decode(resp.body)
+        self.assertEqual(info["format"], "png")
+
+    def test_not_found(self):
+        qs = urlencode(dict(url="file:///x.jpg", w=10, h=10))
+        resp = self.fetch_error(404, "/?%s" % qs)
+        self.assertEqual(resp.get("error_code"), errors.FetchError.get_code())
+
+    def test_traversal(self):
+        qs = urlencode(dict(url="file:///../app_test.py", w=10, h=10))
+        resp = self.fetch_error(400, "/?%s" % qs)
+        self.assertEqual(resp.get("error_code"), errors.UrlError.get_code())
+
+
+class AppS3SourceTest(AsyncHTTPTestCase, _AppAsyncMixin):
+    def get_app(self):
+        return _PilboxTestApplication(
+            s3_endpoint=self.get_url("/test/s3"), s3_access_key="abc",
+            s3_secret_key="def", s3_part_size=10000, s3_parallel=2,
+            timeout=10.0)
+
+    def test_parts(self):
+        _ObjectStoreHandler.requests = []
+        qs = urlencode(dict(url="s3://bucket/test1.jpg", op="noop"))
+        resp = self.fetch_success("/?%s" % qs)
+        with open(os.path.join(os.path.dirname(__file__), "data",
+                               "test1.jpg"), "rb") as f:
+            data = f.read()
+        self.assertEqual(resp.body, data)
+        parts = (len(data) + 9999) // 10000
+        self.assertEqual(len(_ObjectStoreHandler.requests), parts)
+        self.assertEqual(
+            sorted(_ObjectStoreHandler.requests),
+            sorted("bytes=%d-%d" % (i, min(i + 9999, len(data) - 1))
+                   for i in range(0, len(data), 10000)))
+
+    def test_resize(self):
+        qs = urlencode(dict(url="s3://bucket/test1.jpg", w=10, h=10))
+        resp = self.fetch_success("/?%s" % qs)
+        self.assertEqual(PIL.Image.open(BytesIO(resp.body)).size, (10, 10))
+
+    def test_info(self):
+        _ObjectStoreHandler.requests = []
+        qs = urlencode(dict(url="s3://bucket/test1.jpg"))
+        resp = self.fetch_success("/info?%s" % qs)
+        info = tornado.escape.json_decode(resp.body)
+        self.assertEqual(info["format"], "jpeg")
+        self.assertEqual(_ObjectStoreHandler.requests,
+                         ["bytes=0-%d" % (InfoHandler.RANGE_SIZE - 1)])
+
+    def test_info_gif(self):
+        # The start of a GIF only suffices if it includes the end of the
+        # first frame
+        for (name, whole) in [("test-p-mode.gif", False), ("test5.gif", True)]:
+            _ObjectStoreHandler.requests = []
+            qs = urlencode(dict(url="s3://bucket/%s" % name))
+            resp = self.fetch_success("/info?%s" % qs)
+            info = tornado.escape.json_decode(resp.body)
+            self.assertEqual(info["format"], "gif")
+            self.assertFalse(info["animated"])
+            self.assertEqual(len(_ObjectStoreHandler.requests) > 1, whole)
+
+    def test_not_found(self):
+        qs = urlencode(dict(url="s3://bucket/x.jpg", w=10, h=10))
+        resp = self.fetch_error(404, "/?%s" % qs)
+        self.assertEqual(resp.get("error_code"), errors.FetchError.get_code())
+
+    def test_bad_credentials(self):
+        self._app.sources["s3"].secret_key = "ghi"
+        self._app.sources["s3"]._signing_keys = dict()
+        qs = urlencode(dict(url="s3://bucket/test1.jpg", w=10, h=10))
+        self.fetch_error(404, "/?%s" % qs)
+
+
+class _ResultStoreMixin(object):
+    def wait_for_results(self, count):
+        """Waits for the write through of count results"""
+        for _ in range(100):
+            if len(self.get_results()) >= count:
+                return
+            self.io_loop.run_sync(lambda: tornado.gen.sleep(0.01))
+        self.fail("Result not stored")
+
+    def get_results(self):
+        return [os.path.relpath(os.path.join(d, f), self.root)
+                for (d, _, files) in os.walk(self.root) for f in files]
+
+
+class AppFileResultStoreTest(AsyncHTTPTestCase, _AppAsyncMixin,
+                             _ResultStoreMixin):
+    def get_app(self):
+        self.root = tempfile.mkdtemp()
+        return _PilboxTestApplication(
+            result_store="file://%s" % self.root,
+            result_url="http://cdn.foo.co/results", timeout=10.0)
+
+    def tearDown(self):
+        super(AppFileResultStoreTest, self).tearDown()
+        shutil.rmtree(self.root)
+
+    def test_write_through(self):
+        qs = urlencode(dict(url=self.get_url("/test/data/test1.jpg"),
+                            w=10, h=10))
+        resp = self.fetch_success("/?%s" % qs)
+        self.wait_for_results(1)
+        resp = self.fetch("/?%s" % qs, follow_redirects=False)
+        self.assertEqual(resp.code, 302)
+        location = resp.headers["Location"]
+        self.assertTrue(location.startswith("http://cdn.foo.co/results/"))
+        self.assertTrue(location.endswith(".jpeg"))
+        name = location[len("http://cdn.foo.co/results/"):]
+        with open(os.path.join(self.root, name), "rb") as f:
+            self.assertEqual(f.read(), self.fetch_success(
+                "/?%s&fmt=jpeg" % qs).body)
+
+    def test_equivalent_requests(self):
+        url = self.get_url("/test/data/test1.jpg")
+        self.fetch_success("/?%s" % urlencode(dict(url=url, w=10, h=10)))
+        self.wait_for_results(1)
+        qs = urlencode(dict(url=url, w=10, h=10, op="resize"))
+        resp = self.fetch("/?%s" % qs, follow_redirects=False)
+        self.assertEqual(resp.code, 302)
+        qs = urlencode(dict(url=url, w=20, h=10))
+        self.fetch_success("/?%s" % qs)
+
+    def test_private_not_stored(self):
+        qs = urlencode(dict(url=self.get_url("/test/data/test-private.jpg"),
+                            w=10, h=10))
+        self.fetch_success("/?%s" % qs)
+        self.fetch_success("/?%s" % urlencode(
+            dict(url=self.get_url("/test/data/test1.jpg"), w=10, h=10)))
+        self.wait_for_results(1)
+        self.assertEqual(len(self.get_results()), 1)
+        resp = self.fetch("/?%s" % qs, follow_redirects=False)
+        self.assertEqual(resp.code, 200)
+
+    def test_auto_format(self):
+        url = self.get_url("/test/data/test1.jpg")
+        qs = urlencode(dict(url=url, w=10, h=10, fmt="auto"))
+        headers = {"Accept": "image/webp"}
+        self.assertEqual(self.fetch("/?%s" % qs, headers=headers).code, 200)
+        self.assertEqual(self.fetch("/?%s" % qs).code, 200)
+        self.wait_for_results(2)
+        resp = self.fetch("/?%s" % qs, headers=headers,
+                          follow_redirects=False)
+        self.assertEqual(resp.code, 302)
+        self.assertTrue(resp.headers["Location"].endswith(".webp"))
+        self.assertEqual(resp.headers.get("Vary"), "Accept")
+
+
+class AppAccelResultStoreTest(AsyncHTTPTestCase, _AppAsyncMixin,
+                              _ResultStoreMixin):
+    def get_app(self):
+        self.root = tempfile.mkdtemp()
+        return _PilboxTestApplication(
+            result_store="file://%s" % self.root, result_accel="/results/",
+            timeout=10.0)
+
+    def tearDown(self):
+        super(AppAccelResultStoreTest, self).tearDown()
+        shutil.rmtree(self.root)
+
+    def test_accel_redirect(self):
+        qs = urlencode(dict(url=self.get_url("/test/data/test1.jpg"),
+                            w=10, h=10))
+        self.fetch_success("/?%s" % qs)
+        self.wait_for_results(1)
+        resp = self.fetch_success("/?%s" % qs)
+        self.assertEqual(resp.body, b"")
+        self.assertTrue(re.match(r"/results/[0-9a-f]{2}/[0-9a-f]{64}\.jpeg$",
+                                 resp.headers["X-Accel-Redirect"]))
+
+
+class AppS3ResultStoreTest(AsyncHTTPTestCase, _AppAsyncMixin,
+                           _ResultStoreMixin):
+    def get_app(self):
+        return _PilboxTestApplication(
+            s3_endpoint=self.get_url("/test/s3"), s3_access_key="abc",
+            s3_secret_key="def", result_store="s3://results/pilbox",
+            result_url="http://cdn.foo.co", timeout=10.0)
+
+    def get_results(self):
+        return list(_ObjectStoreHandler.objects)
+
+    def test_write_through(self):
+        _ObjectStoreHandler.objects = dict()
+        qs = urlencode(dict(url="s3://bucket/test1.jpg", w=10, h=10))
+        self.fetch_success("/?%s" % qs)
+        self.wait_for_results(1)
+        self.assertEqual(len(_ObjectStoreHandler.objects), 1)
+        (key, (content_type, data)), = _ObjectStoreHandler.objects.items()
+        self.assertTrue(key.startswith("pilbox/"))
+        self.assertEqual(content_type, "image/jpeg")
+        self.assertEqual(PIL.Image.open(BytesIO(data)).size, (10, 10))
+
+        # Found by a HEAD request once no longer remembered
+        self._app.result_store._names = LRUCache(10)
+        resp = self.fetch("/?%s" % qs, follow_redirects=False)
+        self.assertEqual(resp.code, 302)
+        self.assertEqual(resp.headers["Location"], "http://cdn.foo.co/" + key)
+
+
+class AppRenderCacheTest(AsyncHTTPTestCase, _AppAsyncMixin):
+    def get_app(self):
+        return _PilboxTestApplication(
+            render_cache_size=1, render_cache_ttl=60, render_cache_stale=30,
+            stats=True, timeout=10.0)
+
+    def setUp(self):
+        super(AppRenderCacheTest, self).setUp()
+        _RevalidatedHandler.name = "test1.jpg"
+        _RevalidatedHandler.requests = []
+        self.qs = urlencode(dict(
+            url=self.get_url("/test/data/test-revalidated.jpg"), w=10, h=10))
+
+    def wait_for_refresh(self):
+        cache = self._app.render_cache
+        for _ in range(100):
+            if not cache.get_stats()["refreshing"]:
+                return
+            self.io_loop.run_sync(lambda: tornado.gen.sleep(0.01))
+        self.fail("Refresh not finished")
+
+    def wait_until_stale(self):
+        # Renewed as if rendered a ttl ago
+        cache = self._app.render_cache
+        for key in list(cache._entries):
+            cache.renew(key, now=time.time() - cache.ttl)
+
+    def test_cached(self):
+        resp = self.fetch_success("/?%s" % self.qs)
+        self.assertEqual(resp.headers["Cache-Control"],
+                         "public, max-age=60, stale-while-revalidate=30")
+        body = resp.body
+        resp = self.fetch_success("/?%s" % self.qs)
+        self.assertEqual(resp.body, body)
+        self.assertEqual(resp.headers["Content-Type"], "image/jpeg")
+        self.assertEqual(_RevalidatedHandler.requests, [None])
+
+    def test_stale_unchanged(self):
+        body = self.fetch_success("/?%s" % self.qs).body
+        self.wait_until_stale()
+        resp = self.fetch_success("/?%s" % self.qs)
+        self.assertEqual(resp.body, body)
+        self.wait_for_refresh()
+        self.assertEqual(_RevalidatedHandler.requests, [None, '"test1.jpg"'])
+        stats = self._app.render_cache.get_stats()
+        self.assertEqual(stats["refreshes_unchanged"], 1)
+        self.assertEqual(stats["stale_hits"], 1)
+
+    def test_stale_changed(self):
+        body = self.fetch_success("/?%s" % self.qs).body
+        _RevalidatedHandler.name = "test3.jpg"
+        self.wait_until_stale()
+        self.assertEqual(self.fetch_success("/?%s" % self.qs).body, body)
+        self.wait_for_refresh()
+        self.assertEqual(self._app.render_cache.get_stats()[
+            "refreshes_changed"], 1)
+        resp = self.fetch_success("/?%s" % self.qs)
+        self.assertNotEqual(resp.body, body)
+        self.assertEqual(PIL.Image.open(BytesIO(resp.body)).size, (10, 10))
+        self.assertEqual(len(_RevalidatedHandler.requests), 2)
+
+    def test_stats(self):
+        self.fetch_success("/?%s" % self.qs)
+        self.fetch_success("/?%s" % self.qs)
+        stats = tornado.escape.json_decode(self.fetch("/stats").body)
+        self.assertEqual(stats["render_cache"]["entries"], 1)
+        self.assertEqual(stats["render_cache"]["hits"], 1)
+
+
+class AppSharedCacheTest(AsyncHTTPTestCase, _AppAsyncMixin):
+    def get_app(self):
+        return _PilboxTestApplication(
+            shared_cache_size=1, shared_cache_stripes=2, stats=True,
+            timeout=10.0)
+
+    def setUp(self):
+        super(AppSharedCacheTest, self).setUp()
+        _RevalidatedHandler.name = "test1.jpg"
+        _RevalidatedHandler.requests = []
+        self.url = self.get_url("/test/data/test-revalidated.jpg")
+
+    def test_render_cached(self):
+        qs = urlencode(dict(url=self.url, w=10, h=10))
+        body = self.fetch_success("/?%s" % qs).body
+        self.assertEqual(self.fetch_success("/?%s" % qs).body, body)
+        self.assertEqual(len(_RevalidatedHandler.requests), 1)
+
+    def test_source_cached(self):
+        self.fetch_success("/?%s" % urlencode(dict(url=self.url, w=10, h=10)))
+        resp = self.fetch_success(
+            "/?%s" % urlencode(dict(url=self.url, w=20, h=10)))
+        self.assertEqual(PIL.Image.open(BytesIO(resp.body)).size, (20, 10))
+        self.assertEqual(resp.headers["Content-Type"], "image/jpeg")
+        self.assertEqual(len(_RevalidatedHandler.requests), 1)
+
+    def test_stats(self):
+        qs = urlencode(dict(url=self.url, w=10, h=10))
+        self.fetch_success("/?%s" % qs)
+        self.fetch_success("/?%s" % qs)
+        stats = tornado.escape.json_decode(self.fetch("/stats").body)
+        self.assertEqual(stats["shared_cache"]["items"], 2)
+        self.assertEqual(stats["render_cache"]["hits"], 1)
+
+
+class AppPeerTest(AsyncHTTPTestCase, _AppAsyncMixin):
+    def get_app(self):
+        sock, port = bind_unused_port()
+        self.peer_sock = sock
+        self.peers = ["http://127.0.0.1:%d" % self.get_http_port(),
+                      "http://127.0.0.1:%d" % port]
+        return _PilboxTestApplication(
+            peers=self.peers, peer_self=self.peers[0], peer_hash="source",
+            breaker_failures=0, timeout=10.0)
+
+    def setUp(self):
+        super(AppPeerTest, self).setUp()
+        self.peer_app = _PilboxTestApplication(
+            peers=self.peers, peer_self=self.peers[1], peer_hash="source",
+            render_cache_size=1, timeout=10.0)
+        self.peer_server = tornado.httpserver.HTTPServer(self.peer_app)
+        self.peer_server.add_sockets([self.peer_sock])
+
+    def tearDown(self):
+        self.peer_server.stop()
+        super(AppPeerTest, self).tearDown()
+
+    def get_url_of(self, peer, path="test1.jpg"):
+        """Returns a url of the test image owned by the peer"""
+        for i in range(100):
+            url = self.get_url("/test/data/%s?v=%d" % (path, i))
+            if self._app.peers.get(url) == peer:
+                return url
+        self.fail("No url owned by %s" % peer)
+
+    def get_peer_renders(self):
+        return self.peer_app.render_cache.get_stats()["misses"]
+
+    def test_forward(self):
+        qs = urlencode(dict(url=self.get_url_of(self.peers[1]), w=10, h=10))
+        resp = self.fetch_success("/?%s" % qs)
+        self.assertEqual(resp.headers["Content-Type"], "image/jpeg")
+        self.assertEqual(PIL.Image.open(BytesIO(resp.body)).size, (10, 10))
+        self.assertEqual(self.get_peer_renders(), 1)
+
+    def test_local(self):
+        qs = urlencode(dict(url=self.get_url_of(self.peers[0]), w=10, h=10))
+        self.fetch_success("/?%s" % qs)
+        self.assertEqual(self.get_peer_renders(), 0)
+
+    def test_forwarded_once(self):
+        qs = urlencode(dict(url=self.get_url_of(self.peers[1]), w=10, h=10))
+        self.fetch_success("/?%s" % qs,
+                           headers={"X-Pilbox-Peer": self.peers[1]})
+        self.assertEqual(self.get_peer_renders(), 0)
+
+    def test_peer_error(self):
+        url = self.get_url_of(self.peers[1], "x.jpg")
+        resp = self.fetch_error(404, "/?%s" % urlencode(
+            dict(url=url, w=10, h=10)))
+        self.assertEqual(resp.get("error_code"), errors.FetchError.get_code())
+        self.assertEqual(self.get_peer_renders(), 1)
+
+    def test_peer_failure(self):
+        self.peer_server.stop()
+        self.peer_sock.close()
+        qs = urlencode(dict(url=self.get_url_of(self.peers[1]), w=10, h=10))
+        resp = self.fetch_success("/?%s" % qs)
+        self.assertEqual(PIL.Image.open(BytesIO(resp.body)).size, (10, 10))
+
 
 class AppSlowTest(AsyncHTTPTestCase, _AppAsyncMixin):
     def get_app(self):
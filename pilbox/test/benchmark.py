@@ -0,0 +1,103 @@
+"""Measures the memory allocated to render images, e.g.
+
+    $ python -m pilbox.test.benchmark --requests=500 --pool=16 --blocks=4
+
+Python allocations are traced with tracemalloc, which does not see the
+image memory allocated by Pillow, so the growth of the resident set size
+is reported as well. Use --pool=0 to render into a new BytesIO per
+request.
+"""
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import os.path
+import resource
+import sys
+import time
+import tracemalloc
+
+from tornado.options import define, options, parse_command_line
+
+from pilbox import image as image_module
+from pilbox.image import Image
+from pilbox.pool import BufferPool
+
+try:
+    from io import BytesIO
+except ImportError:
+    from cStringIO import StringIO as BytesIO
+
+DATADIR = os.path.join(os.path.dirname(__file__), "data")
+
+CASES = [
+    ("example.jpg", dict(width=500, height=400, mode="crop"), dict()),
+    ("example.jpg", dict(width=500, height=400, mode="clip"),
+     dict(format="webp")),
+    ("test-alpha1.png", dict(width=300, height=300, mode="fill",
+                             background="ccc"), dict(format="jpeg")),
+    ("test2.png", dict(width=300, height=300, mode="fill"), dict())]
+
+
+def render(data, resize, save):
+    img = Image(BytesIO(data)).resize(resize.pop("width"),
+                                      resize.pop("height"), **resize)
+    outfile = img.save(**save)
+    outfile.getvalue()  # As written to the client
+    outfile.close()
+
+
+def measure(requests):
+    """Returns the mean peak of traced bytes allocated per request, the
+    traced bytes retained and the resident set growth in KB.
+    """
+    data = []
+    for (filename, resize, save) in CASES:
+        with open(os.path.join(DATADIR, filename), "rb") as f:
+            data.append((f.read(), resize, save))
+    for (source, resize, save) in data:
+        render(source, dict(resize), dict(save))  # Warm up
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    peaks = 0
+    for i in range(requests):
+        (source, resize, save) = data[i % len(data)]
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        render(source, dict(resize), dict(save))
+        peaks += tracemalloc.get_traced_memory()[1] - current
+    retained = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    return (peaks // requests, retained, growth)
+
+
+def main():
+    define("requests", help="the number of requests to render", type=int,
+           default=500)
+    define("pool", help="the number of pooled buffers (0 = none)",
+           type=int, default=16)
+    define("blocks", help="the number of image memory blocks to reuse",
+           type=int, default=0)
+    parse_command_line()
+    if not hasattr(tracemalloc, "reset_peak"):
+        print("Python 3.9 or later is required")
+        sys.exit(1)
+
+    image_module.set_buffer_pool(
+        BufferPool(options.pool) if options.pool else None)
+    image_module.set_block_cache_size(options.blocks)
+    started = time.time()
+    peak, retained, growth = measure(options.requests)
+    print("Requests: %d" % options.requests)
+    print("Seconds per request: %.4f"
+          % ((time.time() - started) / options.requests))
+    print("Bytes allocated per request: %d" % peak)
+    print("Bytes retained: %d" % retained)
+    print("RSS growth: %d KB" % growth)
+
+
+if __name__ == "__main__":
+    main()
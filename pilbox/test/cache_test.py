@@ -0,0 +1,120 @@
+from __future__ import absolute_import, division, with_statement
+
+import os
+import time
+
+from tornado.test.util import unittest
+
+from pilbox.cache import FRESH, LRUCache, RenderCache, SharedRenderCache, \
+    STALE
+from pilbox.shm import SharedCache
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_get_set(self):
+        cache = LRUCache(2)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("a", 1), 1)
+        cache.set("a", 2)
+        self.assertEqual(cache.get("a"), 2)
+        self.assertTrue("a" in cache)
+        self.assertEqual(len(cache), 1)
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        self.assertTrue("a" in cache)
+        self.assertFalse("b" in cache)
+        self.assertTrue("c" in cache)
+
+    def test_delete_and_clear(self):
+        cache = LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.delete("a")
+        self.assertFalse("a" in cache)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_ttl(self):
+        cache = LRUCache(2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2, ttl=0.01)
+        time.sleep(0.02)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertFalse("b" in cache)
+
+
+class RenderCacheTest(unittest.TestCase):
+
+    def test_fresh_and_stale(self):
+        cache = RenderCache(100, 10, 5)
+        self.assertIsNone(cache.get("a", now=0))
+        cache.set("a", "x", 10, now=0)
+        self.assertEqual(cache.get("a", now=4), ("x", FRESH, 6))
+        self.assertEqual(cache.get("a", now=12), ("x", STALE, 0))
+        self.assertIsNone(cache.get("a", now=15))
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+        stats = cache.get_stats()
+        self.assertEqual((stats["hits"], stats["stale_hits"],
+                          stats["misses"]), (1, 1, 2))
+
+    def test_renew(self):
+        cache = RenderCache(100, 10, 5)
+        cache.set("a", "x", 10, now=0)
+        cache.renew("a", now=12)
+        self.assertEqual(cache.get("a", now=13), ("x", FRESH, 9))
+
+    def test_evicts_by_size(self):
+        cache = RenderCache(100, 10)
+        cache.set("a", "x", 60, now=0)
+        cache.set("b", "y", 30, now=0)
+        cache.get("a", now=0)
+        cache.set("c", "z", 30, now=0)
+        self.assertIsNotNone(cache.get("a", now=0))
+        self.assertIsNone(cache.get("b", now=0))
+        self.assertEqual(cache.size, 90)
+        cache.set("d", "w", 101, now=0)
+        self.assertIsNone(cache.get("d", now=0))
+        self.assertEqual(cache.size, 90)
+
+    def test_single_refresh(self):
+        cache = RenderCache(100, 10)
+        self.assertTrue(cache.begin_refresh("a"))
+        self.assertFalse(cache.begin_refresh("a"))
+        self.assertTrue(cache.begin_refresh("b"))
+        self.assertEqual(cache.get_stats()["refreshing"], 2)
+        cache.end_refresh("a", "unchanged")
+        cache.end_refresh("b", "error")
+        self.assertTrue(cache.begin_refresh("a"))
+        stats = cache.get_stats()
+        self.assertEqual((stats["refreshes"], stats["refreshes_unchanged"],
+                          stats["refresh_errors"]), (3, 1, 1))
+
+
+class SharedRenderCacheTest(unittest.TestCase):
+
+    @unittest.skipIf(not hasattr(os, "fork"), "fork is not supported")
+    def test_single_refresh_across_workers(self):
+        shared = SharedCache(64 * 1024, stripes=1, page_size=16 * 1024)
+        cache = SharedRenderCache(shared, 10)
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if cache.begin_refresh("a") else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+        self.assertFalse(cache.begin_refresh("a"))
+        self.assertTrue(cache.begin_refresh("b"))
+        cache.end_refresh("b", "unchanged")
+        # Another worker's refresh ends, or its marker expires
+        shared.delete(SharedRenderCache.REFRESH_PREFIX + "a")
+        self.assertTrue(cache.begin_refresh("a"))
+        self.assertTrue(shared.set(
+            SharedRenderCache.REFRESH_PREFIX + "c", b"", 1, now=0))
+        self.assertTrue(cache.begin_refresh("c"))
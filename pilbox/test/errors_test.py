@@ -8,12 +8,13 @@ from pilbox.errors import *
 class ErrorsTest(unittest.TestCase):
 
     def test_unique_error_codes(self):
-        errors = [SignatureError, ClientError, HostError, BackgroundError,
-                  DimensionsError, FilterError, FormatError, ModeError,
-                  OptimizeError, PositionError, PreserveExifError,
-                  ProgressiveError, QualityError, UrlError, ImageFormatError,
-                  ImageSaveError, FetchError, DegreeError, OperationError,
-                  RectangleError, RetainError]
+        errors = [SignatureError, SignatureExpiredError, ClientError,
+                  HostError, BackgroundError, DimensionsError, FilterError,
+                  FormatError, ModeError, OptimizeError, PositionError,
+                  PreserveExifError, ProgressiveError, QualityError, UrlError,
+                  ImageFormatError, ImageSaveError, FetchError, DegreeError,
+                  OperationError, RectangleError, RetainError,
+                  ImageFramesError]
         codes = []
         for error in errors:
             code = str(error.get_code())
@@ -0,0 +1,92 @@
+from __future__ import absolute_import, division, with_statement
+
+import os
+import os.path
+import shutil
+import sqlite3
+import tempfile
+import time
+
+from tornado.test.util import unittest
+
+from pilbox import image as image_module
+from pilbox.focalpoint import FocalPointStore
+from pilbox.image import Image, set_focal_point_store
+from pilbox.test.image_test import DATADIR
+
+
+class FocalPointStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "points.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_set(self):
+        store = FocalPointStore(self.path)
+        self.assertIsNone(store.get("abc"))
+        store.set("abc", (0.25, 0.75))
+        self.assertEqual(store.get("abc"), (0.25, 0.75))
+
+    def test_persists_across_instances(self):
+        FocalPointStore(self.path).set("abc", (0.1, 0.2))
+        self.assertEqual(FocalPointStore(self.path).get("abc"), (0.1, 0.2))
+
+    def test_load(self):
+        store = FocalPointStore(self.path)
+        store.load([("a", "0.1", "0.2"), ("b", 0.3, 0.4)])
+        self.assertEqual(store.get("a"), (0.1, 0.2))
+        self.assertEqual(store.get("b"), (0.3, 0.4))
+
+    def test_bounded(self):
+        store = FocalPointStore(self.path, maxsize=5)
+        store.load([(str(i), 0.5, 0.5) for i in range(3)])
+        store.get("0")
+        store.load([(str(i), 0.5, 0.5)
+                    for i in range(3, FocalPointStore._PRUNE_INTERVAL)])
+        self.assertIsNone(store.get("1"))
+        self.assertIsNotNone(store.get(
+            str(FocalPointStore._PRUNE_INTERVAL - 1)))
+
+    def test_get_does_not_write(self):
+        store = FocalPointStore(self.path)
+        store.set("abc", (0.25, 0.75))
+        other = sqlite3.connect(self.path)
+        other.execute("BEGIN IMMEDIATE")
+        try:
+            start = time.time()
+            self.assertEqual(store.get("abc"), (0.25, 0.75))
+            self.assertLess(time.time() - start, 1.0)
+        finally:
+            other.rollback()
+            other.close()
+        accessed = store._accessed["abc"]
+        store.load([(str(i), 0.5, 0.5)
+                    for i in range(FocalPointStore._PRUNE_INTERVAL)])
+        self.assertEqual(store._accessed, dict())
+        row = sqlite3.connect(self.path).execute(
+            "SELECT accessed FROM points WHERE key = 'abc'").fetchone()
+        self.assertEqual(row[0], accessed)
+
+    def test_crop_uses_stored_point(self):
+        store = FocalPointStore(self.path)
+        original = image_module._focal_points
+        set_focal_point_store(store)
+        try:
+            path = os.path.join(DATADIR, "test1.jpg")
+            with open(path, "rb") as f:
+                img = Image(f)
+                store.set(img.fingerprint, (0.0, 0.0))
+
+                def _detect():
+                    raise AssertionError("should not detect")
+                img._detect_face_position = _detect
+                img.resize(100, 100, mode="crop", position="face")
+            with open(path, "rb") as f:
+                expected = Image(f).resize(
+                    100, 100, mode="crop", position="top-left")
+            self.assertEqual(img.img.tobytes(), expected.img.tobytes())
+        finally:
+            set_focal_point_store(original)
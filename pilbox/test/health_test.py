@@ -0,0 +1,120 @@
+from __future__ import absolute_import, division, with_statement
+
+from tornado.test.util import unittest
+
+from pilbox.health import HealthMonitor, HostHealth, RetryBudget, CLOSED, \
+    HALF_OPEN, OPEN
+
+
+class HostHealthTest(unittest.TestCase):
+
+    def test_opens_after_failures(self):
+        health = HostHealth(failures=3, reset=10.0)
+        for _ in range(2):
+            health.record(1.0, failed=True, now=0)
+        self.assertEqual(health.state, CLOSED)
+        self.assertTrue(health.allow(now=0))
+        health.record(1.0, failed=True, now=0)
+        self.assertEqual(health.state, OPEN)
+        self.assertFalse(health.allow(now=5))
+
+    def test_success_resets_failures(self):
+        health = HostHealth(failures=2)
+        health.record(1.0, failed=True)
+        health.record(1.0)
+        health.record(1.0, failed=True)
+        self.assertEqual(health.state, CLOSED)
+
+    def test_half_open_probe(self):
+        health = HostHealth(failures=1, reset=10.0)
+        health.record(1.0, failed=True, now=0)
+        self.assertTrue(health.allow(now=10))
+        self.assertEqual(health.state, HALF_OPEN)
+        # Only a single probe is allowed at a time
+        self.assertFalse(health.allow(now=10))
+        health.record(1.0, failed=True, now=10)
+        self.assertEqual(health.state, OPEN)
+        self.assertFalse(health.allow(now=15))
+        self.assertTrue(health.allow(now=20))
+        health.record(1.0, now=20)
+        self.assertEqual(health.state, CLOSED)
+        self.assertTrue(health.allow(now=20))
+
+    def test_never_opens(self):
+        health = HostHealth(failures=0)
+        for _ in range(100):
+            health.record(1.0, failed=True)
+        self.assertEqual(health.state, CLOSED)
+
+    def test_percentile(self):
+        health = HostHealth()
+        self.assertIsNone(health.get_percentile(99))
+        for i in range(1, 101):
+            health.record(i / 100.0)
+        self.assertEqual(health.get_percentile(50), 0.5)
+        self.assertEqual(health.get_percentile(99), 0.99)
+        self.assertEqual(health.get_percentile(100), 1.0)
+
+    def test_window(self):
+        health = HostHealth(window=10)
+        for i in range(20):
+            health.record(float(i))
+        self.assertEqual(health.get_percentile(0), 10.0)
+
+    def test_timeout(self):
+        health = HostHealth()
+        for _ in range(HostHealth.MIN_SAMPLES - 1):
+            health.record(0.5)
+        self.assertEqual(health.get_timeout(10.0), 10.0)
+        health.record(0.5)
+        self.assertEqual(health.get_timeout(10.0), 1.0)
+        self.assertEqual(health.get_timeout(10.0, minimum=2.0), 2.0)
+        self.assertEqual(health.get_timeout(0.5), 0.5)
+
+    def test_hedge_delay(self):
+        health = HostHealth()
+        for i in range(1, HostHealth.MIN_SAMPLES):
+            health.record_first_byte(i / 100.0)
+        self.assertIsNone(health.get_hedge_delay())
+        health.record_first_byte(0.2)
+        self.assertEqual(health.get_hedge_delay(), 0.19)
+
+
+class RetryBudgetTest(unittest.TestCase):
+
+    def test_ratio(self):
+        budget = RetryBudget(ratio=0.5, minimum=0)
+        self.assertFalse(budget.withdraw(now=0))
+        budget.deposit(now=0)
+        self.assertFalse(budget.withdraw(now=0))
+        budget.deposit(now=0)
+        self.assertTrue(budget.withdraw(now=0))
+        self.assertFalse(budget.withdraw(now=0))
+
+    def test_minimum(self):
+        budget = RetryBudget(ratio=0, minimum=2.0)
+        budget.withdraw(now=0)
+        budget.withdraw(now=0)
+        self.assertFalse(budget.withdraw(now=0))
+        self.assertTrue(budget.withdraw(now=1))
+        self.assertTrue(budget.withdraw(now=1))
+        self.assertFalse(budget.withdraw(now=1))
+
+    def test_capacity(self):
+        budget = RetryBudget(ratio=1.0, minimum=0, capacity=2.0)
+        for _ in range(10):
+            budget.deposit(now=0)
+        self.assertTrue(budget.withdraw(now=0))
+        self.assertTrue(budget.withdraw(now=0))
+        self.assertFalse(budget.withdraw(now=0))
+
+
+class HealthMonitorTest(unittest.TestCase):
+
+    def test_get(self):
+        monitor = HealthMonitor(failures=2, reset=5.0)
+        health = monitor.get("foo.co")
+        self.assertIs(monitor.get("foo.co"), health)
+        self.assertIsNot(monitor.get("bar.io"), health)
+        self.assertEqual(health.failures, 2)
+        self.assertEqual(health.reset, 5.0)
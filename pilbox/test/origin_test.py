@@ -0,0 +1,60 @@
+from __future__ import absolute_import, division, with_statement
+
+from tornado.test.util import unittest
+
+from pilbox.health import HealthMonitor
+from pilbox.origin import OriginGroup, parse_origins
+
+
+class OriginGroupTest(unittest.TestCase):
+
+    def setUp(self):
+        self._explore = OriginGroup.EXPLORE
+        OriginGroup.EXPLORE = 0
+
+    def tearDown(self):
+        OriginGroup.EXPLORE = self._explore
+
+    def test_parse(self):
+        origins = parse_origins(
+            ["a=http://a1.co/", "b=http://b1.co/", "a=http://a2.co/x/"],
+            HealthMonitor())
+        self.assertEqual(sorted(origins.keys()), ["a", "b"])
+        self.assertEqual(origins["a"].bases,
+                         ["http://a1.co/", "http://a2.co/x/"])
+        self.assertEqual(origins["b"].bases, ["http://b1.co/"])
+
+    def test_parse_invalid(self):
+        for spec in ["a", "=http://a.co/", "a=/x/"]:
+            self.assertRaises(Exception, parse_origins, [spec],
+                              HealthMonitor())
+
+    def test_urls(self):
+        group = OriginGroup("a", ["http://a1.co/", "http://a2.co/x/"],
+                            HealthMonitor())
+        self.assertEqual(group.get_urls("y.jpg"),
+                         ["http://a1.co/y.jpg", "http://a2.co/x/y.jpg"])
+        self.assertEqual(group.get_url("/y.jpg"), "http://a1.co/y.jpg")
+
+    def test_fastest_first(self):
+        health = HealthMonitor()
+        group = OriginGroup("a", ["http://a1.co/", "http://a2.co/"], health)
+        health.get("a1.co").record(0.5)
+        health.get("a2.co").record(0.1)
+        self.assertEqual(group.get_urls("y.jpg")[0], "http://a2.co/y.jpg")
+        for _ in range(10):
+            health.get("a2.co").record(1.0)
+        self.assertEqual(group.get_urls("y.jpg")[0], "http://a1.co/y.jpg")
+
+    def test_open_circuit_last(self):
+        health = HealthMonitor(failures=1)
+        group = OriginGroup("a", ["http://a1.co/", "http://a2.co/"], health)
+        health.get("a1.co").record(0.1, failed=True)
+        health.get("a2.co").record(1.0)
+        self.assertEqual(group.get_urls("y.jpg")[0], "http://a2.co/y.jpg")
+
+    def test_explore(self):
+        OriginGroup.EXPLORE = 1
+        group = OriginGroup("a", ["http://a1.co/", "http://a2.co/"],
+                            HealthMonitor())
+        self.assertEqual(group.get_urls("y.jpg")[0], "http://a2.co/y.jpg")
@@ -0,0 +1,46 @@
+from __future__ import absolute_import, division, with_statement
+
+from tornado.test.util import unittest
+
+from pilbox.peer import HashRing, parse_peers
+
+
+class HashRingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.peers = ["http://10.0.0.%d:8888" % i for i in range(1, 5)]
+        self.keys = ["http://foo.co/%d.jpg" % i for i in range(4000)]
+
+    def test_deterministic(self):
+        ring = HashRing(self.peers)
+        other = HashRing(list(reversed(self.peers)))
+        for key in self.keys[:100]:
+            self.assertEqual(ring.get(key), other.get(key))
+            self.assertTrue(ring.get(key) in self.peers)
+
+    def test_balanced(self):
+        ring = HashRing(self.peers)
+        counts = dict((peer, 0) for peer in self.peers)
+        for key in self.keys:
+            counts[ring.get(key)] += 1
+        for count in counts.values():
+            self.assertTrue(600 < count < 1400, counts)
+
+    def test_added_peer_moves_few_keys(self):
+        ring = HashRing(self.peers)
+        added = HashRing(self.peers + ["http://10.0.0.5:8888"])
+        moved = [key for key in self.keys if ring.get(key) != added.get(key)]
+        self.assertTrue(all(added.get(key) == "http://10.0.0.5:8888"
+                            for key in moved))
+        self.assertTrue(len(moved) < len(self.keys) / 3)
+
+    def test_empty(self):
+        self.assertIsNone(HashRing([]).get("a"))
+
+    def test_parse_peers(self):
+        self.assertIsNone(parse_peers([], None))
+        ring = parse_peers(["http://a:1/", "http://b:1"], "http://a:1")
+        self.assertEqual(ring.peers, ["http://a:1", "http://b:1"])
+        self.assertRaises(Exception, parse_peers, ["http://a:1"], None)
+        self.assertRaises(Exception, parse_peers, ["http://a:1"],
+                          "http://c:1")
@@ -0,0 +1,51 @@
+from __future__ import absolute_import, division, with_statement
+
+from tornado.test.util import unittest
+
+from pilbox.pool import BufferPool
+
+
+class BufferPoolTest(unittest.TestCase):
+
+    def test_write_read(self):
+        buf = BufferPool(initial=4).acquire()
+        buf.write(b"hello ")
+        buf.write(b"world")
+        self.assertEqual(buf.tell(), 11)
+        buf.seek(0)
+        self.assertEqual(buf.read(5), b"hello")
+        self.assertEqual(buf.read(), b" world")
+        self.assertEqual(buf.read(), b"")
+        self.assertEqual(buf.getvalue(), b"hello world")
+
+    def test_seek_write(self):
+        buf = BufferPool().acquire()
+        buf.write(b"abc")
+        buf.seek(1)
+        buf.write(b"x")
+        buf.seek(5)
+        buf.write(b"y")
+        self.assertEqual(buf.getvalue(), b"axc\x00\x00y")
+        self.assertEqual(buf.seek(-1, 2), 5)
+
+    def test_reuse(self):
+        pool = BufferPool(initial=4)
+        buf = pool.acquire()
+        buf.write(b"x" * 100)
+        buf.close()
+        self.assertTrue(buf.closed)
+        self.assertRaises(ValueError, buf.read)
+        self.assertEqual(len(pool), 1)
+        buf = pool.acquire()
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(buf.getvalue(), b"")
+        self.assertGreaterEqual(len(buf._data), 100)
+
+    def test_bounded(self):
+        pool = BufferPool(maxsize=1, maxcapacity=8, initial=4)
+        bufs = [pool.acquire() for _ in range(3)]
+        bufs[0].write(b"x" * 100)
+        for buf in bufs:
+            buf.close()
+        self.assertEqual(len(pool), 1)
+        self.assertEqual(len(pool.acquire()._data), 4)
@@ -0,0 +1,72 @@
+from __future__ import absolute_import, division, with_statement
+
+import os
+import shutil
+import tempfile
+
+import tornado.ioloop
+from tornado.test.util import unittest
+
+from pilbox.result import FileResultStore, ResultStore, get_format, \
+    get_result_key, get_result_store
+
+
+class ResultTest(unittest.TestCase):
+
+    def test_result_key(self):
+        key = get_result_key(dict(url="http://foo.co/x.jpg", w="10"))
+        self.assertEqual(
+            key, get_result_key(dict(w="10", url="http://foo.co/x.jpg")))
+        self.assertNotEqual(
+            key, get_result_key(dict(url="http://foo.co/x.jpg", w="20")))
+        self.assertEqual(len(key), 67)
+        self.assertEqual(key[:2], key[3:5])
+
+    def test_format(self):
+        path = os.path.join(os.path.dirname(__file__), "data")
+        for (name, fmt) in [("test1.jpg", "jpeg"), ("test2.png", "png"),
+                            ("test5.gif", "gif"),
+                            ("test4.webp", "webp")]:
+            with open(os.path.join(path, name), "rb") as f:
+                self.assertEqual(get_format(f.read()), fmt)
+        self.assertEqual(get_format(b"foo"), None)
+
+    def test_invalid_store(self):
+        self.assertRaises(Exception, get_result_store, "s3://bucket")
+        self.assertRaises(Exception, get_result_store, "http://foo.co")
+
+    def test_incomplete_store(self):
+        class _LookupOnlyStore(ResultStore):
+            async def _lookup(self, key):
+                return None
+        self.assertRaises(TypeError, _LookupOnlyStore)
+
+
+class FileResultStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = FileResultStore(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def run_sync(self, func):
+        return tornado.ioloop.IOLoop.current().run_sync(func)
+
+    def test_put(self):
+        key = get_result_key(dict(url="x"))
+        self.assertEqual(self.run_sync(lambda: self.store.lookup(key)), None)
+        name = self.run_sync(lambda: self.store.put(key, b"GIF89a"))
+        self.assertEqual(name, key + ".gif")
+        with open(os.path.join(self.root, name), "rb") as f:
+            self.assertEqual(f.read(), b"GIF89a")
+        self.assertEqual(os.listdir(os.path.dirname(
+            os.path.join(self.root, name))), [os.path.basename(name)])
+
+    def test_lookup(self):
+        key = get_result_key(dict(url="x"))
+        self.run_sync(lambda: self.store.put(key, b"\x89PNG"))
+        store = FileResultStore(self.root)
+        self.assertEqual(self.run_sync(lambda: store.lookup(key)),
+                         key + ".png")
@@ -10,9 +10,19 @@ from tornado.test.util import unittest
 
 TEST_MODULES = [
     'pilbox.test.app_test',
+    'pilbox.test.cache_test',
     'pilbox.test.errors_test',
+    'pilbox.test.focalpoint_test',
+    'pilbox.test.health_test',
     'pilbox.test.image_test',
+    'pilbox.test.origin_test',
+    'pilbox.test.peer_test',
+    'pilbox.test.pool_test',
+    'pilbox.test.result_test',
+    'pilbox.test.shm_test',
     'pilbox.test.signature_test',
+    'pilbox.test.source_test',
+    'pilbox.test.supervisor_test',
 ]
 
 
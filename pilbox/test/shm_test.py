@@ -0,0 +1,116 @@
+from __future__ import absolute_import, division, with_statement
+
+import os
+import signal
+import time
+
+from tornado.test.util import unittest
+
+from pilbox.shm import SharedCache
+
+
+class SharedCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = SharedCache(64 * 1024, stripes=1, page_size=16 * 1024)
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.assertTrue(self.cache.set("a", b"1"))
+        self.assertEqual(self.cache.get("a"), b"1")
+        self.assertTrue(self.cache.set("a", b"2" * 1000))
+        self.assertEqual(self.cache.get("a"), b"2" * 1000)
+        self.cache.delete("a")
+        self.assertIsNone(self.cache.get("a"))
+        stats = self.cache.get_stats()
+        self.assertEqual((stats["items"], stats["hits"], stats["misses"],
+                          stats["sets"]), (0, 2, 2, 2))
+
+    def test_add(self):
+        self.assertTrue(self.cache.add("a", b"1"))
+        self.assertFalse(self.cache.add("a", b"2"))
+        self.assertEqual(self.cache.get("a"), b"1")
+        self.assertTrue(self.cache.add("b", b"1", ttl=10, now=0))
+        self.assertTrue(self.cache.add("b", b"2", ttl=10, now=10))
+        self.assertEqual(self.cache.get("b", now=10), b"2")
+        self.assertEqual(self.cache.get_stats()["items"], 2)
+
+    def test_ttl(self):
+        self.cache.set("a", b"1", ttl=10, now=0)
+        self.assertEqual(self.cache.get("a", now=9), b"1")
+        self.assertIsNone(self.cache.get("a", now=10))
+        self.assertEqual(self.cache.get_stats()["items"], 0)
+
+    def test_too_large(self):
+        self.assertFalse(self.cache.set("a", b"1" * 16 * 1024))
+        self.assertIsNone(self.cache.get("a"))
+
+    def test_evicts_unread(self):
+        # Four pages of 2KB chunks, eight chunks each
+        for i in range(32):
+            self.cache.set(str(i), b"%d" % i * 1000)
+        self.assertEqual(self.cache.get_stats()["evictions"], 0)
+        self.assertEqual(self.cache.get("0"), b"0" * 1000)
+        self.cache.set("32", b"x" * 1000)
+        self.assertEqual(self.cache.get("0"), b"0" * 1000)
+        self.assertIsNone(self.cache.get("1"))
+        self.assertEqual(self.cache.get("32"), b"x" * 1000)
+        self.assertEqual(self.cache.get_stats()["evictions"], 1)
+
+    def test_steals_page(self):
+        for i in range(32):
+            self.cache.set(str(i), b"x" * 1000)
+        self.assertTrue(self.cache.set("small", b"y"))
+        self.assertEqual(self.cache.get("small"), b"y")
+        self.assertEqual(self.cache.get_stats()["evictions"], 8)
+        values = [self.cache.get(str(i)) for i in range(32)]
+        self.assertEqual(values.count(None), 8)
+        self.assertTrue(self.cache.set("large", b"z" * 1000))
+        self.assertEqual(self.cache.get("large"), b"z" * 1000)
+
+    def test_stripes(self):
+        cache = SharedCache(1024 * 1024, stripes=4, page_size=16 * 1024)
+        values = dict(("k%d" % i, os.urandom(i * 10)) for i in range(200))
+        for (k, v) in values.items():
+            cache.set(k, v)
+        for (k, v) in values.items():
+            self.assertEqual(cache.get(k), v)
+        self.assertEqual(cache.get_stats()["items"], 200)
+
+    @unittest.skipIf(not hasattr(os, "fork"), "fork is not supported")
+    def test_shared_with_forked_process(self):
+        self.cache.set("parent", b"1")
+        pid = os.fork()
+        if pid == 0:
+            ok = False
+            try:
+                ok = self.cache.get("parent") == b"1"
+                self.cache.set("child", b"2")
+            finally:
+                os._exit(0 if ok else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertEqual(self.cache.get("child"), b"2")
+
+    @unittest.skipIf(not hasattr(os, "fork"), "fork is not supported")
+    def test_killed_lock_holder(self):
+        self.cache.set("a", b"1")
+        self.cache.lock_timeout = 0.1
+        pid = os.fork()
+        if pid == 0:
+            self.cache._locks[0].acquire()
+            os.kill(os.getpid(), signal.SIGKILL)
+        _, status = os.waitpid(pid, 0)
+        self.assertTrue(os.WIFSIGNALED(status))
+        with self.assertLogs("tornado.application", "WARNING") as logs:
+            self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(len(logs.output), 1)
+        start = time.time()
+        self.assertFalse(self.cache.set("b", b"2"))
+        self.cache.delete("a")
+        self.assertEqual(self.cache.get_stats()["stalled"], 1)
+        self.assertLess(time.time() - start, 0.1)
+        # The stripe is used again once its lock is released
+        self.cache._locks[0].release()
+        self.assertEqual(self.cache.get("a"), b"1")
+        self.assertEqual(self.cache.get_stats()["stalled"], 0)
@@ -5,7 +5,8 @@ import hmac
 
 from tornado.test.util import unittest
 
-from pilbox.signature import derive_signature, sign, verify_signature
+from pilbox.signature import derive_signature, sign, verify_signature, \
+    Verifier, EXPIRED, INVALID, VALID
 
 try:
     import urlparse
@@ -42,3 +43,50 @@ class SignatureTest(unittest.TestCase):
         qs_list = ["x=1&y=2&z=3", "x=%20%2B%2F!%40%23%24%25%5E%26"]
         for qs in qs_list:
             self.assertFalse(verify_signature(key1, sign(key2, qs)))
+
+    def test_derive_v2(self):
+        key = "abc123"
+        qs = "x=1&y=2&z=3"
+        m = hmac.new(key.encode(), qs.encode(), hashlib.sha256)
+        self.assertEqual(derive_signature(key, qs, 2), m.hexdigest())
+
+    def test_verify_v2(self):
+        key = "abc123"
+        qs_list = ["x=1&y=2&z=3", "x=%20%2B%2F!%40%23%24%25%5E%26"]
+        for qs in qs_list:
+            self.assertTrue(verify_signature(key, sign(key, qs, 2)))
+            self.assertFalse(verify_signature("def456", sign(key, qs, 2)))
+
+    def test_verify_v2_signature_first(self):
+        key = "abc123"
+        qs = "sig=%s&x=1" % derive_signature(key, "x=1", 2)
+        self.assertTrue(verify_signature(key, qs))
+
+    def test_expiry(self):
+        verifier = Verifier(["abc123"])
+        qs = sign("abc123", "x=1", 2, expires=1000)
+        self.assertEqual(verifier.verify(qs, now=999), VALID)
+        self.assertEqual(verifier.verify(qs, now=1000), EXPIRED)
+        self.assertEqual(verifier.verify(
+            qs.replace("exp=1000", "exp=2000"), now=999), INVALID)
+        self.assertEqual(verifier.verify(
+            qs.replace("exp=1000", "exp=x"), now=999), INVALID)
+
+    def test_v1_ignores_expiry(self):
+        verifier = Verifier(["abc123"])
+        qs = sign("abc123", "x=1", 1, expires=1000)
+        self.assertEqual(verifier.verify(qs, now=2000), VALID)
+
+    def test_multiple_keys(self):
+        verifier = Verifier(["abc123", "def456"])
+        for version in [1, 2]:
+            for key in ["abc123", "def456"]:
+                qs = sign(key, "x=1", version)
+                self.assertEqual(verifier.verify(qs), VALID)
+            qs = sign("ghi789", "x=1", version)
+            self.assertEqual(verifier.verify(qs), INVALID)
+
+    def test_missing_signature(self):
+        verifier = Verifier(["abc123"])
+        self.assertEqual(verifier.verify("x=1"), INVALID)
+        self.assertEqual(verifier.verify("x=1&sig=abc"), INVALID)
@@ -0,0 +1,115 @@
+from __future__ import absolute_import, division, with_statement
+
+import os
+import subprocess
+import tempfile
+
+from tornado.test.util import unittest
+
+from pilbox import supervisor as supervisor_module
+from pilbox.supervisor import get_cpu_count, get_cpus, get_rss, \
+    Supervisor, Worker
+
+
+class _Server(object):
+    stopped = False
+
+    def stop(self):
+        self.stopped = True
+
+
+class SupervisorTest(unittest.TestCase):
+
+    def _start_worker(self, supervisor):
+        slot = supervisor._get_slots(supervisor_module._FREE)[0]
+        supervisor._set(slot, supervisor_module._STATE,
+                        supervisor_module._SERVING)
+        worker = Worker(supervisor, slot)
+        worker._server = _Server()
+        return worker
+
+    def test_recycle_requests(self):
+        supervisor = Supervisor(workers=1, max_requests=2)
+        worker = self._start_worker(supervisor)
+        worker.request_started()
+        worker.request_finished()
+        self.assertFalse(worker.draining)
+        worker.request_started()
+        worker.request_started()
+        worker.request_finished()
+        self.assertTrue(worker.draining)
+        self.assertEqual(worker.active, 1)
+        # Connections are accepted until the replacement is serving
+        server = worker._server
+        worker.check()
+        self.assertFalse(server.stopped)
+        self._start_worker(supervisor)
+        worker.check()
+        self.assertTrue(server.stopped)
+        stats = supervisor.get_stats()
+        self.assertEqual(stats["recycles"]["requests"], 1)
+        self.assertEqual(stats["workers"][0]["requests"], 2)
+        self.assertTrue(stats["workers"][0]["draining"])
+
+    def test_recycle_memory(self):
+        supervisor = Supervisor(workers=1, max_rss=1)
+        worker = self._start_worker(supervisor)
+        worker.check()
+        self.assertTrue(worker.draining)
+        stats = supervisor.get_stats()
+        self.assertEqual(stats["recycles"]["memory"], 1)
+        self.assertGreater(stats["workers"][0]["rss"], 0)
+
+    def test_shutdown_not_counted(self):
+        supervisor = Supervisor(workers=1)
+        worker = self._start_worker(supervisor)
+        worker.check()
+        self.assertFalse(worker.draining)
+        server = worker._server
+        worker.drain()
+        self.assertTrue(worker.draining)
+        self.assertTrue(server.stopped)
+        self.assertEqual(sum(supervisor.get_stats()["recycles"].values()), 0)
+
+    def test_no_free_slot(self):
+        supervisor = Supervisor(workers=1, drain_timeout=0)
+        procs = []
+        for slot in supervisor._get_slots(supervisor_module._FREE):
+            procs.append(subprocess.Popen(["sleep", "60"]))
+            supervisor._set(slot, supervisor_module._PID, procs[-1].pid)
+            supervisor._set(slot, supervisor_module._STATE,
+                            supervisor_module._DRAINING)
+        try:
+            with self.assertLogs("tornado.application", "WARNING") as logs:
+                self.assertIsNone(supervisor._replace_workers())
+                # Draining workers that overrun their timeout are killed
+                self.assertIsNone(supervisor._replace_workers())
+            self.assertIn("No free worker slot", logs.output[0])
+            self.assertIn("Killing worker %d" % procs[0].pid,
+                          logs.output[1])
+            for proc in procs:
+                self.assertEqual(proc.wait(5), -9)
+        finally:
+            for proc in procs:
+                if proc.poll() is None:
+                    proc.kill()
+
+    def test_get_rss(self):
+        self.assertGreater(get_rss(), 0)
+
+    def test_cgroup_quota(self):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, b"150000 100000\n")
+        os.close(fd)
+        original = supervisor_module._CGROUP_CPU_MAX
+        supervisor_module._CGROUP_CPU_MAX = path
+        try:
+            self.assertEqual(supervisor_module._get_cgroup_quota(), 1.5)
+            self.assertEqual(get_cpu_count(), min(len(get_cpus()), 2))
+            with open(path, "w") as f:
+                f.write("max 100000\n")
+            self.assertIsNone(supervisor_module._get_cgroup_quota())
+            self.assertEqual(get_cpu_count(), len(get_cpus()))
+        finally:
+            supervisor_module._CGROUP_CPU_MAX = original
+            os.remove(path)
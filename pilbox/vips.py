@@ -0,0 +1,363 @@
+#!/usr/bin/env python
+#
+# Copyright 2013 Adam Gschwender
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+from __future__ import absolute_import, division, print_function, \
+    with_statement
+
+import math
+
+import PIL.Image
+
+from pilbox import errors
+from pilbox.image import color_hex_to_dec_tuple, get_encoder_profile, \
+    Image, _formats_to_pil, _orientation_to_rotation
+
+try:
+    from io import BytesIO
+except ImportError:
+    from cStringIO import StringIO as BytesIO
+
+try:
+    import pyvips
+except (ImportError, OSError):
+    pyvips = None
+
+_filters_to_vips = {
+    "antialias": "lanczos3",
+    "bicubic": "cubic",
+    "bilinear": "linear",
+    "nearest": "nearest"
+}
+
+_formats_to_vips = {
+    "GIF": ".gif",
+    "JPEG": ".jpg",
+    "PNG": ".png",
+    "WEBP": ".webp",
+    "TIFF": ".tif"
+}
+
+# The libvips save arguments of the Pillow ones of encoder profiles, others
+# continue with Pillow
+_profiles_to_vips = {
+    ("JPEG", "optimize"): "optimize_coding",
+    ("JPEG", "progressive"): "interlace",
+    ("PNG", "compress_level"): "compression",
+    ("WEBP", "lossless"): "lossless",
+    ("WEBP", "method"): "effort"
+}
+
+_bands_to_pil_mode = {1: "L", 2: "LA", 3: "RGB", 4: "RGBA"}
+
+
+class VipsImage(Image):
+    """An Image processed with libvips. Pipelines are demand-driven, so the
+    source is decoded in a single sequential pass when the image is saved,
+    and a leading resize loads the source already shrunk where the format
+    allows, e.g. using JPEG DCT scaling.
+
+    Operations libvips does not support in the same way as Pillow, i.e.
+    face cropping, non right angle rotation, animation, keep and auto
+    quality, continue with the Pillow implementation.
+    """
+
+    def __init__(self, stream):
+        # Pillow only reads the header here, validating the source format
+        Image.__init__(self, stream)
+        self.vimg = None
+        self._pil = bool(self._animated)
+
+    def has_alpha(self):
+        if self.vimg is not None:
+            return self.vimg.hasalpha()
+        return Image.has_alpha(self)
+
+    def region(self, rect):
+        if self._pil:
+            return Image.region(self, rect)
+        box = (int(rect[0]), int(rect[1]), int(rect[0]) + int(rect[2]),
+               int(rect[1]) + int(rect[3]))
+        size = self._get_current_size()
+        if box[2] > size[0] or box[3] > size[1]:
+            raise errors.RectangleError("Region out-of-bounds")
+        elif box == (0, 0) + size:
+            return self  # The region is the entire image
+        self.vimg = self._load().crop(box[0], box[1], int(rect[2]),
+                                      int(rect[3]))
+        self._modified = True
+        self._spec.append(("region", (tuple(rect),), ()))
+        return self
+
+    def resize(self, width, height, **kwargs):
+        opts = Image._normalize_options(kwargs)
+        if self._pil or (opts["position"] == "face"
+                         and opts["mode"] in ["adapt", "crop"]):
+            self._use_pil()
+            return Image.resize(self, width, height, **kwargs)
+        size = self._get_size(width, height)
+        if self._is_identity_resize(size, opts):
+            return self
+        elif opts["mode"] == "adapt":
+            self._vips_adapt(size, opts)
+        elif opts["mode"] == "clip":
+            self._vips_clip(size, opts)
+        elif opts["mode"] == "fill":
+            self._vips_fill(size, opts)
+        elif opts["mode"] == "scale":
+            self._vips_scale(size, opts)
+        else:
+            self._vips_crop(size, opts)
+        self._modified = True
+        self._spec.append(
+            ("resize", (width, height), Image._spec_options(kwargs)))
+        return self
+
+    def rotate(self, deg, **kwargs):
+        if deg == "auto":
+            # As with Pillow, the orientation only applies to the source
+            if self._orig_format == "JPEG" and self.vimg is None:
+                deg = _orientation_to_rotation.get(
+                    self._get_orientation(), 0)
+            else:
+                deg = 0
+        if self._pil or int(deg) % 90 != 0:
+            self._use_pil()
+            return Image.rotate(self, deg, **kwargs)
+        elif int(deg) % 360 == 0:
+            return self
+        self._modified = True
+        self._spec.append(("rotate", (deg,), Image._spec_options(kwargs)))
+        # Rotation reads the source out of order, so it is buffered
+        img = self._load().copy_memory()
+        self.vimg = img.rot("d%d" % (int(deg) % 360))
+        return self
+
+    def save(self, **kwargs):
+        opts = Image._normalize_options(kwargs)
+        if opts["format"] == Image.AUTO_FORMAT:
+            fmt = _formats_to_pil.get(self.get_auto_format())
+        elif opts["pil"]["format"]:
+            fmt = opts["pil"]["format"]
+        else:
+            fmt = self._orig_format
+
+        profile = get_encoder_profile(opts["profile"], fmt)
+        if self._pil or self.vimg is None or \
+                opts["quality"] in ["keep", "auto"] or \
+                any((fmt, k) not in _profiles_to_vips for k in profile):
+            self._use_pil()
+            return Image.save(self, **kwargs)
+
+        color = color_hex_to_dec_tuple(opts["background"])
+        self._vips_prepare(fmt, color)
+
+        save_kwargs = dict((_profiles_to_vips[(fmt, k)], v)
+                           for (k, v) in profile.items())
+        if fmt in ["JPEG", "WEBP"]:
+            save_kwargs["Q"] = int(opts["quality"])
+        if fmt == "JPEG":
+            if int(opts["optimize"]):
+                save_kwargs["optimize_coding"] = True
+            if int(opts["progressive"]):
+                save_kwargs["interlace"] = True
+        elif fmt == "PNG":
+            if int(opts["optimize"]):
+                save_kwargs["compression"] = 9
+            save_kwargs.setdefault("compression", 6)
+
+        save_kwargs.update(_keep_metadata(int(opts["preserve_exif"])))
+
+        try:
+            data = self.vimg.write_to_buffer(
+                _formats_to_vips[fmt], **save_kwargs)
+        except pyvips.Error as e:
+            raise errors.ImageSaveError(str(e))
+        # As with Pillow, the format saved as is reported by the image
+        self.img.format = fmt
+        return BytesIO(data)
+
+    def _load(self, size=None, kernel=None):
+        """Returns the libvips image, loading the source on first use. When
+        a size is supplied, the loaded image is resized to it, shrinking
+        on load where possible.
+        """
+        if self.vimg is not None:
+            if size is not None:
+                return _resize(self.vimg, size, kernel)
+            return self.vimg
+        data = self._get_source_bytes()
+        try:
+            if isinstance(data, bytes):
+                if size is not None and kernel == "lanczos3":
+                    return pyvips.Image.thumbnail_buffer(
+                        data, size[0], height=size[1], size="force",
+                        no_rotate=True)
+                img = pyvips.Image.new_from_buffer(
+                    data, "", access="sequential")
+            else:
+                # A memory mapped file is loaded in place, not copied
+                source = pyvips.Source.new_from_memory(data)
+                if size is not None and kernel == "lanczos3":
+                    return pyvips.Image.thumbnail_source(
+                        source, size[0], height=size[1], size="force",
+                        no_rotate=True)
+                img = pyvips.Image.new_from_source(
+                    source, "", access="sequential")
+        except pyvips.Error as e:
+            raise errors.ImageFormatError(str(e))
+        if size is not None:
+            return _resize(img, size, kernel)
+        return img
+
+    def _use_pil(self):
+        """Continues processing with Pillow"""
+        if self.vimg is not None:
+            self.img = _vips_to_pil(self.vimg)
+            self.vimg = None
+        self._pil = True
+
+    def _get_current_size(self):
+        if self.vimg is not None:
+            return (self.vimg.width, self.vimg.height)
+        return self.img.size
+
+    def _get_size(self, width, height):
+        w, h = self._get_current_size()
+        if not width:
+            width = int((int(height) or h) * (w / h))
+        if not height:
+            height = int((int(width) or w) / (w / h))
+        return (int(width), int(height))
+
+    def _is_identity_resize(self, size, opts):
+        current = self._get_current_size()
+        if size == current:
+            return True
+        return opts["mode"] == "clip" and size[0] >= current[0] \
+            and size[1] >= current[1]
+
+    def _vips_adapt(self, size, opts):
+        w, h = self._get_current_size()
+        source_aspect_ratio = w / h
+        aspect_ratio = size[0] / size[1]
+        if source_aspect_ratio >= aspect_ratio:
+            retain = (aspect_ratio / source_aspect_ratio) * 100.0
+        else:
+            retain = (source_aspect_ratio / aspect_ratio) * 100.0
+
+        if float(opts["retain"]) <= retain:
+            self._vips_crop(size, opts)
+        else:
+            self._vips_fill(size, opts)
+
+    def _vips_clip(self, size, opts):
+        size = _get_clip_size(self._get_current_size(), size)
+        if size is not None:
+            self.vimg = self._load(size, _filters_to_vips[opts["filter"]])
+
+    def _vips_crop(self, size, opts):
+        # Resize to cover the box, then crop at the position ratio
+        w, h = self._get_current_size()
+        scale = max(size[0] / w, size[1] / h)
+        cover = (max(size[0], int(round(w * scale))),
+                 max(size[1], int(round(h * scale))))
+        img = self._load(cover, _filters_to_vips[opts["filter"]])
+        pos = opts["pil"]["position"]
+        x = int(round((cover[0] - size[0]) * pos[0]))
+        y = int(round((cover[1] - size[1]) * pos[1]))
+        self.vimg = img.crop(x, y, size[0], size[1])
+
+    def _vips_fill(self, size, opts):
+        self._vips_clip(size, opts)
+        img = self._load()
+        if (img.width, img.height) == size:
+            return  # No need to fill
+        x = max(int((size[0] - img.width) / 2.0), 0)
+        y = max(int((size[1] - img.height) / 2.0), 0)
+        color = color_hex_to_dec_tuple(opts["background"])
+        img = _to_srgb(img)
+        if len(color) == 4:
+            if not img.hasalpha():
+                img = img.bandjoin(255)
+        elif img.hasalpha():
+            img = img.flatten(background=list(color))
+        self.vimg = img.embed(x, y, size[0], size[1], extend="background",
+                              background=list(color))
+        self._skip_background = True
+
+    def _vips_scale(self, size, opts):
+        self.vimg = self._load(size, _filters_to_vips[opts["filter"]])
+
+    def _vips_prepare(self, fmt, color):
+        img = self.vimg
+        if img.hasalpha():
+            img = _to_srgb(img)
+            if fmt in ["GIF", "JPEG"]:
+                img = img.flatten(background=list(color[:3]))
+            elif not self._skip_background and \
+                    (len(color) == 3 or color[3] > 0):
+                # Composite onto the background, as Pillow does
+                color = list(color) + [255] * (4 - len(color))
+                img = img.new_from_image(color).composite2(
+                    img, "over").cast("uchar")
+        self.vimg = img
+
+
+def _get_clip_size(current, size):
+    """Returns the size of an image clipped to fit the supplied size,
+    rounded as Pillow's thumbnail does, or None if it already fits.
+    """
+    x, y = size
+    if x >= current[0] and y >= current[1]:
+        return None
+    aspect = current[0] / current[1]
+
+    def round_aspect(number, key):
+        return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+    if x / y >= aspect:
+        x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+    else:
+        y = round_aspect(
+            x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+    return (int(x), int(y))
+
+
+def _resize(img, size, kernel):
+    if kernel == "lanczos3":
+        return img.thumbnail_image(size[0], height=size[1], size="force")
+    return img.resize(size[0] / img.width, vscale=size[1] / img.height,
+                      kernel=kernel)
+
+
+def _keep_metadata(exif):
+    if pyvips.at_least_libvips(8, 15):
+        return dict(keep="exif" if exif else "none")
+    return dict(strip=not exif)
+
+
+def _to_srgb(img):
+    if img.interpretation != "srgb" or img.format != "uchar":
+        img = img.colourspace("srgb").cast("uchar")
+    return img
+
+
+def _vips_to_pil(img):
+    if img.interpretation != "b-w" or img.format != "uchar":
+        img = _to_srgb(img)
+    mode = _bands_to_pil_mode[img.bands]
+    return PIL.Image.frombytes(
+        mode, (img.width, img.height), img.write_to_memory())
@@ -26,8 +26,6 @@ setup(name='pilbox',
       long_description=readme,
       classifiers=[
         'License :: OSI Approved :: Apache Software License',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
         'Programming Language :: Python :: 3.6',
         ],
@@ -35,6 +33,7 @@ setup(name='pilbox',
       author='Adam Gschwender',
       author_email='adam.gschwender@gmail.com',
       license='http://www.apache.org/licenses/LICENSE-2.0',
+      python_requires='>=3.5',
       include_package_data=True,
       packages=['pilbox'],
       package_data={
@@ -47,7 +46,9 @@ setup(name='pilbox',
         ],
       extras_require = {
           'Proxy': ['pycurl'],
-          'Facial Recognition': ['cv']
+          'Facial Recognition': ['opencv-python'],
+          'Vips': ['pyvips'],
+          'uvloop': ['uvloop']
       },
       zip_safe=True,
       cmdclass={'test': PilboxTest},